@@ -1,5 +1,5 @@
 from core import Evaluation
-__all__ = ['core','models','solvers','trk2dictionary']
+__all__ = ['core','models','solvers','history','telemetry','batch','trk2dictionary']
 
 from pkg_resources import get_distribution
 __version__ = get_distribution('commit').version
@@ -0,0 +1,240 @@
+"""
+Fit several subjects that share the acquisition scheme.
+
+The response functions are generated and resampled once, in the calling
+process, and stored in shared memory; the subjects are then fitted by a pool
+of processes, each using a part of the cores for the products with A and A'.
+Every subject is fitted in a fresh process, so that its memory is released
+when it is done, and its output is written to a log file in its folder.
+"""
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import sys
+import time
+import traceback
+from os.path import join as pjoin
+import numpy as np
+import amico.scheme
+from commit.core import Evaluation
+
+# kernels in shared memory, as seen by the worker processes
+_SHARED = None
+
+
+def split_cores( n_subjects, n_jobs = None, n_threads = None ) :
+    """Split the cores of the system between concurrent subjects and operator threads.
+
+    Parameters
+    ----------
+    n_subjects : integer
+        Number of subjects to fit
+    n_jobs : integer
+        Number of subjects fitted at the same time (default : as many as possible with
+        n_threads threads each)
+    n_threads : integer
+        Number of threads of the operator of each subject (default : the cores divided by
+        n_jobs or, if both are None, at most 4, as the products are limited by the memory
+        bandwidth and scale sublinearly with the threads)
+
+    Returns
+    -------
+    n_jobs, n_threads : integers
+    """
+    try :
+        n_cpu = multiprocessing.cpu_count()
+    except NotImplementedError :
+        n_cpu = 1
+    if n_jobs is None and n_threads is None :
+        n_threads = min( 4, n_cpu )
+    if n_jobs is None :
+        n_jobs = max( 1, n_cpu // n_threads )
+    n_jobs = max( 1, min( n_jobs, n_subjects ) )
+    if n_threads is None :
+        n_threads = max( 1, n_cpu // n_jobs )
+    return n_jobs, n_threads
+
+
+def _share( KERNELS ) :
+    """Copy the arrays of KERNELS to shared memory; returns what the workers need to
+    rebuild the dictionary (buffer, dtype and shape of the arrays, other values as is)."""
+    shared = {}
+    for key, value in KERNELS.items() :
+        if isinstance( value, np.ndarray ) :
+            buf = RawArray( 'b', max( value.nbytes, 1 ) )
+            np.frombuffer( buf, dtype=value.dtype, count=value.size ).reshape( value.shape )[...] = value
+            shared[key] = ( buf, value.dtype.str, value.shape )
+        else :
+            shared[key] = value
+    return shared
+
+
+def _init_worker( shared ) :
+    global _SHARED
+    _SHARED = shared
+
+
+def _kernels() :
+    """Dictionary of the kernels whose arrays are views of the shared memory; a new
+    dictionary is returned at each call, as Evaluation.compact_kernels() replaces its
+    entries with the compacted tables of the subject."""
+    KERNELS = {}
+    for key, value in _SHARED.items() :
+        if isinstance( value, tuple ) :
+            buf, dtype, shape = value
+            dtype = np.dtype( dtype )
+            KERNELS[key] = np.frombuffer( buf, dtype=dtype, count=int(np.prod(shape)) ).reshape( shape )
+        else :
+            KERNELS[key] = value
+    return KERNELS
+
+
+def _fit_subject( job ) :
+    """Fit one subject in a worker process; never raises, the outcome is in the report."""
+    report = { 'subject' : job['subject'], 'status' : 'ok', 'error' : None, 'timings' : {} }
+    log_filename = pjoin( job['study_path'], job['subject'], job['log_filename'] )
+    stdout = sys.stdout
+    tic_total = time.time()
+    try :
+        sys.stdout = open( log_filename, 'w' )
+        timings = report['timings']
+
+        def step( name, f, *args, **kwargs ) :
+            tic = time.time()
+            out = f( *args, **kwargs )
+            timings[name] = time.time() - tic
+            return out
+
+        mit = Evaluation( job['study_path'], job['subject'] )
+        for key, value in job['config'].items() :
+            mit.set_config( key, value )
+        step( 'load_data', mit.load_data, job['dwi_filename'], job['scheme_filename'], job['b0_thr'] )
+        if not np.array_equal( mit.scheme.raw, job['scheme'] ) :
+            raise RuntimeError( 'The acquisition scheme differs from that of the kernels' )
+        mit.set_model( job['model'] )
+        mit.model.set( *job['model_params'] )
+        mit.model.scheme = mit.scheme
+        mit.set_config( 'lmax', job['lmax'] )
+        mit.KERNELS = _kernels()
+        step( 'load_dictionary', mit.load_dictionary, job['dictionary_path'], **job['dictionary_kwargs'] )
+        step( 'set_threads', mit.set_threads, job['n_threads'] )
+        step( 'build_operator', mit.build_operator )
+        step( 'fit', mit.fit, **job['fit_kwargs'] )
+        step( 'save_results', mit.save_results, **job['save_kwargs'] )
+    except Exception :
+        report['status'] = 'failed'
+        report['error'] = traceback.format_exc()
+        if sys.stdout is not stdout :
+            print report['error']
+    finally :
+        if sys.stdout is not stdout :
+            sys.stdout.close()
+            sys.stdout = stdout
+    report['timings']['total'] = time.time() - tic_total
+    return report
+
+
+def run( study_path, subjects, model, model_params = (), dictionary_path = 'COMMIT',
+         dwi_filename = 'DWI.nii', scheme_filename = 'DWI.scheme', b0_thr = 0,
+         config = None, regenerate_kernels = False, lmax = 12, dictionary_kwargs = None,
+         fit_kwargs = None, save_kwargs = None, n_jobs = None, n_threads = None,
+         log_filename = 'commit_batch.log' ) :
+    """Fit the subjects of a study that share the acquisition scheme.
+
+    The kernels are generated (if needed) and resampled once to the scheme of the first
+    subject, then stored in shared memory and used by all the subjects, which are fitted
+    concurrently by a pool of processes. Each subject goes through load_data(),
+    load_dictionary(), set_threads(), build_operator(), fit() and save_results(); a
+    failure affects only the subject concerned, e.g. when its scheme differs from the
+    one of the kernels, and is described in the report.
+
+    Parameters
+    ----------
+    study_path : string
+        The path to the folder containing all the subjects of the study
+    subjects : list of strings
+        The folders of the subjects, relative to study_path
+    model : string
+        Name of the model (see Evaluation.set_model)
+    model_params : tuple
+        Arguments of the set() method of the model (default : ())
+    dictionary_path : string
+        Folder of the dictionary of each subject, relative to its folder (default : 'COMMIT')
+    dwi_filename, scheme_filename, b0_thr :
+        Arguments of Evaluation.load_data()
+    config : dict
+        Values to set with Evaluation.set_config() for every subject, e.g. the
+        normalization flags (default : None)
+    regenerate_kernels : boolean
+        Regenerate the kernels even if they already exist (default : False)
+    lmax : integer
+        Maximum SH order of the rotation of the kernels (default : 12)
+    dictionary_kwargs, fit_kwargs, save_kwargs : dict
+        Keyword arguments of Evaluation.load_dictionary(), fit() and save_results()
+        (default : None)
+    n_jobs, n_threads : integers
+        Number of subjects fitted at the same time and number of threads of each of
+        them; see split_cores() for the defaults
+    log_filename : string
+        File, in the folder of each subject, where its output is written
+        (default : 'commit_batch.log')
+
+    Returns
+    -------
+    reports : list of dicts
+        For each subject, in the given order: 'subject', 'status' ('ok' or 'failed'),
+        'error' (the traceback of a failure) and 'timings' (seconds spent in each step
+        and in total)
+    """
+    config = {} if config is None else config
+    n_jobs, n_threads = split_cores( len(subjects), n_jobs, n_threads )
+
+    tic = time.time()
+    print '\n-> Preparing the kernels shared by %d subjects:' % len(subjects)
+    mit = Evaluation( study_path, subjects[0] )
+    for key, value in config.items() :
+        mit.set_config( key, value )
+    mit.scheme = amico.scheme.Scheme( pjoin( study_path, subjects[0], scheme_filename ), b0_thr )
+    mit.set_model( model )
+    mit.model.set( *model_params )
+    mit.generate_kernels( regenerate = regenerate_kernels, lmax = lmax )
+    mit.load_kernels()
+    shared = _share( mit.KERNELS )
+    nbytes = sum( v.nbytes for v in mit.KERNELS.values() if isinstance( v, np.ndarray ) )
+    print '\t* %.1f MB of kernels in shared memory' % ( nbytes / 1024.0**2 )
+    print '\t* %d subjects at a time, %d threads each' % ( n_jobs, n_threads )
+    print '   [ %.1f seconds ]' % ( time.time() - tic )
+
+    job = {
+        'study_path' : study_path, 'dwi_filename' : dwi_filename, 'scheme_filename' : scheme_filename,
+        'b0_thr' : b0_thr, 'scheme' : mit.scheme.raw, 'config' : config, 'model' : model,
+        'model_params' : tuple( model_params ), 'lmax' : lmax, 'dictionary_path' : dictionary_path,
+        'dictionary_kwargs' : dictionary_kwargs or {}, 'fit_kwargs' : fit_kwargs or {},
+        'save_kwargs' : save_kwargs or {}, 'n_threads' : n_threads, 'log_filename' : log_filename,
+    }
+    jobs = [ dict( job, subject=s ) for s in subjects ]
+    del mit
+
+    tic = time.time()
+    print '\n-> Fitting the subjects:'
+    sys.stdout.flush()
+    pool = multiprocessing.Pool( n_jobs, initializer=_init_worker, initargs=(shared,), maxtasksperchild=1 )
+    try :
+        reports = []
+        for r in pool.imap( _fit_subject, jobs ) :
+            reports.append( r )
+            print '\t* %-30s %-6s [ %.1f seconds ]' % ( r['subject'], r['status'], r['timings']['total'] )
+            sys.stdout.flush()
+        pool.close()
+    except :
+        pool.terminate()
+        raise
+    finally :
+        pool.join()
+
+    failed = [ r for r in reports if r['status'] != 'ok' ]
+    if failed :
+        print '\t* %d subject(s) failed:' % len(failed)
+        for r in failed :
+            print '\t\t- %s: %s' % ( r['subject'], r['error'].strip().splitlines()[-1] )
+    print '   [ %.1f seconds ]' % ( time.time() - tic )
+    return reports
@@ -11,12 +11,13 @@ from os import makedirs, remove
 from os.path import exists, join as pjoin
 import nibabel
 import cPickle
+import hashlib
 import commit.models
 import commit.solvers
 import amico.scheme
 import amico.lut
-import pyximport
-pyximport.install( reload_support=True )
+import commit.operator.operator
+from commit.operator.operator import LinearOperator
 
 
 def setup( lmax = 12 ) :
@@ -24,6 +25,152 @@ def setup( lmax = 12 ) :
     amico.lut.precompute_rotation_matrices( lmax )
 
 
+def space_filling_curve( ix, iy, iz, curve = 'hilbert' ) :
+    """Compute the position of some voxels along a space-filling curve, so that voxels
+    close in the 3D space are given close indices.
+
+    Parameters
+    ----------
+    ix, iy, iz : np.array
+        Integer coordinates of the voxels
+    curve : string
+        Either 'hilbert' or 'morton', i.e. Z-order (default : 'hilbert')
+
+    Returns
+    -------
+    np.array (int64) with the index of each voxel along the curve
+    """
+    if curve not in ['hilbert', 'morton'] :
+        raise ValueError( 'curve must be either "hilbert" or "morton"' )
+    X = [ np.asarray(c).astype(np.int64) for c in (ix, iy, iz) ]
+    nbits = max( 1, int( max( [c.max() for c in X if c.size > 0] + [0] ) ).bit_length() )
+
+    if curve == 'hilbert' :
+        # convert the coordinates to the "transposed" Hilbert index (J. Skilling, AIP Conf. Proc. 707, 2004)
+        Q = 1 << (nbits-1)
+        while Q > 1 :
+            P = Q - 1
+            for i in xrange(3) :
+                m = ( X[i] & Q ) != 0
+                t = np.where( m, 0, ( X[0] ^ X[i] ) & P )
+                X[0] = X[0] ^ np.where( m, P, t )
+                if i > 0 :
+                    X[i] = X[i] ^ t
+            Q >>= 1
+        for i in xrange(1,3) :
+            X[i] = X[i] ^ X[i-1]
+        t = np.zeros_like( X[0] )
+        Q = 1 << (nbits-1)
+        while Q > 1 :
+            t ^= np.where( ( X[2] & Q ) != 0, Q-1, 0 )
+            Q >>= 1
+        for i in xrange(3) :
+            X[i] = X[i] ^ t
+
+    # interleave the bits of the three coordinates
+    key = np.zeros( X[0].shape, dtype=np.int64 )
+    for b in xrange(nbits-1,-1,-1) :
+        for c in X :
+            key = ( key << 1 ) | ( ( c >> b ) & 1 )
+    return key
+
+
+def split_workload( DICTIONARY, KERNELS, n, nolut = False ) :
+    """Split the products with A and A' among n threads so that all the threads have
+    the same estimated cost. The cost of a segment or voxel is the number of flops of its
+    contribution, i.e. nS times the number of compartments (IC, EC or ISO), or 1 for the
+    models without lookup-tables; the IC, EC and ISO parts of a thread are balanced together.
+
+    In the A product every thread writes a range of voxels, hence the split points are
+    voxels and each thread gets the IC, EC and ISO segments falling in its range. In the
+    A' product every thread writes a range of coefficients: the fibers (whose segments
+    are never split), the EC segments and the ISO voxels are concatenated and cut in n
+    parts of equal cost. Some threads may have nothing to do, e.g. with few voxels.
+
+    Returns
+    -------
+    THREADS : dict
+        Boundaries of the ranges of each thread (n+1 values) and the fiber-ordered copy of
+        the IC segments used by the A' product (see Evaluation.set_threads)
+    """
+    nV = DICTIONARY['nV']
+    nF = DICTIONARY['IC']['nF']
+    nE = DICTIONARY['EC']['nE']
+    if nolut :
+        wIC, wEC, wISO = float(KERNELS['wmr'].shape[0] > 0), 0.0, float(KERNELS['iso'].shape[0] > 0)
+    else :
+        # NB: the factor nS is the same for all the compartments
+        wIC, wEC, wISO = [ float(KERNELS[k].shape[0]) for k in ['wmr','wmh','iso'] ]
+
+    THREADS = {}
+    THREADS['n'] = n
+    targets = np.arange( 1, n ) / float(n)
+
+    # A operator: cut the voxels where the cumulative cost reaches the i-th quota
+    cost = np.zeros( nV, dtype=np.float64 )
+    if DICTIONARY['IC']['n'] > 0 :
+        cost += wIC * np.bincount( DICTIONARY['IC']['v'], minlength=nV )
+    if nE > 0 :
+        cost += wEC * np.bincount( DICTIONARY['EC']['v'], minlength=nV )
+    cost += wISO
+    cost = np.cumsum( cost )
+    b = np.zeros( n+1, dtype=np.int64 )
+    b[n] = nV
+    if nV > 0 and cost[nV-1] > 0 :
+        b[1:n] = np.minimum( np.searchsorted( cost, targets*cost[nV-1] ) + 1, nV )
+
+    THREADS['IC']  = np.searchsorted( DICTIONARY['IC']['v'], b ).astype(np.uint32) if DICTIONARY['IC']['n'] > 0 else None
+    THREADS['EC']  = np.searchsorted( DICTIONARY['EC']['v'], b ).astype(np.uint32) if nE > 0 else None
+    THREADS['ISO'] = np.searchsorted( DICTIONARY['ISO']['v'], b ).astype(np.uint32) if nV > 0 else None
+
+    # A' operator: fiber-ordered copy of the IC segments, so that each thread walks only its own range of fibers
+    if DICTIONARY['IC']['n'] > 0 :
+        idx = np.argsort( DICTIONARY['IC']['fiber'], kind='mergesort' )
+        THREADS['ICt_fiber'] = DICTIONARY['IC']['fiber'][ idx ]
+        THREADS['ICt_v']     = DICTIONARY['IC']['v'][ idx ]
+        THREADS['ICt_o']     = DICTIONARY['IC']['o'][ idx ]
+        THREADS['ICt_len']   = DICTIONARY['IC']['len'][ idx ]
+        del idx
+        seg = np.bincount( THREADS['ICt_fiber'], minlength=nF )
+    else :
+        THREADS['ICt_fiber'] = THREADS['ICt_v'] = THREADS['ICt_o'] = THREADS['ICt_len'] = None
+        seg = np.zeros( nF, dtype=np.int64 )
+
+    # cut the sequence fibers, EC segments, ISO voxels in parts of equal cost
+    cost = np.cumsum( np.concatenate( ( wIC*seg, np.repeat( wEC, nE ), np.repeat( wISO, nV ) ) ) )
+    b = np.zeros( n+1, dtype=np.int64 )
+    b[n] = cost.size
+    if cost.size > 0 and cost[cost.size-1] > 0 :
+        b[1:n] = np.minimum( np.searchsorted( cost, targets*cost[cost.size-1] ) + 1, cost.size )
+    C = np.concatenate( ( [0], np.cumsum( seg ) ) )
+    THREADS['ICt']  = C[ np.clip( b, 0, nF ) ].astype(np.uint32) if DICTIONARY['IC']['n'] > 0 else None
+    THREADS['ECt']  = np.clip( b-nF, 0, nE ).astype(np.uint32) if nE > 0 else None
+    THREADS['ISOt'] = np.clip( b-nF-nE, 0, nV ).astype(np.uint32) if nV > 0 else None
+
+    return THREADS
+
+
+def _update_hash( h, v ) :
+    """Add the value v of a field of the regularisation to the hash h. Arrays are hashed by
+    content, and the object arrays and lists (e.g. the groups of structureIC) element by
+    element, as the data of an object array are pointers that differ in every process; the
+    integer sequences are converted to int64, so that the same groups give the same hash.
+    """
+    if isinstance( v, np.ndarray ) and v.dtype != object :
+        h.update( '%s%s' % ( v.dtype.str, v.shape ) )
+        h.update( np.ascontiguousarray( v ).data )
+    elif isinstance( v, (list, tuple) ) or ( isinstance( v, np.ndarray ) and v.ndim > 0 ) :
+        h.update( '[%d]' % len(v) )
+        for g in v :
+            if isinstance( g, (np.ndarray, list, tuple) ) :
+                g = np.asarray( g )
+                if g.dtype.kind in 'iub' :
+                    g = np.ascontiguousarray( g, dtype=np.int64 )
+            _update_hash( h, g )
+    else :
+        h.update( repr( v ) )
+
+
 cdef class Evaluation :
     """Class to hold all the information (data and parameters) when performing an
     evaluation with the COMMIT framework.
@@ -69,6 +216,7 @@ cdef class Evaluation :
         self.set_config('doNormalizeKernels', True)
         self.set_config('doDemean', False)
         self.set_config('doNormalizeMaps', False)
+        self.set_config('doCompactKernels', True)
 
 
 
@@ -296,10 +444,13 @@ cdef class Evaluation :
 
             print '[ OK ]'
 
+        if self.DICTIONARY is not None :
+            self.compact_kernels()
+
         print '   [ %.1f seconds ]' % ( time.time() - tic )
 
 
-    cpdef load_dictionary( self, path, use_mask = False ) :
+    cpdef load_dictionary( self, path, use_mask = False, voxel_order = None, sort_fibers = False ) :
         """Load the sparse structure previously created with "trk2dictionary" script.
 
         Parameters
@@ -312,9 +463,20 @@ cdef class Evaluation :
             (i.e. "filename_mask" paramater) will be used instead.
             NB: if no mask was specified in trk2dictionary, the "tdi" and
             "mask" masks are equivalent and this parameter is not influent.
+        voxel_order : string
+            Order in which the voxels of the mask are numbered, i.e. the order of the rows of A:
+            None for the column-major order of the image (default), 'hilbert' or 'morton' to
+            follow a space-filling curve, so that neighbouring voxels are also close in memory
+        sort_fibers : boolean
+            If True, the fibers (i.e. the IC columns of A) are sorted by the position of their
+            centroid along the same curve (default : False). The original index of each fiber
+            is stored in DICTIONARY['TRK']['perm'] and the coefficients saved by
+            "save_results()" are always given in the order of the input tractogram.
         """
         if self.niiDWI is None :
             raise RuntimeError( 'Data not loaded; call "load_data()" first.' )
+        if voxel_order not in [None, 'hilbert', 'morton'] :
+            raise ValueError( 'voxel_order must be one of None, "hilbert" or "morton"' )
 
         tic = time.time()
         print '\n-> Loading the dictionary:'
@@ -428,162 +590,225 @@ cdef class Evaluation :
 
         print '         [ OK ]'
 
+        self.set_config('voxel_order', voxel_order)
+        self.set_config('sort_fibers', sort_fibers)
+        if voxel_order is not None or sort_fibers :
+            self.reorder_dictionary( 'hilbert' if voxel_order is None else voxel_order, voxel_order is not None, sort_fibers )
+
+        if self.KERNELS is not None :
+            self.compact_kernels()
+
         print '   [ %.1f seconds ]' % ( time.time() - tic )
 
 
+    def reorder_dictionary( self, curve, reorder_voxels = True, reorder_fibers = False ) :
+        """Renumber the voxels and/or the fibers of the dictionary along a space-filling curve
+        (see "space_filling_curve()") to improve the locality of the memory accesses in the
+        products with A and A'. It is called by "load_dictionary()" (see its parameters).
+        The voxels are renumbered by reordering the MASK_ix/iy/iz indices, hence "get_y()" and
+        the maps saved by "save_results()" are assembled consistently; the fibers by permuting
+        the "fiber" field of the IC segments, with DICTIONARY['TRK']['perm'] mapping them back.
+        """
+        if self.DICTIONARY is None :
+            raise RuntimeError( 'Dictionary not loaded; call "load_dictionary()" first.' )
+
+        print '\t* reordering along %s curve...' % curve,
+        sys.stdout.flush()
+
+        key = space_filling_curve( self.DICTIONARY['MASK_ix'], self.DICTIONARY['MASK_iy'], self.DICTIONARY['MASK_iz'], curve )
+
+        if reorder_voxels :
+            idx = np.argsort( key, kind='mergesort' )
+            lut = np.zeros( idx.size, dtype=np.uint32 )
+            lut[ idx ] = np.arange( idx.size, dtype=np.uint32 )
+            key = key[ idx ]
+            for k in ['MASK_ix','MASK_iy','MASK_iz'] :
+                self.DICTIONARY[k] = self.DICTIONARY[k][ idx ]
+            del idx
+
+            # renumber the voxels and sort again the segments based on the "v" field
+            self.DICTIONARY['IC']['v'] = lut[ self.DICTIONARY['IC']['v'] ]
+            idx = np.argsort( self.DICTIONARY['IC']['v'], kind='mergesort' )
+            for k in ['v','o','fiber','len'] :
+                self.DICTIONARY['IC'][k] = self.DICTIONARY['IC'][k][ idx ]
+            self.DICTIONARY['EC']['v'] = lut[ self.DICTIONARY['EC']['v'] ]
+            idx = np.argsort( self.DICTIONARY['EC']['v'], kind='mergesort' )
+            for k in ['v','o'] :
+                self.DICTIONARY['EC'][k] = self.DICTIONARY['EC'][k][ idx ]
+            self.DICTIONARY['ISO']['v'] = np.sort( lut[ self.DICTIONARY['ISO']['v'] ] ).astype( self.DICTIONARY['ISO']['v'].dtype )
+            del idx, lut
+
+        if reorder_fibers and self.DICTIONARY['IC']['n'] > 0 :
+            # position of the (length-weighted) centroid of each fiber along the curve
+            nF = self.DICTIONARY['IC']['nF']
+            v  = self.DICTIONARY['IC']['v']
+            f  = self.DICTIONARY['IC']['fiber']
+            w  = self.DICTIONARY['IC']['len'].astype(np.float64)
+            tot = np.bincount( f, weights=w, minlength=nF )
+            tot[ tot == 0 ] = 1
+            c = [ np.rint( np.bincount( f, weights=w*self.DICTIONARY[k][v], minlength=nF ) / tot ) for k in ['MASK_ix','MASK_iy','MASK_iz'] ]
+            perm = np.argsort( space_filling_curve( c[0], c[1], c[2], curve ), kind='mergesort' ).astype(np.uint32)
+            inv = np.zeros( nF, dtype=np.uint32 )
+            inv[ perm ] = np.arange( nF, dtype=np.uint32 )
+            self.DICTIONARY['IC']['fiber'] = inv[ f ]
+            for k in ['norm','len'] :
+                self.DICTIONARY['TRK'][k] = self.DICTIONARY['TRK'][k][ perm ]
+            if 'perm' in self.DICTIONARY['TRK'] :
+                perm = self.DICTIONARY['TRK']['perm'][ perm ]
+            self.DICTIONARY['TRK']['perm'] = perm
+            del c, tot, w, inv
+
+        print '[ OK ]'
+
+
+    def fibers_to_input_order( self, x ) :
+        """Return a copy of x (a vector of coefficients or an array with one vector per
+        column) with the IC coefficients in the order of the fibers of the input tractogram,
+        undoing the reordering of the fibers performed by "load_dictionary()" (if any).
+        """
+        x = np.array( x )
+        perm = self.DICTIONARY['TRK'].get('perm')
+        if perm is None :
+            return x
+        nF = self.DICTIONARY['IC']['nF']
+        for k in xrange(self.KERNELS['wmr'].shape[0]) :
+            x[ k*nF + perm.astype(np.int64) ] = x[ k*nF : (k+1)*nF ].copy()
+        return x
+
+
+    def compact_kernels( self ) :
+        """Keep in the lookup-tables only the orientations used by the dictionary.
+
+        The 181x181 orientations of the IC and EC lookup-tables are replaced by the unique
+        values of DICTIONARY['IC']['o'] and DICTIONARY['EC']['o'], which are remapped to the
+        rows of the compacted tables; the original orientations are stored in the 'LUT_o'
+        field of both KERNELS and DICTIONARY. This step is performed automatically once both
+        the kernels and the dictionary are loaded (set "doCompactKernels" to False to disable
+        it) and it is transparent to the linear operator.
+        """
+        if self.KERNELS is None or self.DICTIONARY is None :
+            raise RuntimeError( 'Call "load_kernels()" and "load_dictionary()" first.' )
+
+        # original orientations of the segments
+        nIC = self.DICTIONARY['IC']['o'].size
+        o = np.concatenate( ( self.DICTIONARY['IC']['o'], self.DICTIONARY['EC']['o'] ) )
+        if 'LUT_o' in self.DICTIONARY :
+            o = self.DICTIONARY['LUT_o'][ o ]
+            del self.DICTIONARY['LUT_o']
+
+        if 'LUT_o' in self.KERNELS :
+            # tables already compacted, e.g. the dictionary has been loaded again
+            LUT_o = self.KERNELS['LUT_o']
+            idx = np.searchsorted( LUT_o, o )
+            if np.any( LUT_o[ np.minimum( idx, LUT_o.size-1 ) ] != o ) :
+                raise RuntimeError( 'Lookup-tables compacted for another dictionary; call "load_kernels()" again.' )
+        elif self.get_config('doCompactKernels') and self.KERNELS['wmr'].ndim == 4 :
+            print '\t* compacting lookup-tables...',
+            sys.stdout.flush()
+            LUT_o, idx = np.unique( o, return_inverse=True )
+            nbytes = 0
+            for key in ['wmr','wmh'] :
+                K = self.KERNELS[key]
+                nbytes += K.nbytes
+                K = K.reshape( (K.shape[0], K.shape[1]*K.shape[2], K.shape[3]) )[ :, LUT_o, : ]
+                self.KERNELS[key] = np.ascontiguousarray( K.reshape( (K.shape[0], 1, -1, K.shape[2]) ) )
+                nbytes -= self.KERNELS[key].nbytes
+            self.KERNELS['LUT_o'] = LUT_o.astype( np.uint16 )
+            print '[ %d orientations, %.1f MB saved ]' % ( LUT_o.size, nbytes / 1024.0**2 )
+        else :
+            # full tables
+            idx = o
+
+        ICo = self.DICTIONARY['IC']['o']
+        self.DICTIONARY['IC']['o'] = idx[ :nIC ].astype( np.uint16 )
+        self.DICTIONARY['EC']['o'] = idx[ nIC: ].astype( np.uint16 )
+
+        # keep the fiber-ordered copy used for the A' product in sync
+        if self.THREADS is not None and self.THREADS.get('ICt_o') is not None and nIC > 0 :
+            remap = np.zeros( int(ICo.max())+1, dtype=np.uint16 )
+            remap[ ICo ] = self.DICTIONARY['IC']['o']
+            self.THREADS['ICt_o'] = remap[ self.THREADS['ICt_o'] ]
+        if 'LUT_o' in self.KERNELS :
+            self.DICTIONARY['LUT_o'] = self.KERNELS['LUT_o']
+
+
     def set_threads( self, n = None ) :
         """Set the number of threads to use for the matrix-vector operations with A and A'.
+        The workload is split so that each thread gets the same estimated cost, given by
+        the number of segments/voxels times the number of compartments and samples, with
+        the IC, EC and ISO contributions of a thread considered together.
+        NB: for the A' product a fiber-ordered copy of the IC segments is stored in self.THREADS,
+            hence this function must be called again if self.DICTIONARY is changed.
 
         Parameters
         ----------
-        n : integer
-            Number of threads to use (default : number of CPUs in the system)
+        n : integer or string
+            Number of threads to use (default : number of CPUs in the system). If 'auto',
+            a few products with A and A' are timed for an increasing number of threads (up
+            to the number of CPUs) and the fastest one is retained
         """
+        try :
+            import multiprocessing
+            n_cpu = multiprocessing.cpu_count()
+        except :
+            n_cpu = 1
         if n is None :
             # Set to the number of CPUs in the system
-            try :
-                import multiprocessing
-                n = multiprocessing.cpu_count()
-            except :
-                n = 1
+            n = n_cpu
 
-        if n < 1 or n > 255 :
+        if n != 'auto' and ( n < 1 or n > 255 ) :
             raise RuntimeError( 'Number of threads must be between 1 and 255' )
         if self.DICTIONARY is None :
             raise RuntimeError( 'Dictionary not loaded; call "load_dictionary()" first.' )
         if self.KERNELS is None :
             raise RuntimeError( 'Response functions not generated; call "generate_kernels()" and "load_kernels()" first.' )
 
-        self.THREADS = {}
-        self.THREADS['n'] = n
-
-        cdef :
-            long [:] C
-            long t, tot, i1, i2, N, c
-            int i
-
         tic = time.time()
         print '\n-> Distributing workload to different threads:'
-        print '\t* number of threads : %d' % n
-
-        # Distribute load for the computation of A*x product
-        print '\t* A operator...',
-        sys.stdout.flush()
-
-        if self.DICTIONARY['IC']['n'] > 0 :
-            self.THREADS['IC'] = np.zeros( n+1, dtype=np.uint32 )
-            if n > 1 :
-                N = np.floor( self.DICTIONARY['IC']['n']/n )
-                t = 1
-                tot = 0
-                C = np.bincount( self.DICTIONARY['IC']['v'] )
-                for c in C :
-                    tot += c
-                    if tot >= N :
-                        self.THREADS['IC'][t] = self.THREADS['IC'][t-1] + tot
-                        t += 1
-                        tot = 0
-            self.THREADS['IC'][n] = self.DICTIONARY['IC']['n']
-
-            # check if some threads are not assigned any segment
-            if np.count_nonzero( np.diff( self.THREADS['IC'].astype(np.int32) ) <= 0 ) :
-                self.THREADS = None
-                raise RuntimeError( 'Too many threads for the IC compartments to evaluate; try decreasing the number.' )
-        else :
-            self.THREADS['IC'] = None
-
-        if self.DICTIONARY['EC']['nE'] > 0 :
-            self.THREADS['EC'] = np.zeros( n+1, dtype=np.uint32 )
-            for i in xrange(n) :
-                self.THREADS['EC'][i] = np.searchsorted( self.DICTIONARY['EC']['v'], self.DICTIONARY['IC']['v'][ self.THREADS['IC'][i] ] )
-            self.THREADS['EC'][n] = self.DICTIONARY['EC']['nE']
-
-            # check if some threads are not assigned any segment
-            if np.count_nonzero( np.diff( self.THREADS['EC'].astype(np.int32) ) <= 0 ) :
-                self.THREADS = None
-                raise RuntimeError( 'Too many threads for the EC compartments to evaluate; try decreasing the number.' )
-        else :
-            self.THREADS['EC'] = None
-
-        if self.DICTIONARY['nV'] > 0 :
-            self.THREADS['ISO'] = np.zeros( n+1, dtype=np.uint32 )
-            for i in xrange(n) :
-                self.THREADS['ISO'][i] = np.searchsorted( self.DICTIONARY['ISO']['v'], self.DICTIONARY['IC']['v'][ self.THREADS['IC'][i] ] )
-            self.THREADS['ISO'][n] = self.DICTIONARY['nV']
-
-            # check if some threads are not assigned any segment
-            if np.count_nonzero( np.diff( self.THREADS['ISO'].astype(np.int32) ) <= 0 ) :
-                self.THREADS = None
-                raise RuntimeError( 'Too many threads for the ISO compartments to evaluate; try decreasing the number.' )
-        else :
-            self.THREADS['ISO'] = None
 
-        print ' [ OK ]'
+        nolut = self.model is not None and self.model.id=='VolumeFractions'
+        if n == 'auto' :
+            print '\t* timing A*x + A\'*y :'
+            candidates = sorted( set( [ min(2**i,255) for i in xrange(9) if 2**i < n_cpu ] + [ min(n_cpu,255) ] ) )
+            best = None
+            for c in candidates :
+                self.THREADS = split_workload( self.DICTIONARY, self.KERNELS, c, nolut )
+                A = LinearOperator( self.DICTIONARY, self.KERNELS, self.THREADS, nolut = nolut )
+                t = commit.operator.operator.time_products( A )
+                A.close()
+                del A
+                print '\t\t- %3d threads : %.1f ms' % ( c, 1e3*t )
+                if best is None or t < best[1] :
+                    best = ( c, t )
+            n = best[0]
 
-        # Distribute load for the computation of At*y product
-        print '\t* A\' operator...',
+        print '\t* number of threads : %d' % n
         sys.stdout.flush()
-
-        if self.DICTIONARY['IC']['n'] > 0 :
-            self.THREADS['ICt'] = np.full( self.DICTIONARY['IC']['n'], n-1, dtype=np.uint8 )
-            if n > 1 :
-                idx = np.argsort( self.DICTIONARY['IC']['fiber'], kind='mergesort' )
-                C = np.bincount( self.DICTIONARY['IC']['fiber'] )
-                t = tot = i1 = i2 = 0
-                N = np.floor(self.DICTIONARY['IC']['n']/n)
-                for c in C :
-                    i2 += c
-                    tot += c
-                    if tot >= N :
-                        self.THREADS['ICt'][ i1:i2 ] = t
-                        t += 1
-                        if t==n-1 :
-                            break
-                        i1 = i2
-                        tot = c
-                self.THREADS['ICt'][idx] = self.THREADS['ICt'].copy()
-
-        else :
-            self.THREADS['ICt'] = None
-
-        if self.DICTIONARY['EC']['nE'] > 0 :
-            self.THREADS['ECt'] = np.zeros( n+1, dtype=np.uint32 )
-            N = np.floor( self.DICTIONARY['EC']['nE']/n )
-            for i in xrange(1,n) :
-                self.THREADS['ECt'][i] = self.THREADS['ECt'][i-1] + N
-            self.THREADS['ECt'][n] = self.DICTIONARY['EC']['nE']
-
-            # check if some threads are not assigned any segment
-            if np.count_nonzero( np.diff( self.THREADS['ECt'].astype(np.int32) ) <= 0 ) :
-                self.THREADS = None
-                raise RuntimeError( 'Too many threads for the EC compartments to evaluate; try decreasing the number.' )
-        else :
-            self.THREADS['ECt'] = None
-
-        if self.DICTIONARY['nV'] > 0 :
-            self.THREADS['ISOt'] = np.zeros( n+1, dtype=np.uint32 )
-            N = np.floor( self.DICTIONARY['nV']/n )
-            for i in xrange(1,n) :
-                self.THREADS['ISOt'][i] = self.THREADS['ISOt'][i-1] + N
-            self.THREADS['ISOt'][n] = self.DICTIONARY['nV']
-
-            # check if some threads are not assigned any segment
-            if np.count_nonzero( np.diff( self.THREADS['ISOt'].astype(np.int32) ) <= 0 ) :
-                self.THREADS = None
-                raise RuntimeError( 'Too many threads for the ISO compartments to evaluate; try decreasing the number.' )
-        else :
-            self.THREADS['ISOt'] = None
-
-        print '[ OK ]'
+        self.THREADS = split_workload( self.DICTIONARY, self.KERNELS, n, nolut )
 
         print '   [ %.1f seconds ]' % ( time.time() - tic )
 
 
-    def build_operator( self ) :
-        """Compile/build the operator for computing the matrix-vector multiplications by A and A'
+    def build_operator( self, backend = 'lut', max_sparse_memory = 4.0 ) :
+        """Build the operator for computing the matrix-vector multiplications by A and A'
         using the informations from self.DICTIONARY, self.KERNELS and self.THREADS.
+        The C code is compiled once at installation time and the number of compartments
+        and threads are passed at runtime, so no compilation is needed here.
         NB: needs to call this function to update pointers to data structures in case
             the data is changed in self.DICTIONARY, self.KERNELS or self.THREADS.
+
+        Parameters
+        ----------
+        backend : string
+            How the products are computed (default : 'lut'):
+            'lut'    : on the fly, using the lookup-tables of the kernels
+            'sparse' : with an explicit sparse matrix built from the dictionary and the
+                       kernels; it is cached in the tracking folder and reused as long
+                       as the data does not change
+            'auto'   : time both and keep the fastest; 'lut' is used if the sparse
+                       matrix would need more than max_sparse_memory
+        max_sparse_memory : float
+            Maximum memory (in GB) that the sparse matrix can use with 'auto' (default : 4.0)
         """
         if self.DICTIONARY is None :
             raise RuntimeError( 'Dictionary not loaded; call "load_dictionary()" first.' )
@@ -591,25 +816,121 @@ cdef class Evaluation :
             raise RuntimeError( 'Response functions not generated; call "generate_kernels()" and "load_kernels()" first.' )
         if self.THREADS is None :
             raise RuntimeError( 'Threads not set; call "set_threads()" first.' )
+        if backend not in ['lut', 'sparse', 'auto'] :
+            raise ValueError( 'backend must be one of "lut", "sparse" or "auto"' )
 
         tic = time.time()
         print '\n-> Building linear operator A:'
 
-        # need to pass these parameters at runtime for compiling the C code
-        from commit.operator import config
-        config.nTHREADS = self.THREADS['n']
-        config.model    = self.model.id
-        config.nIC      = self.KERNELS['wmr'].shape[0]
-        config.nEC      = self.KERNELS['wmh'].shape[0]
-        config.nISO     = self.KERNELS['iso'].shape[0]
-        if not 'commit.operator.operator' in sys.modules :
-            import commit.operator.operator
+        # terminate the workers of the previous operator (if any)
+        if self.A is not None :
+            self.A.close()
+            self.A = None
+
+        nolut = self.model.id=='VolumeFractions'
+        A_lut = A_sparse = None
+        if backend in ['lut', 'auto'] :
+            A_lut = LinearOperator( self.DICTIONARY, self.KERNELS, self.THREADS, nolut = nolut )
+
+        if backend == 'auto' :
+            size = commit.operator.operator.estimate_sparse_size( self.DICTIONARY, self.KERNELS, nolut ) / 1024.0**3
+            if size > max_sparse_memory :
+                print '\t* sparse matrix would need up to %.1f GB, using the lookup-tables' % size
+                backend = 'lut'
+
+        if backend in ['sparse', 'auto'] :
+            A_sparse = commit.operator.operator.SparseOperator( self.load_sparse( nolut ), self.THREADS['n'], None if A_lut is None else A_lut.pool )
+
+        if backend == 'auto' :
+            t_lut    = commit.operator.operator.time_products( A_lut )
+            t_sparse = commit.operator.operator.time_products( A_sparse )
+            print '\t* time of A*x + A\'*y : %.1f ms (lookup-tables), %.1f ms (sparse)' % ( 1e3*t_lut, 1e3*t_sparse )
+            backend = 'sparse' if t_sparse < t_lut else 'lut'
+
+        if backend == 'sparse' :
+            self.A = A_sparse
         else :
-            reload( sys.modules['commit.operator.operator'] )
-        self.A = sys.modules['commit.operator.operator'].LinearOperator( self.DICTIONARY, self.KERNELS, self.THREADS )
+            self.A = A_lut
+        self.set_config('operator_backend', backend)
+        print '\t* backend : %s' % backend
 
         print '   [ %.1f seconds ]' % ( time.time() - tic )
 
+
+    def load_sparse( self, nolut = False ) :
+        """Return the explicit sparse matrix of A (see commit.operator.operator.build_sparse).
+        The matrix is stored in the tracking folder in a file named after a hash of the
+        dictionary and kernels, so it is built only the first time or when they change.
+        """
+        signature = commit.operator.operator.sparse_signature( self.DICTIONARY, self.KERNELS, nolut )
+        filename = None
+        if self.get_config('TRACKING_path') is not None :
+            filename = pjoin( self.get_config('TRACKING_path'), 'A_sparse_%s.npz' % signature )
+
+        if filename is not None and exists( filename ) :
+            print '\t* loading sparse matrix from "%s"' % filename
+            with np.load( filename ) as data :
+                SPARSE = { k : data[k] for k in data.files }
+        else :
+            print '\t* building sparse matrix...',
+            sys.stdout.flush()
+            SPARSE = commit.operator.operator.build_sparse( self.DICTIONARY, self.KERNELS, nolut )
+            print '[ %d non-zeros ]' % SPARSE['idx'].size
+            if filename is not None :
+                np.savez( filename, **SPARSE )
+        return SPARSE
+
+    def estimate_lipschitz( self, tol = 1e-3 ) :
+        """Return the Lipschitz constant of the gradient of the data term, i.e. ||A||^2,
+        estimated with commit.solvers.estimate_lipschitz(). The value is stored in the
+        tracking folder in a file named after a hash of the dictionary, the kernels and
+        the normalization flags, so repeated fits of the same data reuse it as long as it
+        was estimated with a tolerance not larger than tol.
+
+        Parameters
+        ----------
+        tol : float
+            Relative tolerance of the estimate (default : 1e-3)
+        """
+        if self.A is None :
+            raise RuntimeError( 'Operator not built; call "build_operator()" first.' )
+
+        signature = self._operator_signature()
+        filename = None
+        if self.get_config('TRACKING_path') is not None :
+            filename = pjoin( self.get_config('TRACKING_path'), 'A_lipschitz_%s.txt' % signature )
+
+        if filename is not None and exists( filename ) :
+            L, L_tol = np.loadtxt( filename )
+            if L_tol <= tol :
+                print '\t* Lipschitz constant : %.6e (cached)' % L
+                return L
+
+        print '\t* Lipschitz constant :',
+        sys.stdout.flush()
+        L, n_iter = commit.solvers.estimate_lipschitz( self.A, self.A.T, tol )
+        print '%.6e [ %d iterations ]' % ( L, n_iter )
+        if filename is not None :
+            np.savetxt( filename, [ L, tol ] )
+        return L
+
+    def _operator_signature( self ) :
+        """Hash of the dictionary, the kernels and the normalization flags that define A."""
+        nolut = self.model.id=='VolumeFractions'
+        signature = commit.operator.operator.sparse_signature( self.DICTIONARY, self.KERNELS, nolut )
+        flags = [ self.get_config(k) for k in ['doNormalizeKernels', 'doDemean', 'doMergeB0'] ]
+        return hashlib.md5( signature + str(flags) ).hexdigest()
+
+    def _problem_signature( self, y, regularisation ) :
+        """Hash of A, the data y and the regularisation, which identifies a checkpoint."""
+        h = hashlib.md5( self._operator_signature() )
+        h.update( str( y.dtype ) )
+        h.update( np.ascontiguousarray( y ).data )
+        for k in sorted( regularisation ) :
+            h.update( k )
+            _update_hash( h, regularisation[k] )
+        return h.hexdigest()
+
     def get_y( self ):
         """
         Returns a numpy array that corresponds to the 'y' vector of the optimisation problem.
@@ -621,7 +942,7 @@ cdef class Evaluation :
             raise RuntimeError( 'Data not loaded; call "load_data()" first.' )
         return self.niiDWI_img[ self.DICTIONARY['MASK_ix'], self.DICTIONARY['MASK_iy'], self.DICTIONARY['MASK_iz'], : ].flatten().astype(np.float64)
 
-    def fit( self, tol_fun = 1e-3, tol_x = 1e-6, max_iter = 100, verbose = 1, x0 = None, regularisation = None, save_x_suffix = None, save_x_interval = 0 ) :
+    def fit( self, tol_fun = 1e-3, tol_x = 1e-6, max_iter = 100, verbose = 1, x0 = None, regularisation = None, save_x_suffix = None, save_x_interval = 0, single_precision = False, lipschitz_tol = 1e-3, solver = 'fista', screen_interval = 0, restart = None, monotone = False, callback = None, checkpoint_interval = 0, resume = False ) :
         """Fit the model to the data.
 
         Parameters
@@ -633,12 +954,57 @@ cdef class Evaluation :
         verbose : integer
             Level of verbosity: 0=no print, 1=print progress (default : 1)
         x0 : np.array
-            Initial guess for the solution of the problem (default : None)
+            Initial guess for the solution of the problem, with the fibers in the same
+            order as self.x (default : None)
         regularisation : commit.solvers.init_regularisation object
             Python dictionary that describes the wanted regularisation term.
             Check the documentation of commit.solvers.init_regularisation to see
             how to properly define the wanted mathematical formulation
             ( default : None )
+        save_x_interval : integer
+            Save x every save_x_interval iterations in the file commit.history.FILENAME of the
+            folder "Coeff_x_*", which can be read with commit.history.HistoryReader; 0 saves
+            nothing (default : 0)
+        single_precision : boolean
+            Store the vectors used by the solver and perform the products with A and A'
+            in single precision, which halves their memory footprint; the norms and the
+            objective are still computed in double precision (default : False)
+        lipschitz_tol : float
+            Relative tolerance of the estimate of ||A||^2 that sets the step size of the
+            solver; it is cached for the following fits (see estimate_lipschitz). The step is
+            1/L, while it used to be 1.9 over a cruder estimate of L; as the penalty is applied
+            without scaling it by the step, fits with a regularisation give different
+            solutions than with the older step (default : 1e-3)
+        solver : string
+            Name of the algorithm in commit.solvers.SOLVERS: 'fista' (any regularisation) or
+            'lbfgs' (projected quasi-Newton, faster when all the compartments are only
+            constrained to be non-negative) (default : 'fista')
+        screen_interval : integer
+            With 'fista' and no regularisation, every screen_interval iterations the coefficients
+            proven to be zero at the solution are removed and the corresponding fibers are
+            skipped by the products with A and A'; 0 disables it. The test is safe but removes
+            columns only close to the solution, typically in the last iterations of a fit, and
+            each stage that removes some costs 4 products, hence it is a late-stage feature
+            that rarely reduces the total number of products (default : 0)
+        restart : string
+            With 'fista', reset the momentum when the objective increases ('function') or when
+            the step opposes the momentum ('gradient'), which avoids the oscillations near the
+            solution; None keeps the plain scheme (default : None)
+        monotone : boolean
+            With 'fista', reject the steps that increase the objective (default : False)
+        callback : callable
+            Function called at every iteration with a dictionary of timings, step size and
+            stopping metrics; commit.telemetry provides callbacks that keep these records or
+            write them to CSV or JSON lines files (default : None)
+        checkpoint_interval : integer
+            With 'fista', save the complete state of the solver every checkpoint_interval
+            iterations in the file "checkpoint.npz" of the folder "Coeff_x_*"; the file is
+            removed when the fit completes (default : 0)
+        resume : boolean
+            Continue the fit from the state saved by a previous call that was interrupted,
+            instead of starting from x0; the coefficients already saved are kept. The state
+            must have been saved for the same dictionary, kernels, data and regularisation,
+            otherwise an error is raised (default : False)
         """
         if self.niiDWI is None :
             raise RuntimeError( 'Data not loaded; call "load_data()" first.' )
@@ -660,11 +1026,11 @@ cdef class Evaluation :
         print '\n-> Saving coefficients x to "%s/*":' % COEFF_path
         tic = time.time()
 
-        # create folder or delete existing files (if any)
+        # create folder or delete existing files (if any); they are kept to resume a fit
         COEFF_path = pjoin( self.get_config('TRACKING_path'), COEFF_path )
         if not exists( COEFF_path ) :
             makedirs( COEFF_path )
-        else :
+        elif not resume :
             for f in glob.glob( pjoin(COEFF_path,'*') ) :
                 remove( f )
         self.set_config('COEFF_path', COEFF_path)
@@ -682,12 +1048,34 @@ cdef class Evaluation :
         self.CONFIG['optimization']['max_iter']       = max_iter
         self.CONFIG['optimization']['verbose']        = verbose
         self.CONFIG['optimization']['regularisation'] = regularisation
+        self.CONFIG['optimization']['single_precision'] = single_precision
+        self.CONFIG['optimization']['lipschitz_tol']  = lipschitz_tol
+        self.CONFIG['optimization']['solver']         = solver
+        self.CONFIG['optimization']['screen_interval'] = screen_interval
+        self.CONFIG['optimization']['restart']        = restart
+        self.CONFIG['optimization']['monotone']       = monotone
 
         # run solver
         t = time.time()
         print '\n-> Fit model'
 
-        self.x, opt_details = commit.solvers.solve(self.get_y(), self.A, self.A.T, tol_fun = tol_fun, tol_x = tol_x, max_iter = max_iter, verbose = verbose, x0 = x0, regularisation = regularisation, coeff_path = COEFF_path, save_x_interval = save_x_interval )
+        L = self.estimate_lipschitz( lipschitz_tol ) if solver == 'fista' else None
+        y = self.get_y()
+        if single_precision :
+            y = y.astype( np.float32 )
+            if x0 is not None :
+                x0 = x0.astype( np.float32 )
+
+        checkpoint = None
+        if checkpoint_interval > 0 or resume :
+            checkpoint = { 'filename' : pjoin( COEFF_path, 'checkpoint.npz' ), 'interval' : checkpoint_interval,
+                           'id' : self._problem_signature( y, regularisation ), 'resume' : resume }
+            if resume and not exists( checkpoint['filename'] ) :
+                print '\t* no checkpoint found in "%s"; starting from the beginning' % COEFF_path
+        self.CONFIG['optimization']['checkpoint_interval'] = checkpoint_interval
+        self.CONFIG['optimization']['resume'] = resume
+
+        self.x, opt_details = commit.solvers.solve(y, self.A, self.A.T, tol_fun = tol_fun, tol_x = tol_x, max_iter = max_iter, verbose = verbose, x0 = x0, regularisation = regularisation, coeff_path = COEFF_path, save_x_interval = save_x_interval, L = L, solver = solver, screen_interval = screen_interval, restart = restart, monotone = monotone, callback = callback, checkpoint = checkpoint )
 
         nF = self.DICTIONARY['IC']['nF']
         nE = self.DICTIONARY['EC']['nE']
@@ -706,6 +1094,9 @@ cdef class Evaluation :
                 np.save( COEFF_path + '/norm2.npy', norm2 )
                 np.save( COEFF_path + '/norm3.npy', norm3 )
                 np.save( COEFF_path + '/norm_fib.npy', norm_fib )
+        if save_x_interval > 0 and self.DICTIONARY['TRK'].get('perm') is not None :
+            # the saved coefficients follow the order of the fibers in the dictionary
+            np.save( COEFF_path + '/perm.npy', self.DICTIONARY['TRK']['perm'] )
 
         self.CONFIG['optimization']['fit_details'] = opt_details
         self.CONFIG['optimization']['fit_time'] = time.time()-t
@@ -713,6 +1104,80 @@ cdef class Evaluation :
         print '   [ %s ]' % ( time.strftime("%Hh %Mm %Ss", time.gmtime(self.CONFIG['optimization']['fit_time']) ) )
 
 
+    def fit_path( self, lambdas, regularisation = None, tol_fun = 1e-3, tol_x = 1e-6, max_iter = 100, verbose = 1, x0 = None, validation = None, patience = 1, single_precision = False, lipschitz_tol = 1e-3, solver = 'fista' ) :
+        """Fit the model for a sequence of regularisation parameters, from the largest to the
+        smallest, starting each fit from the previous solution and reusing the step size (see
+        commit.solvers.solve_path). No coefficients are written in the tracking folder; at the
+        end self.x is set to the solution with the best validation score (the last one if no
+        validation is given), so that "save_results()" can be used as after "fit()".
+
+        Parameters
+        ----------
+        lambdas : list
+            Regularisation parameters, each one a tuple (lambdaIC, lambdaEC, lambdaISO) or a
+            number used for all the compartments
+        regularisation : commit.solvers.init_regularisation object
+            Regularisation term, whose lambdas are replaced by those of the path (default : None,
+            i.e. the one returned by commit.solvers.init_regularisation with its defaults)
+        validation : function
+            Function returning a score (lower is better) of a solution x, e.g. the error on
+            held-out data; the path stops when it has not improved for "patience" consecutive
+            lambdas (default : None)
+        patience : integer
+            See "validation" (default : 1)
+        tol_fun, tol_x, max_iter, verbose, x0, single_precision, lipschitz_tol, solver :
+            See "fit()"
+
+        Returns
+        -------
+        X : np.array
+            Solutions, one column per lambda actually solved, with the fibers in the same
+            order as self.x
+        lambdas : np.array
+            The lambdas of the columns of X, one per row
+        scores : np.array
+            Validation score of each solution (NaN if validation is None)
+        """
+        if self.niiDWI is None :
+            raise RuntimeError( 'Data not loaded; call "load_data()" first.' )
+        if self.A is None :
+            raise RuntimeError( 'Operator not built; call "build_operator()" first.' )
+        if x0 is not None and x0.shape[0] != self.A.shape[1] :
+            raise RuntimeError( 'x0: dimension does not match the number of columns of the dictionary.' )
+        if regularisation is None :
+            regularisation = commit.solvers.init_regularisation(self)
+
+        t = time.time()
+        print '\n-> Fit model along the regularisation path'
+        L = self.estimate_lipschitz( lipschitz_tol ) if solver == 'fista' else None
+        y = self.get_y()
+        if single_precision :
+            y = y.astype( np.float32 )
+            if x0 is not None :
+                x0 = x0.astype( np.float32 )
+
+        X, lambdas, scores, details = commit.solvers.solve_path( y, self.A, self.A.T, regularisation, lambdas, tol_fun = tol_fun, tol_x = tol_x, max_iter = max_iter, verbose = verbose, x0 = x0, L = L, validation = validation, patience = patience, solver = solver )
+        best = int( np.nanargmin( scores ) ) if validation is not None else X.shape[X.ndim-1]-1
+        self.x = X[...,best].copy()
+
+        self.CONFIG['optimization']                   = {}
+        self.CONFIG['optimization']['tol_fun']        = tol_fun
+        self.CONFIG['optimization']['tol_x']          = tol_x
+        self.CONFIG['optimization']['max_iter']       = max_iter
+        self.CONFIG['optimization']['verbose']        = verbose
+        self.CONFIG['optimization']['regularisation'] = dict( regularisation, lambdaIC = lambdas[best,0], lambdaEC = lambdas[best,1], lambdaISO = lambdas[best,2] )
+        self.CONFIG['optimization']['single_precision'] = single_precision
+        self.CONFIG['optimization']['lipschitz_tol']  = lipschitz_tol
+        self.CONFIG['optimization']['solver']         = solver
+        self.CONFIG['optimization']['path_lambdas']   = lambdas
+        self.CONFIG['optimization']['path_scores']    = scores
+        self.CONFIG['optimization']['fit_details']    = details[best]
+        self.CONFIG['optimization']['fit_time']       = time.time()-t
+
+        print '   [ %d solutions, %s ]' % ( X.shape[X.ndim-1], time.strftime("%Hh %Mm %Ss", time.gmtime(self.CONFIG['optimization']['fit_time']) ) )
+        return X, lambdas, scores
+
+
     def save_results( self, path_suffix = None, save_opt_details = True, save_coeff = False, save_x_suffix = None ) :
         """Save the output (coefficients, errors, maps etc).
 
@@ -771,18 +1236,22 @@ cdef class Evaluation :
             x = self.x / np.hstack( (norm1*norm_fib,norm2,norm3) )
         else :
             x = self.x
+
+        # coefficients in the order of the input tractogram
+        x_in  = self.fibers_to_input_order( x )
+        x0_in = self.fibers_to_input_order( self.x )
         if save_opt_details:
             print '\t\t- pickle... ',
             sys.stdout.flush()
             with open( pjoin(RESULTS_path,'results.pickle'), 'wb+' ) as fid :
-                cPickle.dump( [self.CONFIG, self.x, x], fid, protocol=2 )
+                cPickle.dump( [self.CONFIG, x0_in, x_in], fid, protocol=2 )
             print '[ OK ]'
         if save_coeff:
             print '\t\t- txt... ',
             sys.stdout.flush()
-            np.savetxt(pjoin(RESULTS_path,'xic.txt'), x[0:nF])
-            np.savetxt(pjoin(RESULTS_path,'xec.txt'), x[nF:nF+nE])
-            np.savetxt(pjoin(RESULTS_path,'xiso.txt'), x[(nF+nE):])
+            np.savetxt(pjoin(RESULTS_path,'xic.txt'), x_in[0:nF])
+            np.savetxt(pjoin(RESULTS_path,'xec.txt'), x_in[nF:nF+nE])
+            np.savetxt(pjoin(RESULTS_path,'xiso.txt'), x_in[(nF+nE):])
             with open( pjoin(RESULTS_path,'config.pickle'), 'wb+' ) as fid :
                 cPickle.dump( self.CONFIG, fid, protocol=2 )
             print '[ OK ]'
@@ -876,6 +1345,6 @@ cdef class Evaluation :
         nibabel.save( niiISO , pjoin(RESULTS_path,'compartment_ISO.nii.gz') )
 
         with open( pjoin(RESULTS_path,'results.pickle'), 'wb+' ) as fid :
-            cPickle.dump( [self.CONFIG, self.x, x], fid, protocol=2 )
+            cPickle.dump( [self.CONFIG, x0_in, x_in], fid, protocol=2 )
 
         print '   [ %.1f seconds ]' % ( time.time() - tic )
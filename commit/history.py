@@ -0,0 +1,186 @@
+"""
+History of the coefficients x saved during a fit.
+
+The snapshots are stored in a single append-only file made of a header,
+which describes the snapshots, followed by fixed-size records, each holding
+the iteration number and the coefficients:
+
+    magic     : 8 bytes, b'COMMITXH'
+    size      : uint32, size in bytes of the JSON text that follows
+    JSON text : {"version", "dtype", "shape"} padded with spaces so that the
+                records start at a multiple of 64 bytes
+    records   : [ iteration (int64), x (dtype, shape) ] * number of snapshots
+
+The number of snapshots is given by the size of the file, hence a record
+is valid as soon as it is completely written and a fit that is interrupted
+leaves a readable file. The records are memory-mapped by HistoryReader, so
+that only the snapshots actually accessed are read from disk.
+"""
+from __future__ import print_function
+import json
+import os
+import struct
+import threading
+import numpy as np
+try :
+    import queue
+except ImportError :
+    import Queue as queue
+
+MAGIC     = b'COMMITXH'
+VERSION   = 1
+ALIGNMENT = 64
+FILENAME  = 'x_history.dat'
+
+
+def _record_dtype( dtype, shape ) :
+    return np.dtype( [ ('iteration', '<i8'), ('x', np.dtype(dtype).newbyteorder('<'), tuple(shape)) ] )
+
+
+class HistoryWriter :
+    """Append the snapshots of the coefficients to a history file.
+
+    The snapshots are copied and written by a background thread, hence
+    append() returns as soon as the copy is done and the solver never waits
+    for the disk. The file is complete once close() returns.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the history file; an existing file is overwritten
+    shape : tuple
+        Shape of the coefficients, e.g. (n,) or (n,k) for a block of problems
+    dtype : numpy dtype
+        Type of the coefficients (default : np.float64)
+    keep_until : integer
+        If given and the file exists, the snapshots up to this iteration are kept and
+        the new ones are appended after them, e.g. to continue an interrupted fit; the
+        file must hold coefficients of the same shape and type (default : None)
+    """
+
+    def __init__( self, filename, shape, dtype = np.float64, keep_until = None ) :
+        self.filename = filename
+        self.shape    = tuple( shape )
+        self.dtype    = np.dtype( dtype )
+        self.record   = _record_dtype( self.dtype, self.shape )
+        self.count    = 0
+        self.error    = None
+
+        if keep_until is not None and os.path.exists( filename ) :
+            old = HistoryReader( filename )
+            if old.shape != self.shape or old.dtype != self.dtype.newbyteorder('<') :
+                raise RuntimeError( '"%s" holds coefficients of a different shape or type' % filename )
+            self.count = int( np.searchsorted( old.iterations, keep_until, side='right' ) )
+            offset = old.offset
+            del old
+            self.file = open( filename, 'r+b' )
+            self.file.seek( offset + self.count * self.record.itemsize )
+            self.file.truncate()
+        else :
+            self.file = open( filename, 'wb' )
+            self.file.write( self._header() )
+
+        self.queue  = queue.Queue()
+        self.thread = threading.Thread( target=self._write )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _header( self ) :
+        header = json.dumps( { 'version' : VERSION, 'dtype' : self.dtype.newbyteorder('<').str, 'shape' : list(self.shape) } ).encode( 'ascii' )
+        size = len(MAGIC) + 4 + len(header)
+        header += b' ' * ( -size % ALIGNMENT )
+        return MAGIC + struct.pack( '<I', len(header) ) + header
+
+    def _write( self ) :
+        while True :
+            rec = self.queue.get()
+            if rec is None :
+                break
+            try :
+                if self.error is None :
+                    self.file.write( rec.tobytes() )
+                    self.file.flush()
+            except Exception as e :
+                self.error = e
+
+    def append( self, iteration, x ) :
+        """Queue a snapshot of x, taken at the given iteration, for writing."""
+        if self.error is not None :
+            raise RuntimeError( 'Unable to write "%s": %s' % ( self.filename, self.error ) )
+        rec = np.empty( 1, dtype=self.record )
+        rec['iteration'] = iteration
+        rec['x'] = np.asarray( x ).reshape( self.shape )
+        self.queue.put( rec )
+        self.count += 1
+
+    def close( self ) :
+        """Wait until all the snapshots are written and close the file."""
+        if self.file is None :
+            return
+        self.queue.put( None )
+        self.thread.join()
+        self.file.close()
+        self.file = None
+        if self.error is not None :
+            raise RuntimeError( 'Unable to write "%s": %s' % ( self.filename, self.error ) )
+
+    def __enter__( self ) :
+        return self
+
+    def __exit__( self, *args ) :
+        self.close()
+
+
+class HistoryReader :
+    """Lazy access to the snapshots of a history file.
+
+    The records are memory-mapped: indexing the reader returns the snapshot
+    at the given position as a read-only view, and only the pages it spans
+    are read from disk.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the history file
+    """
+
+    def __init__( self, filename ) :
+        self.filename = filename
+        with open( filename, 'rb' ) as f :
+            if f.read( len(MAGIC) ) != MAGIC :
+                raise RuntimeError( '"%s" is not a history file' % filename )
+            size = struct.unpack( '<I', f.read(4) )[0]
+            header = json.loads( f.read( size ).decode( 'ascii' ) )
+        if header['version'] > VERSION :
+            raise RuntimeError( 'Version %d of the history file not supported' % header['version'] )
+        self.dtype  = np.dtype( header['dtype'] )
+        self.shape  = tuple( header['shape'] )
+        self.record = _record_dtype( self.dtype, self.shape )
+        self.offset = len(MAGIC) + 4 + size
+        n = ( os.path.getsize( filename ) - self.offset ) // self.record.itemsize # a partial record is ignored
+        if n > 0 :
+            self.records = np.memmap( filename, dtype=self.record, mode='r', offset=self.offset, shape=(n,) )
+        else :
+            self.records = np.empty( 0, dtype=self.record )
+
+    def __len__( self ) :
+        return self.records.shape[0]
+
+    def __getitem__( self, i ) :
+        return self.records['x'][i]
+
+    @property
+    def iterations( self ) :
+        """Iteration numbers of the snapshots."""
+        return np.array( self.records['iteration'] )
+
+    def get( self, iteration ) :
+        """Snapshot taken at the given iteration."""
+        idx = np.flatnonzero( self.records['iteration'] == iteration )
+        if idx.size == 0 :
+            raise RuntimeError( 'Iteration %d not in "%s"' % ( iteration, self.filename ) )
+        return self[ idx[0] ]
+
+    def __iter__( self ) :
+        for i in range( len(self) ) :
+            yield self[i]
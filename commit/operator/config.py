@@ -1,5 +0,0 @@
-nTHREADS = None
-model    = None
-nIC      = None
-nEC      = None
-nISO     = None
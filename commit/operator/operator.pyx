@@ -4,41 +4,242 @@
 import cython
 import numpy as np
 cimport numpy as np
+import hashlib
+import time
+
+# Interfaces to the persistent pool of workers used by the C code
+cdef extern from "operator_pool.h" :
+    ctypedef struct COMMIT_pool :
+        pass
+    COMMIT_pool* COMMIT_pool_create( int n ) nogil
+    void COMMIT_pool_destroy( COMMIT_pool *pool ) nogil
+
+# Interfaces to actual C code performing the multiplications (in double and single precision)
+ctypedef void (*product_t)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    double *_v_in, double *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+ctypedef void (*product_float_t)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
 
-# Interfaces to actual C code performing the multiplications
 cdef extern void COMMIT_A(
-    int _nF, int _n, int _nE, int _nV, int _nS,
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
     double *_v_in, double *_v_out,
     unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
     unsigned int *_ECv, unsigned short *_ECo,
     unsigned int *_ISOv,
     float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
-    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+cdef extern void COMMIT_A_float(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
 ) nogil
 
 cdef extern void COMMIT_At(
-    int _nF, int _n, int _nE, int _nV, int _nS,
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    double *_v_in, double *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+cdef extern void COMMIT_At_float(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+cdef extern void COMMIT_A_noLUT(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    double *_v_in, double *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+cdef extern void COMMIT_A_noLUT_float(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+cdef extern void COMMIT_At_noLUT(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
     double *_v_in, double *_v_out,
     unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
     unsigned int *_ECv, unsigned short *_ECo,
     unsigned int *_ISOv,
     float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
-    unsigned char *_ICthreadsT, unsigned int *_ECthreadsT, unsigned int *_ISOthreadsT
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
 ) nogil
 
+cdef extern void COMMIT_At_noLUT_float(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    double *_stats
+) nogil
+
+# Interfaces to the C code computing the gradient A'*(A*x-y) with a single call
+cdef extern void COMMIT_gradient(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    double *_x, double *_y, double *_res, double *_grad, double *_norms,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ICfT, unsigned int *_ICvT, unsigned short *_ICoT, float *_IClT,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    unsigned int* _ICthreadsT
+) nogil
+
+cdef extern void COMMIT_gradient_float(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    float *_x, float *_y, float *_res, float *_grad, double *_norms,
+    unsigned int *_ICf, unsigned int *_ICv, unsigned short *_ICo, float *_ICl,
+    unsigned int *_ICfT, unsigned int *_ICvT, unsigned short *_ICoT, float *_IClT,
+    unsigned int *_ECv, unsigned short *_ECo,
+    unsigned int *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    unsigned int* _ICthreads, unsigned int* _ECthreads, unsigned int* _ISOthreads,
+    unsigned int* _ICthreadsT
+) nogil
+
+# Interfaces to the C code performing the multiplications with an explicit sparse matrix
+cdef extern void COMMIT_csr_dot(
+    COMMIT_pool *_pool,
+    int _nK, int _nRows, int _nCols,
+    double *_v_in, double *_v_out,
+    np.uint64_t *_ptr, unsigned int *_idx, float *_val,
+    unsigned int *_threads
+) nogil
+
+cdef extern void COMMIT_csr_dot_float(
+    COMMIT_pool *_pool,
+    int _nK, int _nRows, int _nCols,
+    float *_v_in, float *_v_out,
+    np.uint64_t *_ptr, unsigned int *_idx, float *_val,
+    unsigned int *_threads
+) nogil
+
+
+
+cdef class WorkerPool :
+    """Threads performing the multiplications. They are created once and kept alive
+    until the object is released; the operators A and A.T share the same pool.
+    """
+    cdef COMMIT_pool* pool
+    cdef public int n
+
+    def __cinit__( self, int n ) :
+        self.pool = COMMIT_pool_create( n )
+        if self.pool == NULL :
+            raise RuntimeError( 'Unable to create the pool of %d threads' % n )
+        self.n = n
+
+    def __dealloc__( self ) :
+        if self.pool != NULL :
+            with nogil :
+                COMMIT_pool_destroy( self.pool )
+            self.pool = NULL
+
 
 
 cdef class LinearOperator :
     """This class is a wrapper to the C code for performing marix-vector multiplications
     with the COMMIT linear operator A. The multiplications are done using C code
     that uses information from the DICTIONARY, KERNELS and THREADS data structures.
+    The C code is compiled once at installation time and the number of compartments
+    and threads are passed at runtime, hence building a new operator is immediate.
+    The threads performing the multiplications are created once and kept alive until
+    the operator and its transpose are released, either explicitly with "close()" or
+    when they are garbage collected.
+    Per-thread counters of the products can be collected with "enable_stats()" and
+    read with "stats()"; when disabled they add no cost.
     """
-    cdef int nS, nF, nR, nE, nT, nV, nI, n
+    cdef int nS, nO, nF, nR, nE, nT, nV, nI, n
     cdef public int adjoint, n1, n2
+    cdef public bint nolut
+    cdef readonly WorkerPool pool
+    cdef product_t fA
+    cdef product_t fAt
+    cdef product_float_t fA_float
+    cdef product_float_t fAt_float
 
     cdef DICTIONARY
     cdef KERNELS
     cdef THREADS
+    cdef STATS
+    cdef MASK
 
     cdef unsigned int*   ICf
     cdef float*          ICl
@@ -48,6 +249,11 @@ cdef class LinearOperator :
     cdef unsigned short* ECo
     cdef unsigned int*   ISOv
 
+    cdef unsigned int*   ICfT
+    cdef float*          IClT
+    cdef unsigned int*   ICvT
+    cdef unsigned short* ICoT
+
     cdef float* LUT_IC
     cdef float* LUT_EC
     cdef float* LUT_ISO
@@ -56,16 +262,38 @@ cdef class LinearOperator :
     cdef unsigned int*   ECthreads
     cdef unsigned int*   ISOthreads
 
-    cdef unsigned char*  ICthreadsT
+    cdef unsigned int*   ICthreadsT
     cdef unsigned int*   ECthreadsT
     cdef unsigned int*   ISOthreadsT
 
 
-    def __init__( self, DICTIONARY, KERNELS, THREADS ) :
-        """Set the pointers to the data structures used by the C code."""
+    def __init__( self, DICTIONARY, KERNELS, THREADS, nolut = False, WorkerPool pool = None, STATS = None, MASK = None ) :
+        """Set the pointers to the data structures used by the C code.
+
+        Parameters
+        ----------
+        DICTIONARY, KERNELS, THREADS : dict
+            Data structures prepared by the Evaluation class
+        nolut : boolean
+            Use the code for the models without lookup-tables, e.g. VolumeFractions (default : False)
+        pool : WorkerPool
+            Threads to use; if None, a new pool with THREADS['n'] threads is created (default : None)
+        STATS : dict
+            Counters to share with another operator, e.g. by A and A.T (default : None)
+        MASK : dict
+            Working set of fibers to share with another operator, e.g. by A and A.T (default : None)
+        """
+        if THREADS['n'] < 1 or THREADS['n'] > 255 :
+            raise RuntimeError( 'Number of threads must be between 1 and 255' )
+        for key, name in [ ('wmr','nIC'), ('wmh','nEC'), ('iso','nISO') ] :
+            if KERNELS[key].shape[0] > 20 :
+                raise RuntimeError( '%s must be in the range [0..20]' % name )
+
         self.DICTIONARY = DICTIONARY
         self.KERNELS    = KERNELS
         self.THREADS    = THREADS
+        self.STATS      = {} if STATS is None else STATS # empty if the counters are disabled
+        self.MASK       = {} if MASK is None else MASK   # empty if all the fibers are used
 
         self.nF         = DICTIONARY['IC']['nF']    # number of FIBERS
         self.nR         = KERNELS['wmr'].shape[0]   # number of FIBER RADII
@@ -77,10 +305,13 @@ cdef class LinearOperator :
 
         if KERNELS['wmr'].size > 0 :
             self.nS = KERNELS['wmr'].shape[3]       # number of SAMPLES
+            self.nO = KERNELS['wmr'].shape[1] * KERNELS['wmr'].shape[2] # number of ORIENTATIONS in the LUT
         elif KERNELS['wmh'].size > 0 :
             self.nS = KERNELS['wmh'].shape[3]
+            self.nO = KERNELS['wmh'].shape[1] * KERNELS['wmh'].shape[2]
         else :
             self.nS = KERNELS['wmr'].shape[1]
+            self.nO = 0
 
         self.adjoint    = 0                         # direct of inverse product
 
@@ -119,18 +350,55 @@ cdef class LinearOperator :
         cdef unsigned int [::1] ISOthreads = THREADS['ISO']
         self.ISOthreads = &ISOthreads[0]
 
-        cdef unsigned char [::1] ICthreadsT = THREADS['ICt']
+        cdef unsigned int  [::1] ICthreadsT = THREADS['ICt']
         self.ICthreadsT  = &ICthreadsT[0]
         cdef unsigned int  [::1] ECthreadsT = THREADS['ECt']
         self.ECthreadsT  = &ECthreadsT[0]
         cdef unsigned int  [::1] ISOthreadsT = THREADS['ISOt']
         self.ISOthreadsT = &ISOthreadsT[0]
 
+        # get C pointers to the fiber-ordered copy of the IC segments (used by A')
+        cdef unsigned int [::1]   ICfT = THREADS['ICt_fiber']
+        self.ICfT = &ICfT[0]
+        cdef float [::1]          IClT = THREADS['ICt_len']
+        self.IClT = &IClT[0]
+        cdef unsigned int [::1]   ICvT = THREADS['ICt_v']
+        self.ICvT = &ICvT[0]
+        cdef unsigned short [::1] ICoT = THREADS['ICt_o']
+        self.ICoT = &ICoT[0]
+
+        # select the C code
+        self.nolut = nolut
+        if nolut :
+            self.fA        = COMMIT_A_noLUT
+            self.fAt       = COMMIT_At_noLUT
+            self.fA_float  = COMMIT_A_noLUT_float
+            self.fAt_float = COMMIT_At_noLUT_float
+        else :
+            self.fA        = COMMIT_A
+            self.fAt       = COMMIT_At
+            self.fA_float  = COMMIT_A_float
+            self.fAt_float = COMMIT_At_float
+
+        # start (or share) the pool of workers
+        if pool is None :
+            pool = WorkerPool( THREADS['n'] )
+        elif pool.n != THREADS['n'] :
+            raise RuntimeError( 'The pool has %d threads, but THREADS was set for %d' % (pool.n, THREADS['n']) )
+        self.pool = pool
+
+
+    def close( self ) :
+        """Release this operator; the workers are terminated when no other operator uses them."""
+        self.pool = None
+
 
     @property
     def T( self ) :
         """Transpose of the explicit matrix."""
-        C = LinearOperator( self.DICTIONARY, self.KERNELS, self.THREADS )
+        if self.pool is None :
+            raise RuntimeError( "A.T: operator has been closed" )
+        C = LinearOperator( self.DICTIONARY, self.KERNELS, self.THREADS, self.nolut, self.pool, self.STATS, self.MASK )
         C.adjoint = 1 - C.adjoint
         return C
 
@@ -144,47 +412,749 @@ cdef class LinearOperator :
             return ( self.n2, self.n1 )
 
 
-    def dot( self, double [::1] v_in  ):
+    def dot( self, v_in, out = None ):
         """Wrapper to C code for efficiently performing the matrix-vector multiplications.
 
         Parameters
         ----------
-        v_in : 1D numpy.array of double
-            Input vector for the matrix-vector multiplication
+        v_in : 1D or 2D numpy.array of double or float
+            Input vector for the matrix-vector multiplication. A 2D array with k columns
+            is also accepted, in which case the k products are computed with a single
+            pass over the dictionary and the kernels. If v_in is np.float32, the product
+            is computed in single precision (the partial sums are still accumulated in
+            double precision); any other type is converted to np.float64
+        out : numpy.array
+            Array where to store the result, to avoid allocating a new one at each call;
+            it must have the shape and type of v_out, be contiguous (in Fortran order if
+            2D) and not overlap v_in (default : None)
 
         Returns
         -------
-        v_out : 1D numpy.array of double
-            Results of the multiplication
+        v_out : 1D or 2D numpy.array of double or float
+            Results of the multiplication (with k columns if v_in is 2D), with the same
+            precision used for the computation; it is "out" if given
         """
+        cdef int nK
+        cdef int nIC = self.nR, nEC = self.nT, nISO = self.nI
+        cdef COMMIT_pool* pool
+        cdef WorkerPool workers
+        cdef product_t f
+        cdef product_float_t f_float
+        cdef unsigned int*   ICf
+        cdef float*          ICl
+        cdef unsigned int*   ICv
+        cdef unsigned short* ICo
+        cdef unsigned int*   ICthreads
+        cdef unsigned int*   ECthreads
+        cdef unsigned int*   ISOthreads
+        cdef double [::1] v_in_, v_out
+        cdef float [::1]  v_in_float, v_out_float
+        cdef double [:, ::1] counters
+        cdef double* stats = NULL
+        cdef int n = self.n
+        cdef unsigned int [::1]   mICf, mICv, mICthreads
+        cdef unsigned short [::1] mICo
+        cdef float [::1]          mICl
 
-        # Permit only matrix-vector multiplications
-        if v_in.size != self.shape[1] :
+        if self.pool is None :
+            raise RuntimeError( "A.dot(): operator has been closed" )
+
+        # Permit only matrix-vector and matrix-matrix multiplications
+        v_in = np.asarray( v_in )
+        if v_in.ndim == 1 :
+            nK = 1
+        elif v_in.ndim == 2 :
+            nK = v_in.shape[1]
+        else :
+            raise RuntimeError( "A.dot(): input must be a vector or a 2D array" )
+        if v_in.shape[0] != self.shape[1] or nK < 1 :
             raise RuntimeError( "A.dot(): dimensions do not match" )
 
-        # Create output array
-        cdef double [::1] v_out = np.zeros( self.shape[0], dtype=np.float64 )
+        # Counters of this product (if enabled)
+        key = 'At' if self.adjoint else 'A'
+        if self.STATS :
+            counters = self.STATS[key]['counters']
+            stats = &counters[0,0]
 
-        # Call the cython function to read the memory pointers
+        # Select the data structures for the DIRECT PRODUCT A*x or the INVERSE PRODUCT A'*y
         if not self.adjoint :
-            # DIRECT PRODUCT A*x
+            f, f_float = self.fA, self.fA_float
+            ICf, ICl, ICv, ICo = self.ICf, self.ICl, self.ICv, self.ICo
+            ICthreads, ECthreads, ISOthreads = self.ICthreads, self.ECthreads, self.ISOthreads
+        else :
+            f, f_float = self.fAt, self.fAt_float
+            ICf, ICl, ICv, ICo = self.ICfT, self.IClT, self.ICvT, self.ICoT
+            ICthreads, ECthreads, ISOthreads = self.ICthreadsT, self.ECthreadsT, self.ISOthreadsT
+
+        # Use only the segments of the fibers in the working set (see set_mask)
+        if self.MASK :
+            key_mask = 'T' if self.adjoint else ''
+            mICf, mICv, mICo, mICl = self.MASK['ICf'+key_mask], self.MASK['ICv'+key_mask], self.MASK['ICo'+key_mask], self.MASK['ICl'+key_mask]
+            mICthreads = self.MASK['ICthreads'+key_mask]
+            ICf, ICv, ICo, ICl, ICthreads = &mICf[0], &mICv[0], &mICo[0], &mICl[0], &mICthreads[0]
+            n = self.MASK['n']
+
+        # Call the cython function to read the memory pointers
+        # NB: columns are passed to the C code one after the other
+        workers = self.pool # keeps the pool alive if close() is called meanwhile
+        pool = workers.pool
+        if v_in.dtype == np.float32 :
+            v_in_float  = np.ravel( v_in, order='F' )
+            if out is None :
+                v_out_float = np.zeros( self.shape[0]*nK, dtype=np.float32 )
+            else :
+                # the C code accumulates in the output
+                v_out_ = _output( out, self.shape[0], v_in, np.float32 )
+                v_out_.fill( 0 )
+                v_out_float = v_out_
+            if stats != NULL :
+                tic = time.time()
+            with nogil :
+                f_float(
+                    pool, nIC, nEC, nISO,
+                    self.nF, n, self.nE, self.nV, self.nS, self.nO,
+                    nK, self.n1, self.n2,
+                    &v_in_float[0], &v_out_float[0],
+                    ICf, ICv, ICo, ICl, self.ECv, self.ECo, self.ISOv,
+                    self.LUT_IC, self.LUT_EC, self.LUT_ISO,
+                    ICthreads, ECthreads, ISOthreads,
+                    stats
+                )
+            v_out_ = np.asarray( v_out_float )
+        else :
+            v_in_ = np.ravel( v_in, order='F' ).astype( np.float64, copy=False )
+            if out is None :
+                v_out = np.zeros( self.shape[0]*nK, dtype=np.float64 )
+            else :
+                # the C code accumulates in the output
+                v_out_ = _output( out, self.shape[0], v_in, np.float64 )
+                v_out_.fill( 0 )
+                v_out = v_out_
+            if stats != NULL :
+                tic = time.time()
+            with nogil :
+                f(
+                    pool, nIC, nEC, nISO,
+                    self.nF, n, self.nE, self.nV, self.nS, self.nO,
+                    nK, self.n1, self.n2,
+                    &v_in_[0], &v_out[0],
+                    ICf, ICv, ICo, ICl, self.ECv, self.ECo, self.ISOv,
+                    self.LUT_IC, self.LUT_EC, self.LUT_ISO,
+                    ICthreads, ECthreads, ISOthreads,
+                    stats
+                )
+            v_out_ = np.asarray( v_out )
+
+        if stats != NULL :
+            S = self.STATS[key]
+            S['wall_time'] += time.time() - tic
+            S['calls']     += 1
+            S['products']  += nK
+            S['bytes']     += self._bytes( nK, v_out_.itemsize )
+
+        if out is not None :
+            return out
+        if v_in.ndim == 1 :
+            return v_out_
+        return v_out_.reshape( (self.shape[0],nK), order='F' )
+
+
+    def gradient( self, x, y, out = None, res = None ) :
+        """Gradient of the least-squares term 0.5*||A*x-y||^2, i.e. A'*(A*x-y), and norm of
+        the residual A*x-y computed with a single call to the C code: every thread forms the
+        residual of its own voxels as soon as their rows of A*x are complete, accumulates its
+        norm and multiplies it by the EC and ISO compartments of the same voxels while they
+        are still in cache; the IC part of A' follows, once the residual is complete, using
+        the fiber-ordered copy of the segments (the segments of a fiber span several voxels,
+        hence several threads). The models without lookup-tables use dot() and T.dot().
+
+        Parameters
+        ----------
+        x : 1D or 2D numpy.array of double or float
+            Coefficients (with k columns if 2D); np.float32 selects the single precision
+        y : numpy.array
+            Measurements, with the same number of columns as x
+        out : numpy.array
+            Array where to store the gradient, with the requirements of dot() (default : None)
+        res : numpy.array
+            Array where to store the residual A*x-y, with the requirements of dot() (default : None)
+
+        Returns
+        -------
+        res_norm : float or 1D numpy.array
+            Norm of the residual (one value per column if x is 2D), computed in double precision
+        grad : 1D or 2D numpy.array of double or float
+            The gradient A'*(A*x-y); it is "out" if given
+        """
+        cdef int nK
+        cdef COMMIT_pool* pool
+        cdef WorkerPool workers
+        cdef double [::1] x_, y_, res_, grad_
+        cdef float [::1]  x_float, y_float, res_float, grad_float
+        cdef double [::1] norms
+        cdef int n = self.n
+        cdef unsigned int*   ICf = self.ICf
+        cdef float*          ICl = self.ICl
+        cdef unsigned int*   ICv = self.ICv
+        cdef unsigned short* ICo = self.ICo
+        cdef unsigned int*   ICthreads = self.ICthreads
+        cdef unsigned int*   ICfT = self.ICfT
+        cdef float*          IClT = self.IClT
+        cdef unsigned int*   ICvT = self.ICvT
+        cdef unsigned short* ICoT = self.ICoT
+        cdef unsigned int*   ICthreadsT = self.ICthreadsT
+        cdef unsigned int [::1]   mICf, mICv, mICthreads, mICfT, mICvT, mICthreadsT
+        cdef unsigned short [::1] mICo, mICoT
+        cdef float [::1]          mICl, mIClT
+
+        if self.pool is None :
+            raise RuntimeError( "A.gradient(): operator has been closed" )
+        if self.adjoint :
+            raise RuntimeError( "A.gradient(): not available for the transposed operator" )
+
+        x = np.asarray( x )
+        if x.ndim == 1 :
+            nK = 1
+        elif x.ndim == 2 :
+            nK = x.shape[1]
+        else :
+            raise RuntimeError( "A.gradient(): input must be a vector or a 2D array" )
+        dtype = np.float32 if x.dtype == np.float32 else np.float64
+        y = np.asarray( y )
+        if x.shape[0] != self.n2 or nK < 1 or y.shape != (self.n1,) + x.shape[1:] :
+            raise RuntimeError( "A.gradient(): dimensions do not match" )
+
+        if self.nolut :
+            x = x.astype( dtype, copy=False )
+            res = self.dot( x, out=res )
+            res -= y
+            grad = self.T.dot( res, out=out )
+            res_norm = np.sqrt( np.einsum( 'i...,i...->...', res, res, dtype=np.float64 ) )
+            return res_norm, grad
+
+        # the C code accumulates in both outputs
+        if res is None :
+            res = np.zeros( (self.n1,) + x.shape[1:], dtype=dtype, order='F' )
+        res_flat = _output( res, self.n1, x, dtype )
+        if out is None :
+            out = np.zeros( (self.n2,) + x.shape[1:], dtype=dtype, order='F' )
+        grad_flat = _output( out, self.n2, x, dtype )
+        if np.may_share_memory( out, res ) or np.may_share_memory( res, y ) or np.may_share_memory( out, y ) :
+            raise RuntimeError( "A.gradient(): out, res and y must not overlap" )
+        grad_flat.fill( 0 )
+        norms = np.zeros( self.pool.n*nK, dtype=np.float64 )
+
+        # Use only the segments of the fibers in the working set (see set_mask)
+        if self.MASK :
+            mICf, mICv, mICo, mICl, mICthreads = self.MASK['ICf'], self.MASK['ICv'], self.MASK['ICo'], self.MASK['ICl'], self.MASK['ICthreads']
+            mICfT, mICvT, mICoT, mIClT, mICthreadsT = self.MASK['ICfT'], self.MASK['ICvT'], self.MASK['ICoT'], self.MASK['IClT'], self.MASK['ICthreadsT']
+            ICf, ICv, ICo, ICl, ICthreads = &mICf[0], &mICv[0], &mICo[0], &mICl[0], &mICthreads[0]
+            ICfT, ICvT, ICoT, IClT, ICthreadsT = &mICfT[0], &mICvT[0], &mICoT[0], &mIClT[0], &mICthreadsT[0]
+            n = self.MASK['n']
+
+        workers = self.pool # keeps the pool alive if close() is called meanwhile
+        pool = workers.pool
+        if dtype == np.float32 :
+            x_float    = np.ravel( x, order='F' )
+            y_float    = np.ravel( y, order='F' ).astype( np.float32, copy=False )
+            res_float  = res_flat
+            grad_float = grad_flat
             with nogil :
-                COMMIT_A(
-                    self.nF, self.n, self.nE, self.nV, self.nS,
-                    &v_in[0], &v_out[0],
-                    self.ICf, self.ICv, self.ICo, self.ICl, self.ECv, self.ECo, self.ISOv,
+                COMMIT_gradient_float(
+                    pool, self.nR, self.nT, self.nI,
+                    self.nF, n, self.nE, self.nV, self.nS, self.nO,
+                    nK, self.n1, self.n2,
+                    &x_float[0], &y_float[0], &res_float[0], &grad_float[0], &norms[0],
+                    ICf, ICv, ICo, ICl,
+                    ICfT, ICvT, ICoT, IClT,
+                    self.ECv, self.ECo, self.ISOv,
                     self.LUT_IC, self.LUT_EC, self.LUT_ISO,
-                    self.ICthreads, self.ECthreads, self.ISOthreads
+                    ICthreads, self.ECthreads, self.ISOthreads,
+                    ICthreadsT
                 )
         else :
-            # INVERSE PRODUCT A'*y
+            x_    = np.ravel( x, order='F' ).astype( np.float64, copy=False )
+            y_    = np.ravel( y, order='F' ).astype( np.float64, copy=False )
+            res_  = res_flat
+            grad_ = grad_flat
             with nogil :
-                COMMIT_At(
-                    self.nF, self.n, self.nE, self.nV, self.nS,
-                    &v_in[0], &v_out[0],
-                    self.ICf, self.ICv, self.ICo, self.ICl, self.ECv, self.ECo, self.ISOv,
+                COMMIT_gradient(
+                    pool, self.nR, self.nT, self.nI,
+                    self.nF, n, self.nE, self.nV, self.nS, self.nO,
+                    nK, self.n1, self.n2,
+                    &x_[0], &y_[0], &res_[0], &grad_[0], &norms[0],
+                    ICf, ICv, ICo, ICl,
+                    ICfT, ICvT, ICoT, IClT,
+                    self.ECv, self.ECo, self.ISOv,
                     self.LUT_IC, self.LUT_EC, self.LUT_ISO,
-                    self.ICthreadsT, self.ECthreadsT, self.ISOthreadsT
+                    ICthreads, self.ECthreads, self.ISOthreads,
+                    ICthreadsT
                 )
 
-        return v_out
+        res_norm = np.sqrt( np.asarray( norms ).reshape( (self.pool.n, nK) ).sum( axis=0 ) )
+        if x.ndim == 1 :
+            res_norm = res_norm[0]
+        return res_norm, out
+
+
+    def set_mask( self, columns = None ) :
+        """Restrict the products to a working set of columns of A, e.g. to skip those of
+        the fibers whose coefficients are known to be zero. The C code skips the segments
+        of the fibers whose IC columns are all masked, both in A*x and in A'*y (where their
+        coefficients are set to 0); the EC and ISO columns are always used. The working set
+        is shared by the operator and its transposes obtained with ".T"; the ranges of
+        voxels and fibers of the threads are kept, with fewer segments in each range.
+
+        Parameters
+        ----------
+        columns : np.array of bool
+            True for the columns to keep (one value per column of A); if None, all the
+            columns are used (default : None)
+        """
+        self.MASK.clear()
+        if columns is None :
+            return
+        columns = np.asarray( columns, dtype=bool )
+        if columns.shape != (self.n2,) :
+            raise RuntimeError( 'A.set_mask(): columns must be a boolean array with %d values' % self.n2 )
+        if self.n == 0 or self.nR == 0 :
+            return
+        fibers = columns[ :self.nR*self.nF ].reshape( (self.nR,self.nF) ).any( axis=0 )
+        if fibers.all() :
+            return
+
+        # segments in voxel order (A); the voxel boundaries of the threads are those of the ISO part
+        D = self.DICTIONARY['IC']
+        keep = fibers[ D['fiber'] ]
+        self.MASK['ICf'] = np.ascontiguousarray( D['fiber'][keep] )
+        self.MASK['ICv'] = np.ascontiguousarray( D['v'][keep] )
+        self.MASK['ICo'] = np.ascontiguousarray( D['o'][keep] )
+        self.MASK['ICl'] = np.ascontiguousarray( D['len'][keep] )
+        self.MASK['ICthreads'] = np.searchsorted( self.MASK['ICv'], self.THREADS['ISO'] ).astype(np.uint32)
+
+        # segments in fiber order (A'); each thread keeps its range of fibers
+        T = self.THREADS
+        keep = fibers[ T['ICt_fiber'] ]
+        self.MASK['ICfT'] = np.ascontiguousarray( T['ICt_fiber'][keep] )
+        self.MASK['ICvT'] = np.ascontiguousarray( T['ICt_v'][keep] )
+        self.MASK['ICoT'] = np.ascontiguousarray( T['ICt_o'][keep] )
+        self.MASK['IClT'] = np.ascontiguousarray( T['ICt_len'][keep] )
+        bounds = np.append( T['ICt_fiber'], self.nF )[ T['ICt'] ]
+        self.MASK['ICthreadsT'] = np.searchsorted( self.MASK['ICfT'], bounds ).astype(np.uint32)
+
+        self.MASK['n'] = int( self.MASK['ICf'].size )
+        self.MASK['fibers'] = fibers
+
+
+    def masked_fibers( self ) :
+        """Number of fibers skipped by the products (see set_mask)."""
+        return int( self.nF - self.MASK['fibers'].sum() ) if self.MASK else 0
+
+
+    def column_norms( self ) :
+        """Upper bounds of the 2-norms of the columns of A (exact unless a fiber has several
+        segments in the same voxel), computed from the dictionary and the kernels."""
+        return column_norms( self.DICTIONARY, self.KERNELS, self.nolut )
+
+
+    def _bytes( self, int nK, int r ) :
+        """Estimate of the memory read and written by a product with nK columns whose
+        vectors have r bytes per element: indices of the segments, rows of the kernels
+        and elements of x and y (the segments with zero coefficients are not skipped)."""
+        if self.nolut :
+            return self.n*( 12 + nK*2*r ) + ( self.nV*( 4 + nK*2*r ) if self.nI > 0 else 0 )
+        return ( self.n*( 14 + 4*self.nR*self.nS + nK*(self.nS+self.nR)*r ) if self.nR > 0 else 0 ) \
+             + ( self.nE*( 6 + 4*self.nT*self.nS + nK*(self.nS+self.nT)*r ) if self.nT > 0 else 0 ) \
+             + ( self.nV*( 4 + nK*(self.nS+self.nI)*r ) if self.nI > 0 else 0 )
+
+
+    def enable_stats( self, enable = True ) :
+        """Start (or stop, if enable is False) collecting the counters returned by "stats()".
+        The counters are shared by the operator and its transposes obtained with ".T", and
+        they are reset every time they are enabled.
+        """
+        self.STATS.clear()
+        if enable :
+            for key in ['A','At'] :
+                self.STATS[key] = {
+                    'counters'  : np.zeros( (self.pool.n, 6), dtype=np.float64 ),
+                    'wall_time' : 0.0,
+                    'calls'     : 0,
+                    'products'  : 0,
+                    'bytes'     : 0,
+                }
+
+
+    def reset_stats( self ) :
+        """Set all the counters to zero."""
+        if self.STATS :
+            self.enable_stats( True )
+
+
+    def stats( self ) :
+        """Counters of the products performed since "enable_stats()" was called.
+
+        Returns
+        -------
+        stats : dict
+            'threads' is the number of threads; 'A' and 'At' hold the counters of the
+            products with A and A', respectively:
+                'calls'       : number of calls to dot()
+                'products'    : number of matrix-vector products (columns of the inputs)
+                'wall_time'   : total time spent in the C code (seconds)
+                'time_IC', 'time_EC', 'time_ISO' : time spent by each thread in the
+                                compartments (np.array with one value per thread)
+                'n_IC', 'n_EC', 'n_ISO' : number of IC segments, EC segments and voxels
+                                processed by each thread
+                'busy', 'idle' : time each thread spent working or waiting for the others
+                'imbalance'   : maximum over mean busy time of the threads (1 = perfect balance)
+                'bytes'       : estimate of the memory read and written
+        """
+        if not self.STATS :
+            raise RuntimeError( 'A.stats(): counters are disabled; call "enable_stats()" first' )
+        out = { 'threads' : self.pool.n }
+        for key in ['A','At'] :
+            S = self.STATS[key]
+            C = np.array( S['counters'] )
+            busy = C[:,0:3].sum( axis=1 )
+            out[key] = {
+                'calls'     : S['calls'],
+                'products'  : S['products'],
+                'wall_time' : S['wall_time'],
+                'time_IC'   : C[:,0],
+                'time_EC'   : C[:,1],
+                'time_ISO'  : C[:,2],
+                'n_IC'      : C[:,3].astype(np.int64),
+                'n_EC'      : C[:,4].astype(np.int64),
+                'n_ISO'     : C[:,5].astype(np.int64),
+                'busy'      : busy,
+                'idle'      : np.maximum( S['wall_time'] - busy, 0 ),
+                'imbalance' : busy.max() / busy.mean() if busy.mean() > 0 else 1.0,
+                'bytes'     : S['bytes'],
+            }
+        return out
+
+
+
+def _output( out, nRows, v_in, dtype ) :
+    """Check that "out" can store the result of a product with v_in and return it as
+    a 1D array with the columns one after the other, without copying it."""
+    shape = (nRows,) + v_in.shape[1:]
+    if not isinstance( out, np.ndarray ) or out.shape != shape or out.dtype != dtype :
+        raise RuntimeError( "A.dot(): out must be an array of %s with shape %s" % ( np.dtype(dtype).name, str(shape) ) )
+    if not out.flags.f_contiguous or not out.flags.writeable :
+        raise RuntimeError( "A.dot(): out must be writeable and contiguous (in Fortran order if 2D)" )
+    if np.may_share_memory( out, v_in ) :
+        raise RuntimeError( "A.dot(): out must not overlap the input" )
+    return out.reshape( -1, order='F' )
+
+
+
+def column_norms( DICTIONARY, KERNELS, nolut = False ) :
+    """Upper bounds of the 2-norms of the columns of A, by the triangle inequality over the
+    segments of each fiber; they are exact for the EC and ISO columns."""
+    nF, nE, nV, nR, nT, nI, nS = _sizes( DICTIONARY, KERNELS )
+    IC, EC = DICTIONARY['IC'], DICTIONARY['EC']
+    norms = []
+    if nolut :
+        if nR > 0 :
+            norms.append( np.bincount( IC['fiber'], weights=IC['len'], minlength=nF ) )
+        norms.append( np.ones( nI*nV ) )
+        return np.concatenate( norms )
+    for i in xrange(nR) :
+        lut = np.sqrt( ( KERNELS['wmr'][i].reshape( (-1,nS) ).astype(np.float64)**2 ).sum( axis=1 ) )
+        norms.append( np.bincount( IC['fiber'], weights=IC['len']*lut[IC['o']], minlength=nF ) )
+    for t in xrange(nT) :
+        lut = np.sqrt( ( KERNELS['wmh'][t].reshape( (-1,nS) ).astype(np.float64)**2 ).sum( axis=1 ) )
+        norms.append( lut[EC['o']] )
+    for i in xrange(nI) :
+        norms.append( np.repeat( np.sqrt( ( KERNELS['iso'][i].astype(np.float64)**2 ).sum() ), nV ) )
+    return np.concatenate( norms ) if norms else np.zeros( 0 )
+
+
+def _sizes( DICTIONARY, KERNELS ) :
+    """Number of fibers, EC segments, voxels, compartments and samples of the operator."""
+    if KERNELS['wmr'].size > 0 :
+        nS = KERNELS['wmr'].shape[3]
+    elif KERNELS['wmh'].size > 0 :
+        nS = KERNELS['wmh'].shape[3]
+    else :
+        nS = KERNELS['wmr'].shape[1]
+    return DICTIONARY['IC']['nF'], DICTIONARY['EC']['nE'], DICTIONARY['nV'], KERNELS['wmr'].shape[0], KERNELS['wmh'].shape[0], KERNELS['iso'].shape[0], nS
+
+
+def _to_csr( rows, cols, vals, nRows, nCols ) :
+    """Convert a list of (possibly repeated) entries into CSR format, summing the duplicates."""
+    key = rows * nCols + cols
+    idx = np.argsort( key, kind='mergesort' )
+    key = key[ idx ]
+    vals = vals[ idx ]
+    del idx
+    if key.size > 0 :
+        first = np.flatnonzero( np.concatenate( ( [True], key[1:] != key[:key.size-1] ) ) )
+        vals = np.add.reduceat( vals, first )
+        key = key[ first ]
+        del first
+        nz = vals != 0
+        vals = vals[ nz ]
+        key = key[ nz ]
+        del nz
+    ptr = np.zeros( nRows+1, dtype=np.uint64 )
+    ptr[1:] = np.cumsum( np.bincount( key // nCols, minlength=nRows ) )
+    return ptr, ( key % nCols ).astype( np.uint32 ), vals.astype( np.float32 )
+
+
+def estimate_sparse_size( DICTIONARY, KERNELS, nolut = False ) :
+    """Upper bound of the memory (in bytes) needed by build_sparse() to store A and A'.
+
+    Each non-zero costs 8 bytes (column index and value) in each of the two copies;
+    the actual size is smaller if segments of the same fiber share voxel and orientation.
+    """
+    nF, nE, nV, nR, nT, nI, nS = _sizes( DICTIONARY, KERNELS )
+    if nolut :
+        nnz = DICTIONARY['IC']['n'] + ( nV if nI > 0 else 0 )
+    else :
+        nnz = ( DICTIONARY['IC']['n']*nR + nE*nT + nV*nI ) * nS
+    return 2 * ( 8*nnz + 8*(nV*nS+1) ) + 8*( nR*nF + nT*nE + nI*nV + 1 )
+
+
+def sparse_signature( DICTIONARY, KERNELS, nolut = False ) :
+    """Hash of all the data used by build_sparse(), to identify a cached matrix."""
+    h = hashlib.md5()
+    h.update( str( _sizes( DICTIONARY, KERNELS ) + ( bool(nolut), ) ) )
+    for a in [ DICTIONARY['IC']['v'], DICTIONARY['IC']['o'], DICTIONARY['IC']['fiber'], DICTIONARY['IC']['len'],
+               DICTIONARY['EC']['v'], DICTIONARY['EC']['o'], DICTIONARY['ISO']['v'],
+               KERNELS['wmr'], KERNELS['wmh'], KERNELS['iso'] ] :
+        h.update( np.ascontiguousarray( a ).data )
+    return h.hexdigest()
+
+
+def build_sparse( DICTIONARY, KERNELS, nolut = False ) :
+    """Materialize the operator A as an explicit sparse matrix.
+
+    Parameters
+    ----------
+    DICTIONARY, KERNELS : dict
+        Data structures prepared by the Evaluation class
+    nolut : boolean
+        Build the matrix of the models without lookup-tables, e.g. VolumeFractions (default : False)
+
+    Returns
+    -------
+    SPARSE : dict
+        'shape' of A and the CSR representations of A ('ptr', 'idx', 'val') and of A'
+        ('ptrT', 'idxT', 'valT'); the values are stored as float32, like the kernels
+    """
+    nF, nE, nV, nR, nT, nI, nS = _sizes( DICTIONARY, KERNELS )
+    n1 = nV*nS
+    n2 = nR*nF + nT*nE + nI*nV
+    IC = DICTIONARY['IC']
+    EC = DICTIONARY['EC']
+    rows, cols, vals = [], [], []
+
+    if nolut :
+        # each segment contributes with its length; only one IC and one ISO compartment
+        rows.append( IC['v'].astype(np.int64) )
+        cols.append( IC['fiber'].astype(np.int64) )
+        vals.append( IC['len'].astype(np.float64) )
+        if nI > 0 :
+            rows.append( DICTIONARY['ISO']['v'].astype(np.int64) )
+            cols.append( nF + np.arange( nV, dtype=np.int64 ) )
+            vals.append( np.ones( nV ) )
+    else :
+        samples = np.arange( nS, dtype=np.int64 )
+        for i in xrange(nR) :
+            rows.append( ( IC['v'].astype(np.int64)[:,None]*nS + samples ).ravel() )
+            cols.append( np.repeat( i*nF + IC['fiber'].astype(np.int64), nS ) )
+            vals.append( ( IC['len'].astype(np.float64)[:,None] * KERNELS['wmr'][i].reshape(-1,nS)[ IC['o'] ] ).ravel() )
+        for i in xrange(nT) :
+            rows.append( ( EC['v'].astype(np.int64)[:,None]*nS + samples ).ravel() )
+            cols.append( np.repeat( nR*nF + i*nE + np.arange( nE, dtype=np.int64 ), nS ) )
+            vals.append( KERNELS['wmh'][i].reshape(-1,nS)[ EC['o'] ].astype(np.float64).ravel() )
+        for i in xrange(nI) :
+            rows.append( ( DICTIONARY['ISO']['v'].astype(np.int64)[:,None]*nS + samples ).ravel() )
+            cols.append( np.repeat( nR*nF + nT*nE + i*nV + np.arange( nV, dtype=np.int64 ), nS ) )
+            vals.append( np.tile( KERNELS['iso'][i].astype(np.float64), nV ) )
+
+    rows = np.concatenate( rows ) if rows else np.zeros( 0, dtype=np.int64 )
+    cols = np.concatenate( cols ) if cols else np.zeros( 0, dtype=np.int64 )
+    vals = np.concatenate( vals ) if vals else np.zeros( 0 )
+
+    SPARSE = {}
+    SPARSE['shape'] = np.array( [n1, n2], dtype=np.int64 )
+    SPARSE['ptr'],  SPARSE['idx'],  SPARSE['val']  = _to_csr( rows, cols, vals, n1, n2 )
+    SPARSE['ptrT'], SPARSE['idxT'], SPARSE['valT'] = _to_csr( cols, rows, vals, n2, n1 )
+    return SPARSE
+
+
+
+cdef class SparseOperator :
+    """Same interface of LinearOperator, but the multiplications are performed with
+    an explicit sparse matrix (see build_sparse) instead of the lookup-tables.
+    This is faster when the matrix fits in memory and the orientations of the segments
+    are spread over a large part of the lookup-tables, as each product then reads the
+    non-zeros sequentially instead of gathering rows of the kernels.
+    The rows of A and A' are split among the threads by number of non-zeros.
+    """
+    cdef public int adjoint, n1, n2
+    cdef SPARSE
+    cdef public THREADS
+    cdef readonly WorkerPool pool
+
+
+    def __init__( self, SPARSE, n, WorkerPool pool = None ) :
+        """Split the rows among the threads and start the workers.
+
+        Parameters
+        ----------
+        SPARSE : dict
+            Matrix returned by build_sparse()
+        n : integer
+            Number of threads to use
+        pool : WorkerPool
+            Threads to use; if None, a new pool with n threads is created (default : None)
+        """
+        if n < 1 or n > 255 :
+            raise RuntimeError( 'Number of threads must be between 1 and 255' )
+        self.SPARSE  = SPARSE
+        self.n1      = SPARSE['shape'][0]
+        self.n2      = SPARSE['shape'][1]
+        self.adjoint = 0
+
+        self.THREADS = {}
+        for key, nRows in [ ('', self.n1), ('T', self.n2) ] :
+            ptr = SPARSE['ptr'+key]
+            rows = np.searchsorted( ptr, np.linspace( 0, ptr[nRows], n+1 ) )
+            rows[0], rows[n] = 0, nRows
+            self.THREADS['rows'+key] = np.minimum( rows, nRows ).astype( np.uint32 )
+
+        if pool is None :
+            pool = WorkerPool( n )
+        elif pool.n != n :
+            raise RuntimeError( 'The pool has %d threads, but %d were requested' % (pool.n, n) )
+        self.pool = pool
+
+
+    def close( self ) :
+        """Release this operator; the workers are terminated when no other operator uses them."""
+        self.pool = None
+
+
+    @property
+    def T( self ) :
+        """Transpose of the explicit matrix."""
+        if self.pool is None :
+            raise RuntimeError( "A.T: operator has been closed" )
+        C = SparseOperator( self.SPARSE, self.pool.n, self.pool )
+        C.adjoint = 1 - C.adjoint
+        return C
+
+
+    @property
+    def shape( self ) :
+        """Size of the explicit matrix."""
+        if not self.adjoint :
+            return ( self.n1, self.n2 )
+        else :
+            return ( self.n2, self.n1 )
+
+
+    @property
+    def nbytes( self ) :
+        """Memory used by the sparse matrices (in bytes)."""
+        return sum( self.SPARSE[k].nbytes for k in ['ptr','idx','val','ptrT','idxT','valT'] )
+
+
+    def column_norms( self ) :
+        """2-norms of the columns of the explicit matrix."""
+        if self.adjoint :
+            ptr, val, n = self.SPARSE['ptr'], self.SPARSE['val'], self.shape[1]
+        else :
+            ptr, val, n = self.SPARSE['ptrT'], self.SPARSE['valT'], self.shape[1]
+        rows = np.repeat( np.arange( n ), np.diff( ptr.astype(np.int64) ) )
+        return np.sqrt( np.bincount( rows, weights=val.astype(np.float64)**2, minlength=n ) )
+
+
+    def dot( self, v_in, out = None ):
+        """Multiply by the explicit matrix; same as LinearOperator.dot()."""
+        cdef int nK, nRows, nCols
+        cdef COMMIT_pool* pool
+        cdef WorkerPool workers
+        cdef np.uint64_t [::1] ptr
+        cdef unsigned int [::1] idx
+        cdef float [::1] val
+        cdef unsigned int [::1] threads
+        cdef double [::1] v_in_, v_out
+        cdef float [::1]  v_in_float, v_out_float
+
+        if self.pool is None :
+            raise RuntimeError( "A.dot(): operator has been closed" )
+
+        # Permit only matrix-vector and matrix-matrix multiplications
+        v_in = np.asarray( v_in )
+        if v_in.ndim == 1 :
+            nK = 1
+        elif v_in.ndim == 2 :
+            nK = v_in.shape[1]
+        else :
+            raise RuntimeError( "A.dot(): input must be a vector or a 2D array" )
+        if v_in.shape[0] != self.shape[1] or nK < 1 :
+            raise RuntimeError( "A.dot(): dimensions do not match" )
+
+        # Select the CSR representation of A or A'
+        key = 'T' if self.adjoint else ''
+        ptr     = self.SPARSE['ptr'+key]
+        idx     = self.SPARSE['idx'+key]
+        val     = self.SPARSE['val'+key]
+        threads = self.THREADS['rows'+key]
+        nRows, nCols = self.shape
+        dtype = np.float32 if v_in.dtype == np.float32 else np.float64
+        if idx.shape[0] == 0 :
+            if out is None :
+                return np.zeros( (self.shape[0],) + v_in.shape[1:], dtype=dtype )
+            _output( out, self.shape[0], v_in, dtype ).fill( 0 )
+            return out
+
+        # NB: columns are passed to the C code one after the other; all the rows are
+        #     written, hence the output does not need to be cleared
+        workers = self.pool # keeps the pool alive if close() is called meanwhile
+        pool = workers.pool
+        if v_in.dtype == np.float32 :
+            v_in_float  = np.ravel( v_in, order='F' )
+            if out is None :
+                v_out_float = np.zeros( self.shape[0]*nK, dtype=np.float32 )
+            else :
+                v_out_float = _output( out, self.shape[0], v_in, np.float32 )
+            with nogil :
+                COMMIT_csr_dot_float( pool, nK, nRows, nCols, &v_in_float[0], &v_out_float[0], &ptr[0], &idx[0], &val[0], &threads[0] )
+            v_out_ = np.asarray( v_out_float )
+        else :
+            v_in_ = np.ravel( v_in, order='F' ).astype( np.float64, copy=False )
+            if out is None :
+                v_out = np.zeros( self.shape[0]*nK, dtype=np.float64 )
+            else :
+                v_out = _output( out, self.shape[0], v_in, np.float64 )
+            with nogil :
+                COMMIT_csr_dot( pool, nK, nRows, nCols, &v_in_[0], &v_out[0], &ptr[0], &idx[0], &val[0], &threads[0] )
+            v_out_ = np.asarray( v_out )
+
+        if out is not None :
+            return out
+        if v_in.ndim == 1 :
+            return v_out_
+        return v_out_.reshape( (self.shape[0],nK), order='F' )
+
+
+
+def time_products( A, repeat = 3 ) :
+    """Average time (in seconds) of a product with A plus a product with A', measured
+    on random vectors; used to choose the fastest backend for a given dictionary."""
+    x = np.random.rand( A.shape[1] )
+    y = np.random.rand( A.shape[0] )
+    At = A.T
+    A.dot( x )
+    tic = time.time()
+    for i in xrange(repeat) :
+        A.dot( x )
+        At.dot( y )
+    return ( time.time() - tic ) / repeat
@@ -0,0 +1,228 @@
+/*
+    Body of the products, included by operator_noLUT.c once for each precision of the
+    vectors x and y: REAL is their type and NAME(f) the name of the function f for it.
+*/
+
+/* parameters of a product, shared by all the threads */
+typedef struct
+{
+    int         nISO;
+    int         nF, n, nK;
+    size_t      nRows, nCols;
+    REAL        *x, *Y;
+    uint32_t    *ICthreads, *ISOthreads;
+    uint32_t    *ICf, *ICv, *ISOv;
+    float       *ICl;
+    double      *stats;
+} NAME(COMMIT_product);
+
+
+
+// ====================================================
+// Compute a sub-block of the A*x MAtRIX-VECTOR product
+// ====================================================
+static void NAME(COMMIT_A__block)( void *ptr, int id )
+{
+    NAME(COMMIT_product) *P = (NAME(COMMIT_product)*) ptr;
+    const int    nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols;
+    int      k;
+    size_t   kX, kY;
+    double   x0;
+    REAL     *x = P->x, *Y = P->Y, *xPtr;
+    uint32_t *t_v, *t_vEnd, *t_f;
+    float    *t_l;
+
+    COMMIT_STATS_START( P->stats )
+
+    // intra-cellular compartments
+    t_v    = P->ICv + P->ICthreads[id];
+    t_vEnd = P->ICv + P->ICthreads[id+1];
+    t_l    = P->ICl + P->ICthreads[id];
+    t_f    = P->ICf + P->ICthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            x0 = x[kX+*t_f];
+            if ( x0 != 0 )
+                Y[kY+*t_v] += (double)(*t_l) * x0;
+        }
+        t_f++;
+        t_v++;
+        t_l++;
+    }
+
+    COMMIT_STATS_LAP( P->stats, id, 0, (size_t)(P->ICthreads[id+1]-P->ICthreads[id])*nK )
+
+    if ( P->nISO >= 1 )
+    {
+        // isotropic compartments
+        t_v    = P->ISOv + P->ISOthreads[id];
+        t_vEnd = P->ISOv + P->ISOthreads[id+1];
+        xPtr   = x + P->nF + P->ISOthreads[id];
+
+        while( t_v != t_vEnd )
+        {
+            for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+            {
+                x0 = xPtr[kX];
+                if ( x0 != 0 )
+                    Y[kY+*t_v] += x0;
+            }
+            xPtr++;
+            t_v++;
+        }
+        COMMIT_STATS_LAP( P->stats, id, 2, (size_t)(P->ISOthreads[id+1]-P->ISOthreads[id])*nK )
+    }
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_A_noLUT)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    REAL *_vIN, REAL *_vOUT,
+    uint32_t *_ICf, uint32_t *_ICv, uint16_t *_ICo, float *_ICl,
+    uint32_t *_ECv, uint16_t *_ECo,
+    uint32_t *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    uint32_t* _ICthreads, uint32_t* _ECthreads, uint32_t* _ISOthreads,
+    double *_stats
+)
+{
+    NAME(COMMIT_product) P;
+
+    P.nISO  = _nISO;
+    P.nF    = _nF;
+    P.n     = _n;
+    P.nK    = _nK;
+    P.nRows = _nRows;
+    P.nCols = _nCols;
+
+    P.x = _vIN;
+    P.Y = _vOUT;
+
+    P.ICf  = _ICf;
+    P.ICv  = _ICv;
+    P.ICl  = _ICl;
+    P.ISOv = _ISOv;
+
+    P.ICthreads  = _ICthreads;
+    P.ISOthreads = _ISOthreads;
+
+    P.stats = _stats;
+
+    // Wake up the workers to perform the multiplication
+    COMMIT_pool_run( _pool, NAME(COMMIT_A__block), &P );
+}
+
+
+
+/* ===================================================== */
+/* Compute a sub-block of the A'*y MAtRIX-VECTOR product */
+/* ===================================================== */
+static void NAME(COMMIT_At__block)( void *ptr, int id )
+{
+    NAME(COMMIT_product) *P = (NAME(COMMIT_product)*) ptr;
+    const int    nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols;
+    int      k;
+    size_t   kX, kY;
+    double   acc;
+    REAL     *x = P->x, *Y = P->Y, *xPtr;
+    uint32_t *t_v, *t_vEnd, *t_f, *r_v, *r_vEnd, *r_f;
+    float    *t_l, *r_l;
+
+    COMMIT_STATS_START( P->stats )
+
+    // intra-cellular compartments
+    t_v    = P->ICv + P->ICthreads[id];
+    t_vEnd = P->ICv + P->ICthreads[id+1];
+    t_l    = P->ICl + P->ICthreads[id];
+    t_f    = P->ICf + P->ICthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        // the segments of a fiber are contiguous, hence their contributions are
+        // accumulated in double precision and x is updated once per fiber
+        for( r_vEnd=t_v+1, r_f=t_f+1 ; r_vEnd != t_vEnd && *r_f == *t_f ; r_vEnd++, r_f++ );
+
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            acc = 0;
+            for( r_v=t_v, r_l=t_l ; r_v != r_vEnd ; r_v++, r_l++ )
+                acc += (double)(*r_l) * Y[kY+*r_v];
+            x[kX+*t_f] += acc;
+        }
+        t_f += r_vEnd - t_v;
+        t_l += r_vEnd - t_v;
+        t_v  = r_vEnd;
+    }
+
+    COMMIT_STATS_LAP( P->stats, id, 0, (size_t)(P->ICthreads[id+1]-P->ICthreads[id])*nK )
+
+    if ( P->nISO >= 1 )
+    {
+        // isotropic compartments
+        t_v    = P->ISOv + P->ISOthreads[id];
+        t_vEnd = P->ISOv + P->ISOthreads[id+1];
+        xPtr   = x + P->nF + P->ISOthreads[id];
+
+        while( t_v != t_vEnd )
+        {
+            for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+                xPtr[kX] += Y[kY+*t_v];
+            xPtr++;
+            t_v++;
+        }
+        COMMIT_STATS_LAP( P->stats, id, 2, (size_t)(P->ISOthreads[id+1]-P->ISOthreads[id])*nK )
+    }
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_At_noLUT)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    REAL *_vIN, REAL *_vOUT,
+    uint32_t *_ICf, uint32_t *_ICv, uint16_t *_ICo, float *_ICl,
+    uint32_t *_ECv, uint16_t *_ECo,
+    uint32_t *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    uint32_t* _ICthreadsT, uint32_t* _ECthreadsT, uint32_t* _ISOthreadsT,
+    double *_stats
+)
+{
+    NAME(COMMIT_product) P;
+
+    P.nISO  = _nISO;
+    P.nF    = _nF;
+    P.n     = _n;
+    P.nK    = _nK;
+    P.nRows = _nRows;
+    P.nCols = _nCols;
+
+    P.x = _vOUT;
+    P.Y = _vIN;
+
+    P.ICf  = _ICf;
+    P.ICv  = _ICv;
+    P.ICl  = _ICl;
+    P.ISOv = _ISOv;
+
+    P.ICthreads  = _ICthreadsT;
+    P.ISOthreads = _ISOthreadsT;
+
+    P.stats = _stats;
+
+    // Wake up the workers to perform the multiplication
+    COMMIT_pool_run( _pool, NAME(COMMIT_At__block), &P );
+}
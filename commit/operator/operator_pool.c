@@ -0,0 +1,166 @@
+#include <pthread.h>
+#include <stdlib.h>
+#include "operator_pool.h"
+
+
+typedef struct
+{
+    COMMIT_pool *pool;
+    int         id;
+} COMMIT_pool__worker_arg;
+
+struct COMMIT_pool
+{
+    int                     n;      // number of threads actually started (including the calling one)
+    int                     jobs;   // number of sub-blocks of each job, i.e. the threads requested
+    pthread_t               *threads;
+    COMMIT_pool__worker_arg *args;
+    pthread_mutex_t         run;    // held for a whole COMMIT_pool_run, as A and A' share the pool
+    pthread_mutex_t         mutex;
+    pthread_cond_t          cond_start, cond_done;
+    void                    (*job)( void*, int );
+    void                    *arg;
+    unsigned long           generation;
+    int                     busy, quit;
+};
+
+
+static void* COMMIT_pool__worker( void *ptr )
+{
+    COMMIT_pool   *pool = ((COMMIT_pool__worker_arg*)ptr)->pool;
+    int           id    = ((COMMIT_pool__worker_arg*)ptr)->id;
+    int           i, n, jobs;
+    unsigned long generation = 0; // the value set by COMMIT_pool_create
+    void          (*job)( void*, int );
+    void          *arg;
+
+    pthread_mutex_lock( &pool->mutex );
+    while( 1 )
+    {
+        while( pool->generation == generation && !pool->quit )
+            pthread_cond_wait( &pool->cond_start, &pool->mutex );
+        if ( pool->quit )
+            break;
+        generation = pool->generation;
+        job  = pool->job;
+        arg  = pool->arg;
+        n    = pool->n;
+        jobs = pool->jobs;
+        pthread_mutex_unlock( &pool->mutex );
+
+        for(i=id; i<jobs ; i+=n)
+            job( arg, i );
+
+        pthread_mutex_lock( &pool->mutex );
+        if ( --pool->busy == 0 )
+            pthread_cond_signal( &pool->cond_done );
+    }
+    pthread_mutex_unlock( &pool->mutex );
+    return NULL;
+}
+
+
+// create the workers; returns NULL on failure
+COMMIT_pool* COMMIT_pool_create( int n )
+{
+    int t;
+    COMMIT_pool *pool;
+
+    if ( n < 1 )
+        return NULL;
+    pool = (COMMIT_pool*) calloc( 1, sizeof(COMMIT_pool) );
+    if ( pool == NULL )
+        return NULL;
+    pool->n       = n;
+    pool->jobs    = n;
+    pool->threads = (pthread_t*) calloc( n, sizeof(pthread_t) );
+    pool->args    = (COMMIT_pool__worker_arg*) calloc( n, sizeof(COMMIT_pool__worker_arg) );
+    if ( pool->threads == NULL || pool->args == NULL )
+    {
+        free( pool->args );
+        free( pool->threads );
+        free( pool );
+        return NULL;
+    }
+    pthread_mutex_init( &pool->run, NULL );
+    pthread_mutex_init( &pool->mutex, NULL );
+    pthread_cond_init( &pool->cond_start, NULL );
+    pthread_cond_init( &pool->cond_done, NULL );
+    pool->generation = 0;
+    pool->quit = 0;
+
+    for(t=1; t<n ; t++)
+    {
+        pool->args[t].pool = pool;
+        pool->args[t].id   = t;
+        if ( pthread_create( &pool->threads[t], NULL, COMMIT_pool__worker, &pool->args[t] ) != 0 )
+        {
+            // keep the workers already started; the sub-blocks are then shared among them
+            pthread_mutex_lock( &pool->mutex );
+            pool->n = t;
+            pthread_mutex_unlock( &pool->mutex );
+            break;
+        }
+    }
+    return pool;
+}
+
+
+// terminate and join the workers, then release the pool
+void COMMIT_pool_destroy( COMMIT_pool *pool )
+{
+    int t;
+    if ( pool == NULL )
+        return;
+    // wait for the product in progress, if any
+    pthread_mutex_lock( &pool->run );
+    pthread_mutex_lock( &pool->mutex );
+    pool->quit = 1;
+    pthread_cond_broadcast( &pool->cond_start );
+    pthread_mutex_unlock( &pool->mutex );
+    for(t=1; t<pool->n ; t++)
+        pthread_join( pool->threads[t], NULL );
+    pthread_mutex_unlock( &pool->run );
+
+    pthread_cond_destroy( &pool->cond_done );
+    pthread_cond_destroy( &pool->cond_start );
+    pthread_mutex_destroy( &pool->mutex );
+    pthread_mutex_destroy( &pool->run );
+    free( pool->args );
+    free( pool->threads );
+    free( pool );
+}
+
+
+// execute "job" on all the threads and wait for its completion; concurrent calls
+// (e.g. A and A' used from different Python threads) are executed one at a time
+void COMMIT_pool_run( COMMIT_pool *pool, void (*job)( void*, int ), void *arg )
+{
+    int i;
+
+    pthread_mutex_lock( &pool->run );
+    if ( pool->n == 1 )
+    {
+        for(i=0; i<pool->jobs ; i++)
+            job( arg, i );
+        pthread_mutex_unlock( &pool->run );
+        return;
+    }
+
+    pthread_mutex_lock( &pool->mutex );
+    pool->job  = job;
+    pool->arg  = arg;
+    pool->busy = pool->n-1;
+    pool->generation++;
+    pthread_cond_broadcast( &pool->cond_start );
+    pthread_mutex_unlock( &pool->mutex );
+
+    for(i=0; i<pool->jobs ; i+=pool->n)
+        job( arg, i );
+
+    pthread_mutex_lock( &pool->mutex );
+    while( pool->busy > 0 )
+        pthread_cond_wait( &pool->cond_done, &pool->mutex );
+    pthread_mutex_unlock( &pool->mutex );
+    pthread_mutex_unlock( &pool->run );
+}
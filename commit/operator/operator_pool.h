@@ -0,0 +1,25 @@
+#ifndef COMMIT_OPERATOR_POOL_H
+#define COMMIT_OPERATOR_POOL_H
+
+/*
+    Persistent pool of workers used by the matrix-vector products.
+
+    The workers are created once (COMMIT_pool_create) and then sleep on a condition
+    variable; each product wakes them up with the function computing one sub-block,
+    which is executed with ids 1..n-1 by the workers and with id 0 by the calling
+    thread. COMMIT_pool_destroy wakes the workers for the last time and joins them.
+    Every LinearOperator (and its transpose) owns a reference to its own pool, so
+    operators with a different number of threads can coexist in the same process.
+    The products run one at a time on a pool (COMMIT_pool_run holds a mutex for its
+    whole duration, and COMMIT_pool_destroy waits for it), as A and A' share it. If
+    fewer workers than requested can be started, the n sub-blocks are shared among
+    those actually running.
+*/
+
+typedef struct COMMIT_pool COMMIT_pool;
+
+COMMIT_pool* COMMIT_pool_create( int n );
+void         COMMIT_pool_destroy( COMMIT_pool *pool );
+void         COMMIT_pool_run( COMMIT_pool *pool, void (*job)( void*, int ), void *arg );
+
+#endif
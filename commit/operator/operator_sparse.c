@@ -0,0 +1,24 @@
+#include <stddef.h> // size_t
+#include <stdint.h> // uint32_t etc
+#include "operator_pool.h"
+
+/*
+    Matrix-vector products with an explicit sparse matrix stored in CSR format, i.e. the
+    columns (idx) and values (val) of row r are in the range ptr[r]..ptr[r+1]-1. The rows
+    are split among the threads, so each thread writes only its own elements of the output;
+    A' is performed in the same way with the CSR representation of the transpose.
+*/
+
+// double precision
+#define REAL        double
+#define NAME(f)     f
+#include "operator_sparse.h"
+#undef REAL
+#undef NAME
+
+// single precision (the sums are still accumulated in double precision)
+#define REAL        float
+#define NAME(f)     f##_float
+#include "operator_sparse.h"
+#undef REAL
+#undef NAME
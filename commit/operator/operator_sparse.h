@@ -0,0 +1,84 @@
+/*
+    Body of the products, included by operator_sparse.c once for each precision of the
+    vectors x and y: REAL is their type and NAME(f) the name of the function f for it.
+*/
+
+/* parameters of a product, shared by all the threads */
+typedef struct
+{
+    int         nK;
+    size_t      nRows, nCols;
+    REAL        *x, *Y;
+    uint64_t    *ptr;
+    uint32_t    *idx;
+    float       *val;
+    uint32_t    *threads;
+} NAME(COMMIT_csr_product);
+
+
+// ====================================================================
+// Compute the rows threads[id]..threads[id+1]-1 of the product Y = M*x
+// ====================================================================
+static void NAME(COMMIT_csr__block)( void *ptr, int id )
+{
+    NAME(COMMIT_csr_product) *P = (NAME(COMMIT_csr_product)*) ptr;
+    const int    nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols;
+    int      k;
+    size_t   kX, kY, r, rEnd;
+    double   acc;
+    REAL     *x, *Y;
+    uint64_t *t_ptr;
+    uint32_t *t_idx, *t_idxEnd;
+    float    *t_val;
+
+    for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+    {
+        x = P->x + kX;
+        Y = P->Y + kY;
+        r     = P->threads[id];
+        rEnd  = P->threads[id+1];
+        t_ptr = P->ptr + r;
+        for( ; r<rEnd ; r++, t_ptr++ )
+        {
+            acc      = 0;
+            t_idx    = P->idx + t_ptr[0];
+            t_idxEnd = P->idx + t_ptr[1];
+            t_val    = P->val + t_ptr[0];
+            while( t_idx != t_idxEnd )
+                acc += (double)(*t_val++) * x[*t_idx++];
+            Y[r] = acc;
+        }
+    }
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_csr_dot)(
+    COMMIT_pool *_pool,
+    int _nK, int _nRows, int _nCols,
+    REAL *_vIN, REAL *_vOUT,
+    uint64_t *_ptr, uint32_t *_idx, float *_val,
+    uint32_t *_threads
+)
+{
+    NAME(COMMIT_csr_product) P;
+
+    P.nK    = _nK;
+    P.nRows = _nRows;
+    P.nCols = _nCols;
+
+    P.x = _vIN;
+    P.Y = _vOUT;
+
+    P.ptr = _ptr;
+    P.idx = _idx;
+    P.val = _val;
+
+    P.threads = _threads;
+
+    // Wake up the workers to perform the multiplication
+    COMMIT_pool_run( _pool, NAME(COMMIT_csr__block), &P );
+}
@@ -0,0 +1,40 @@
+#ifndef COMMIT_OPERATOR_STATS_H
+#define COMMIT_OPERATOR_STATS_H
+
+#include <time.h>
+
+/*
+    Optional counters of the matrix-vector products.
+
+    If a product is given a non-NULL "stats" array, the thread with id "id" accumulates
+    in stats[id*COMMIT_STATS_SIZE+k] the time (in seconds) spent in the IC, EC and ISO
+    compartments (k=0,1,2) and the number of IC segments, EC segments and voxels it
+    processed (k=3,4,5, counted once per column of x). Every thread writes only its own
+    row, so no synchronization is needed. With a NULL array nothing is measured and the
+    only cost is one test per compartment and thread, i.e. the counters are free when
+    disabled.
+*/
+
+#define COMMIT_STATS_SIZE 6
+
+static inline double COMMIT_stats_now( void )
+{
+    struct timespec ts;
+    clock_gettime( CLOCK_MONOTONIC, &ts );
+    return (double)ts.tv_sec + 1e-9*(double)ts.tv_nsec;
+}
+
+// start the clock of the current thread
+#define COMMIT_STATS_START(stats) \
+    double COMMIT_stats_t0 = ( (stats) != NULL ) ? COMMIT_stats_now() : 0;
+
+// charge to the compartment k the time since the last call and the "count" elements processed
+#define COMMIT_STATS_LAP(stats,id,k,count) \
+    if ( (stats) != NULL ) { \
+        double COMMIT_stats_t1 = COMMIT_stats_now(); \
+        (stats)[(id)*COMMIT_STATS_SIZE+(k)]   += COMMIT_stats_t1 - COMMIT_stats_t0; \
+        (stats)[(id)*COMMIT_STATS_SIZE+3+(k)] += (double)(count); \
+        COMMIT_stats_t0 = COMMIT_stats_t1; \
+    }
+
+#endif
@@ -0,0 +1,598 @@
+/*
+    Body of the products, included by operator_withLUT.c once for each precision of the
+    vectors x and y: REAL is their type and NAME(f) the name of the function f for it.
+*/
+
+/* parameters of a product, shared by all the threads */
+typedef struct
+{
+    int         nIC, nEC, nISO;
+    int         nF, n, nE, nV, nS, nO, nK;
+    size_t      nRows, nCols;
+    REAL        *x, *Y;
+    uint32_t    *ICthreads, *ECthreads, *ISOthreads;
+    uint32_t    *ICf, *ICv, *ECv, *ISOv;
+    uint16_t    *ICo, *ECo;
+    float       *ICl;
+    float       *wmrSFP, *wmhSFP, *isoSFP;
+    double      *stats;
+} NAME(COMMIT_product);
+
+
+
+// ====================================================
+// Compute a sub-block of the A*x MAtRIX-VECTOR product
+// ====================================================
+
+// intra-cellular compartments
+INLINE void NAME(COMMIT_A__IC)( NAME(COMMIT_product) *P, int id, const int nIC )
+{
+    const int    nF = P->nF, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols, LUTstride = (size_t)P->nO*nS;
+    int      i, s, k, nonzero;
+    size_t   kX, kY, offset;
+    double   x_[MAX_COMPARTMENTS], w, tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP;
+    uint32_t *t_v, *t_vEnd, *t_f;
+    uint16_t *t_o;
+    float    *t_l;
+
+    t_v    = P->ICv + P->ICthreads[id];
+    t_vEnd = P->ICv + P->ICthreads[id+1];
+    t_o    = P->ICo + P->ICthreads[id];
+    t_l    = P->ICl + P->ICthreads[id];
+    t_f    = P->ICf + P->ICthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            xPtr = P->x + kX + *t_f;
+            nonzero = 0;
+            for( i=0 ; i<nIC ; i++ )
+            {
+                x_[i] = xPtr[i*nF];
+                nonzero |= x_[i] != 0;
+            }
+            if ( nonzero )
+            {
+                Yptr   = P->Y + kY + (size_t)nS * (*t_v);
+                w      = (double)(*t_l);
+                offset = (size_t)nS * (*t_o);
+                SFP    = P->wmrSFP + offset;
+                for( s=0 ; s<nS ; s++ )
+                {
+                    tmp = x_[0] * SFP[s];
+                    for( i=1 ; i<nIC ; i++ )
+                        tmp += x_[i] * SFP[i*LUTstride+s];
+                    Yptr[s] += w * tmp;
+                }
+            }
+        }
+        t_f++;
+        t_v++;
+        t_o++;
+        t_l++;
+    }
+}
+
+// extra-cellular compartments
+INLINE void NAME(COMMIT_A__EC)( NAME(COMMIT_product) *P, int id, const int nEC )
+{
+    const int    nE = P->nE, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols, LUTstride = (size_t)P->nO*nS;
+    int      i, s, k, nonzero;
+    size_t   kX, kY;
+    double   x_[MAX_COMPARTMENTS], tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP;
+    uint32_t *t_v, *t_vEnd;
+    uint16_t *t_o;
+
+    t_v    = P->ECv + P->ECthreads[id];
+    t_vEnd = P->ECv + P->ECthreads[id+1];
+    t_o    = P->ECo + P->ECthreads[id];
+    xPtr   = P->x + (size_t)P->nIC*P->nF + P->ECthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            nonzero = 0;
+            for( i=0 ; i<nEC ; i++ )
+            {
+                x_[i] = xPtr[kX+i*nE];
+                nonzero |= x_[i] != 0;
+            }
+            if ( nonzero )
+            {
+                Yptr = P->Y + kY + (size_t)nS * (*t_v);
+                SFP  = P->wmhSFP + (size_t)nS * (*t_o);
+                for( s=0 ; s<nS ; s++ )
+                {
+                    tmp = x_[0] * SFP[s];
+                    for( i=1 ; i<nEC ; i++ )
+                        tmp += x_[i] * SFP[i*LUTstride+s];
+                    Yptr[s] += tmp;
+                }
+            }
+        }
+        xPtr++;
+        t_v++;
+        t_o++;
+    }
+}
+
+// isotropic compartments
+INLINE void NAME(COMMIT_A__ISO)( NAME(COMMIT_product) *P, int id, const int nISO )
+{
+    const int    nV = P->nV, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols;
+    int      i, s, k, nonzero;
+    size_t   kX, kY;
+    double   x_[MAX_COMPARTMENTS], tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP = P->isoSFP;
+    uint32_t *t_v, *t_vEnd;
+
+    t_v    = P->ISOv + P->ISOthreads[id];
+    t_vEnd = P->ISOv + P->ISOthreads[id+1];
+    xPtr   = P->x + (size_t)P->nIC*P->nF + (size_t)P->nEC*P->nE + P->ISOthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            nonzero = 0;
+            for( i=0 ; i<nISO ; i++ )
+            {
+                x_[i] = xPtr[kX+i*nV];
+                nonzero |= x_[i] != 0;
+            }
+            if ( nonzero )
+            {
+                Yptr = P->Y + kY + (size_t)nS * (*t_v);
+                for( s=0 ; s<nS ; s++ )
+                {
+                    tmp = x_[0] * SFP[s];
+                    for( i=1 ; i<nISO ; i++ )
+                        tmp += x_[i] * SFP[i*nS+s];
+                    Yptr[s] += tmp;
+                }
+            }
+        }
+        xPtr++;
+        t_v++;
+    }
+}
+
+static void NAME(COMMIT_A__block)( void *ptr, int id )
+{
+    NAME(COMMIT_product) *P = (NAME(COMMIT_product)*) ptr;
+    COMMIT_STATS_START( P->stats )
+    DISPATCH( NAME(COMMIT_A__IC),  P->nIC  )
+    COMMIT_STATS_LAP( P->stats, id, 0, P->nIC  ? (size_t)(P->ICthreads[id+1]-P->ICthreads[id])*P->nK : 0 )
+    DISPATCH( NAME(COMMIT_A__EC),  P->nEC  )
+    COMMIT_STATS_LAP( P->stats, id, 1, P->nEC  ? (size_t)(P->ECthreads[id+1]-P->ECthreads[id])*P->nK : 0 )
+    DISPATCH( NAME(COMMIT_A__ISO), P->nISO )
+    COMMIT_STATS_LAP( P->stats, id, 2, P->nISO ? (size_t)(P->ISOthreads[id+1]-P->ISOthreads[id])*P->nK : 0 )
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_A)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    REAL *_vIN, REAL *_vOUT,
+    uint32_t *_ICf, uint32_t *_ICv, uint16_t *_ICo, float *_ICl,
+    uint32_t *_ECv, uint16_t *_ECo,
+    uint32_t *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    uint32_t* _ICthreads, uint32_t* _ECthreads, uint32_t* _ISOthreads,
+    double *_stats
+)
+{
+    NAME(COMMIT_product) P;
+
+    P.nIC   = _nIC;
+    P.nEC   = _nEC;
+    P.nISO  = _nISO;
+    P.nF    = _nF;
+    P.n     = _n;
+    P.nE    = _nE;
+    P.nV    = _nV;
+    P.nS    = _nS;
+    P.nO    = _nO;
+    P.nK    = _nK;
+    P.nRows = _nRows;
+    P.nCols = _nCols;
+
+    P.x = _vIN;
+    P.Y = _vOUT;
+
+    P.ICf  = _ICf;
+    P.ICv  = _ICv;
+    P.ICo  = _ICo;
+    P.ICl  = _ICl;
+    P.ECv  = _ECv;
+    P.ECo  = _ECo;
+    P.ISOv = _ISOv;
+
+    P.wmrSFP = _wmrSFP;
+    P.wmhSFP = _wmhSFP;
+    P.isoSFP = _isoSFP;
+
+    P.ICthreads  = _ICthreads;
+    P.ECthreads  = _ECthreads;
+    P.ISOthreads = _ISOthreads;
+
+    P.stats = _stats;
+
+    // Wake up the workers to perform the multiplication
+    COMMIT_pool_run( _pool, NAME(COMMIT_A__block), &P );
+}
+
+
+
+/* ===================================================== */
+/* Compute a sub-block of the A'*y MAtRIX-VECTOR product */
+/* ===================================================== */
+
+// intra-cellular compartments
+INLINE void NAME(COMMIT_At__IC)( NAME(COMMIT_product) *P, int id, const int nIC )
+{
+    const int    nF = P->nF, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols, LUTstride = (size_t)P->nO*nS;
+    int      i, s, k;
+    size_t   kX, kY, offset;
+    double   x_[MAX_COMPARTMENTS], acc[MAX_COMPARTMENTS], w, Y_tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP;
+    uint32_t *t_v, *t_vEnd, *t_f, *r_v, *r_vEnd, *r_f;
+    uint16_t *t_o, *r_o;
+    float    *t_l, *r_l;
+
+    t_v    = P->ICv + P->ICthreads[id];
+    t_vEnd = P->ICv + P->ICthreads[id+1];
+    t_o    = P->ICo + P->ICthreads[id];
+    t_l    = P->ICl + P->ICthreads[id];
+    t_f    = P->ICf + P->ICthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        // the segments of a fiber are contiguous, hence their contributions are
+        // accumulated in double precision and x is updated once per fiber
+        for( r_vEnd=t_v+1, r_f=t_f+1 ; r_vEnd != t_vEnd && *r_f == *t_f ; r_vEnd++, r_f++ );
+
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            for( i=0 ; i<nIC ; i++ )
+                acc[i] = 0;
+            for( r_v=t_v, r_o=t_o, r_l=t_l ; r_v != r_vEnd ; r_v++, r_o++, r_l++ )
+            {
+                Yptr   = P->Y + kY + (size_t)nS * (*r_v);
+                offset = (size_t)nS * (*r_o);
+                SFP    = P->wmrSFP + offset;
+
+                Y_tmp = Yptr[0];
+                for( i=0 ; i<nIC ; i++ )
+                    x_[i] = SFP[i*LUTstride] * Y_tmp;
+                for( s=1 ; s<nS ; s++ )
+                {
+                    Y_tmp = Yptr[s];
+                    for( i=0 ; i<nIC ; i++ )
+                        x_[i] += SFP[i*LUTstride+s] * Y_tmp;
+                }
+
+                w = (double)(*r_l);
+                for( i=0 ; i<nIC ; i++ )
+                    acc[i] += w * x_[i];
+            }
+
+            xPtr = P->x + kX + *t_f;
+            for( i=0 ; i<nIC ; i++ )
+                xPtr[i*nF] += acc[i];
+        }
+        t_f += r_vEnd - t_v;
+        t_o += r_vEnd - t_v;
+        t_l += r_vEnd - t_v;
+        t_v  = r_vEnd;
+    }
+}
+
+// extra-cellular compartments
+INLINE void NAME(COMMIT_At__EC)( NAME(COMMIT_product) *P, int id, const int nEC )
+{
+    const int    nE = P->nE, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols, LUTstride = (size_t)P->nO*nS;
+    int      i, s, k;
+    size_t   kX, kY;
+    double   x_[MAX_COMPARTMENTS], Y_tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP;
+    uint32_t *t_v, *t_vEnd;
+    uint16_t *t_o;
+
+    t_v    = P->ECv + P->ECthreads[id];
+    t_vEnd = P->ECv + P->ECthreads[id+1];
+    t_o    = P->ECo + P->ECthreads[id];
+    xPtr   = P->x + (size_t)P->nIC*P->nF + P->ECthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            Yptr = P->Y + kY + (size_t)nS * (*t_v);
+            SFP  = P->wmhSFP + (size_t)nS * (*t_o);
+
+            Y_tmp = Yptr[0];
+            for( i=0 ; i<nEC ; i++ )
+                x_[i] = SFP[i*LUTstride] * Y_tmp;
+            for( s=1 ; s<nS ; s++ )
+            {
+                Y_tmp = Yptr[s];
+                for( i=0 ; i<nEC ; i++ )
+                    x_[i] += SFP[i*LUTstride+s] * Y_tmp;
+            }
+
+            for( i=0 ; i<nEC ; i++ )
+                xPtr[kX+i*nE] += x_[i];
+        }
+        xPtr++;
+        t_v++;
+        t_o++;
+    }
+}
+
+// isotropic compartments
+INLINE void NAME(COMMIT_At__ISO)( NAME(COMMIT_product) *P, int id, const int nISO )
+{
+    const int    nV = P->nV, nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows, nCols = P->nCols;
+    int      i, s, k;
+    size_t   kX, kY;
+    double   x_[MAX_COMPARTMENTS], Y_tmp;
+    REAL     *xPtr, *Yptr;
+    float    *SFP = P->isoSFP;
+    uint32_t *t_v, *t_vEnd;
+
+    t_v    = P->ISOv + P->ISOthreads[id];
+    t_vEnd = P->ISOv + P->ISOthreads[id+1];
+    xPtr   = P->x + (size_t)P->nIC*P->nF + (size_t)P->nEC*P->nE + P->ISOthreads[id];
+
+    while( t_v != t_vEnd )
+    {
+        for( k=0, kX=0, kY=0 ; k<nK ; k++, kX+=nCols, kY+=nRows )
+        {
+            Yptr = P->Y + kY + (size_t)nS * (*t_v);
+
+            Y_tmp = Yptr[0];
+            for( i=0 ; i<nISO ; i++ )
+                x_[i] = SFP[i*nS] * Y_tmp;
+            for( s=1 ; s<nS ; s++ )
+            {
+                Y_tmp = Yptr[s];
+                for( i=0 ; i<nISO ; i++ )
+                    x_[i] += SFP[i*nS+s] * Y_tmp;
+            }
+
+            for( i=0 ; i<nISO ; i++ )
+                xPtr[kX+i*nV] += x_[i];
+        }
+        xPtr++;
+        t_v++;
+    }
+}
+
+static void NAME(COMMIT_At__block)( void *ptr, int id )
+{
+    NAME(COMMIT_product) *P = (NAME(COMMIT_product)*) ptr;
+    COMMIT_STATS_START( P->stats )
+    DISPATCH( NAME(COMMIT_At__IC),  P->nIC  )
+    COMMIT_STATS_LAP( P->stats, id, 0, P->nIC  ? (size_t)(P->ICthreads[id+1]-P->ICthreads[id])*P->nK : 0 )
+    DISPATCH( NAME(COMMIT_At__EC),  P->nEC  )
+    COMMIT_STATS_LAP( P->stats, id, 1, P->nEC  ? (size_t)(P->ECthreads[id+1]-P->ECthreads[id])*P->nK : 0 )
+    DISPATCH( NAME(COMMIT_At__ISO), P->nISO )
+    COMMIT_STATS_LAP( P->stats, id, 2, P->nISO ? (size_t)(P->ISOthreads[id+1]-P->ISOthreads[id])*P->nK : 0 )
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_At)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    REAL *_vIN, REAL *_vOUT,
+    uint32_t *_ICf, uint32_t *_ICv, uint16_t *_ICo, float *_ICl,
+    uint32_t *_ECv, uint16_t *_ECo,
+    uint32_t *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    uint32_t* _ICthreadsT, uint32_t* _ECthreadsT, uint32_t* _ISOthreadsT,
+    double *_stats
+)
+{
+    NAME(COMMIT_product) P;
+
+    P.nIC   = _nIC;
+    P.nEC   = _nEC;
+    P.nISO  = _nISO;
+    P.nF    = _nF;
+    P.n     = _n;
+    P.nE    = _nE;
+    P.nV    = _nV;
+    P.nS    = _nS;
+    P.nO    = _nO;
+    P.nK    = _nK;
+    P.nRows = _nRows;
+    P.nCols = _nCols;
+
+    P.x = _vOUT;
+    P.Y = _vIN;
+
+    P.ICf  = _ICf;
+    P.ICv  = _ICv;
+    P.ICo  = _ICo;
+    P.ICl  = _ICl;
+    P.ECv  = _ECv;
+    P.ECo  = _ECo;
+    P.ISOv = _ISOv;
+
+    P.wmrSFP = _wmrSFP;
+    P.wmhSFP = _wmhSFP;
+    P.isoSFP = _isoSFP;
+
+    P.ICthreads  = _ICthreadsT;
+    P.ECthreads  = _ECthreadsT;
+    P.ISOthreads = _ISOthreadsT;
+
+    P.stats = _stats;
+
+    // Wake up the workers to perform the multiplication
+    COMMIT_pool_run( _pool, NAME(COMMIT_At__block), &P );
+}
+
+
+
+/* ============================================================ */
+/* Compute the gradient A'*(A*x-y) of the least-squares problem */
+/* ============================================================ */
+
+/* parameters of a gradient, shared by all the threads */
+typedef struct
+{
+    NAME(COMMIT_product) A;     // A*x, written in the residual
+    NAME(COMMIT_product) At;    // A'*res, with the EC and ISO parts split as in A
+    REAL                 *y;
+    double               *norms;
+} NAME(COMMIT_grad);
+
+// first pass, over the voxels of the thread (same split of the A*x product): the residual
+// of each voxel is computed and, while it is still in cache, multiplied by the EC and ISO
+// compartments of the voxel, which are written only by this thread
+// NB: the range of voxels of the thread is ISOthreads[id]..ISOthreads[id+1]-1, as the ISO
+//     contributions are one per voxel in increasing order
+static void NAME(COMMIT_gradient__block1)( void *ptr, int id )
+{
+    NAME(COMMIT_grad) *G = (NAME(COMMIT_grad)*) ptr;
+    NAME(COMMIT_product)  *P = &G->A;
+    const int    nS = P->nS, nK = P->nK;
+    const size_t nRows = P->nRows;
+    const size_t r0 = (size_t)nS * P->ISOthreads[id], r1 = (size_t)nS * P->ISOthreads[id+1];
+    int      k;
+    size_t   kY, r;
+    double   acc, tmp;
+    REAL     *Y, *y;
+
+    for( k=0, kY=0 ; k<nK ; k++, kY+=nRows )
+        memset( P->Y + kY + r0, 0, (r1-r0)*sizeof(REAL) );
+
+    DISPATCH( NAME(COMMIT_A__IC),  P->nIC  )
+    DISPATCH( NAME(COMMIT_A__EC),  P->nEC  )
+    DISPATCH( NAME(COMMIT_A__ISO), P->nISO )
+
+    for( k=0, kY=0 ; k<nK ; k++, kY+=nRows )
+    {
+        Y = P->Y + kY;
+        y = G->y + kY;
+        acc = 0;
+        for( r=r0 ; r<r1 ; r++ )
+        {
+            tmp  = (double)Y[r] - (double)y[r];
+            Y[r] = tmp;
+            acc += tmp * tmp;
+        }
+        G->norms[ (size_t)id*nK + k ] = acc;
+    }
+
+    P = &G->At;
+    DISPATCH( NAME(COMMIT_At__EC),  P->nEC  )
+    DISPATCH( NAME(COMMIT_At__ISO), P->nISO )
+}
+
+// second pass, over the fibers of the thread (same split of the A'*y product)
+static void NAME(COMMIT_gradient__block2)( void *ptr, int id )
+{
+    NAME(COMMIT_grad) *G = (NAME(COMMIT_grad)*) ptr;
+    NAME(COMMIT_product)  *P = &G->At;
+    DISPATCH( NAME(COMMIT_At__IC), P->nIC )
+}
+
+
+// =========================
+// Function called by CYTHON
+// =========================
+void NAME(COMMIT_gradient)(
+    COMMIT_pool *_pool, int _nIC, int _nEC, int _nISO,
+    int _nF, int _n, int _nE, int _nV, int _nS, int _nO,
+    int _nK, int _nRows, int _nCols,
+    REAL *_x, REAL *_y, REAL *_res, REAL *_grad, double *_norms,
+    uint32_t *_ICf, uint32_t *_ICv, uint16_t *_ICo, float *_ICl,
+    uint32_t *_ICfT, uint32_t *_ICvT, uint16_t *_ICoT, float *_IClT,
+    uint32_t *_ECv, uint16_t *_ECo,
+    uint32_t *_ISOv,
+    float *_wmrSFP, float *_wmhSFP, float *_isoSFP,
+    uint32_t* _ICthreads, uint32_t* _ECthreads, uint32_t* _ISOthreads,
+    uint32_t* _ICthreadsT
+)
+{
+    NAME(COMMIT_grad) G;
+
+    G.A.nIC   = _nIC;
+    G.A.nEC   = _nEC;
+    G.A.nISO  = _nISO;
+    G.A.nF    = _nF;
+    G.A.n     = _n;
+    G.A.nE    = _nE;
+    G.A.nV    = _nV;
+    G.A.nS    = _nS;
+    G.A.nO    = _nO;
+    G.A.nK    = _nK;
+    G.A.nRows = _nRows;
+    G.A.nCols = _nCols;
+
+    G.A.x = _x;
+    G.A.Y = _res;
+
+    G.A.ICf  = _ICf;
+    G.A.ICv  = _ICv;
+    G.A.ICo  = _ICo;
+    G.A.ICl  = _ICl;
+    G.A.ECv  = _ECv;
+    G.A.ECo  = _ECo;
+    G.A.ISOv = _ISOv;
+
+    G.A.wmrSFP = _wmrSFP;
+    G.A.wmhSFP = _wmhSFP;
+    G.A.isoSFP = _isoSFP;
+
+    G.A.ICthreads  = _ICthreads;
+    G.A.ECthreads  = _ECthreads;
+    G.A.ISOthreads = _ISOthreads;
+
+    G.A.stats = NULL;
+
+    // same data for A', but with the fiber-ordered copy of the IC segments
+    G.At = G.A;
+    G.At.x = _grad;
+    G.At.Y = _res;
+
+    G.At.ICf  = _ICfT;
+    G.At.ICv  = _ICvT;
+    G.At.ICo  = _ICoT;
+    G.At.ICl  = _IClT;
+
+    G.At.ICthreads = _ICthreadsT;
+
+    G.y     = _y;
+    G.norms = _norms;
+
+    // Wake up the workers twice, as the IC part of A' needs the complete residual
+    COMMIT_pool_run( _pool, NAME(COMMIT_gradient__block1), &G );
+    COMMIT_pool_run( _pool, NAME(COMMIT_gradient__block2), &G );
+}
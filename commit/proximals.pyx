@@ -5,20 +5,30 @@ Author: Matteo Frigo - lts5 @ EPFL and Dep. of CS @ Univ. of Verona
 
 This structure is based on the previous work of Rafael Carrillo and was
 supported by the LTS5 laboratory at EPFL, Lausanne.
+
+The functions accept vectors of both np.float64 and np.float32; in the latter case
+the norms are still accumulated in double precision.
+
+prox_compartments and omega_compartments handle all the compartments at once and
+work in place without the GIL, as do prox_groups and omega_groups for the group
+sparsity, which take the groups compiled by group_structure and process the
+disjoint ones in parallel with OpenMP; the other functions return a modified copy.
 """
 cimport cython
 import numpy as np
 cimport numpy as np
-from math import sqrt
+from libc.math cimport sqrt
+from cython.parallel cimport prange
 import sys
+from cython cimport floating
 
 
-cpdef non_negativity(np.ndarray[np.float64_t] x, int compartment_start, int compartment_size):
+cpdef non_negativity(np.ndarray[floating] x, int compartment_start, int compartment_size):
     """
     POCS for the first orthant (non-negativity)
     """
     cdef:
-        np.ndarray[np.float64_t] v
+        np.ndarray[floating] v
         size_t i
     v = x.copy()
     for i in range(compartment_start, compartment_start+compartment_size):
@@ -27,13 +37,13 @@ cpdef non_negativity(np.ndarray[np.float64_t] x, int compartment_start, int comp
     return v
 
 
-cpdef soft_thresholding(np.ndarray[np.float64_t] x, double lam, int compartment_start, int compartment_size) :
+cpdef soft_thresholding(np.ndarray[floating] x, double lam, int compartment_start, int compartment_size) :
     """
     Proximal of L1 norm
     """
     # NB: this preserves non-negativity
     cdef:
-        np.ndarray[np.float64_t] v
+        np.ndarray[floating] v
         size_t i
     v = x.copy()
     for i in range(compartment_start, compartment_start+compartment_size):
@@ -44,38 +54,124 @@ cpdef soft_thresholding(np.ndarray[np.float64_t] x, double lam, int compartment_
     return v
 
 
-cpdef projection_onto_l2_ball(np.ndarray[np.float64_t] x, double lam, int compartment_start, int compartment_size) :
+cpdef projection_onto_l2_ball(np.ndarray[floating] x, double lam, int compartment_start, int compartment_size) :
     """
     Proximal of L2 norm
     """
     # NB: this preserves non-negativity
     cdef:
-        np.float64_t xn
-        np.ndarray[np.float64_t] v
+        np.float64_t xn = 0.0
+        np.ndarray[floating] v
         size_t i
     v = x.copy()
-    xn = sqrt(sum(v[compartment_start:compartment_start+compartment_size]**2))
+    for i in range(compartment_start, compartment_start+compartment_size):
+        xn += <double>v[i] * v[i]
+    xn = sqrt(xn)
     if xn > lam:
         for i in range(compartment_start, compartment_start+compartment_size):
             v[i] = v[i]/xn*lam
     return v
 
 
-cpdef omega_group_sparsity(np.ndarray[np.float64_t] v, np.ndarray[object] subtree, np.ndarray[np.float64_t] weight, double lam, double n) :
+cdef inline void _clip( floating[::1] x, Py_ssize_t start, Py_ssize_t end ) nogil :
+    cdef Py_ssize_t i
+    for i in range(start, end):
+        if x[i] < 0.0:
+            x[i] = 0.0
+
+
+cpdef prox_compartments( floating[::1] x, Py_ssize_t[:,::1] compartments, int[::1] norms, double[::1] lambdas ) :
+    """
+    Proximal of the penalties of the compartments followed by the projection onto
+    the first orthant, computed in place with one pass over x (two over the
+    compartments penalised with the L2 norm, whose norm is needed first).
+
+    The compartment c spans compartments[c,1] entries starting at compartments[c,0]
+    and is penalised by lambdas[c] times the norm norms[c], i.e. 0 (non-negativity
+    only), 1 (L1 norm) or 2 (L2 norm). The compartments must be sorted and disjoint;
+    the entries outside them are only made non-negative. The result is the same as
+    non_negativity() applied after soft_thresholding() or projection_onto_l2_ball()
+    on each compartment.
+    """
+    cdef:
+        Py_ssize_t c, i, start, end, pos = 0
+        double lam, xn, v
+
+    with nogil:
+        for c in range(compartments.shape[0]):
+            start = compartments[c,0]
+            end   = start + compartments[c,1]
+            lam   = lambdas[c]
+            _clip( x, pos, start )
+            if norms[c] == 1 and lam > 0.0:
+                for i in range(start, end):
+                    if x[i] <= lam:
+                        x[i] = 0.0
+                    else:
+                        x[i] -= lam
+            elif norms[c] == 2 and lam > 0.0:
+                xn = 0.0
+                for i in range(start, end):
+                    xn += <double>x[i] * x[i]
+                xn = sqrt(xn)
+                if xn > lam:
+                    for i in range(start, end):
+                        v = x[i]/xn*lam
+                        x[i] = v if v > 0.0 else 0.0
+                else:
+                    _clip( x, start, end )
+            else:
+                _clip( x, start, end )
+            pos = end
+        _clip( x, pos, x.shape[0] )
+
+
+cpdef double omega_compartments( floating[::1] x, Py_ssize_t[:,::1] compartments, int[::1] norms, double[::1] lambdas ) :
+    """
+    Penalty of the compartments described as in prox_compartments, i.e. the sum of
+    lambdas[c] times the L1 or L2 norm of each compartment; as x is non-negative after
+    the proximal step, the L1 norm is computed as the plain sum of the entries.
+    """
+    cdef:
+        Py_ssize_t c, i, start, end
+        double acc, tot = 0.0
+
+    with nogil:
+        for c in range(compartments.shape[0]):
+            if lambdas[c] == 0.0 or ( norms[c] != 1 and norms[c] != 2 ):
+                continue
+            start = compartments[c,0]
+            end   = start + compartments[c,1]
+            acc = 0.0
+            if norms[c] == 1:
+                for i in range(start, end):
+                    acc += x[i]
+            else:
+                for i in range(start, end):
+                    acc += <double>x[i] * x[i]
+                acc = sqrt(acc)
+            tot += lambdas[c] * acc
+    return tot
+
+
+cpdef omega_group_sparsity(np.ndarray[floating] v, np.ndarray[object] subtree, np.ndarray[np.float64_t] weight, double lam, double n) :
     """
     References:
         [1] Jenatton et al. - `Proximal Methods for Hierarchical Sparse Coding`
     """
     cdef:
         int nG = weight.size
-        size_t k
-        double tmp = 0.0
+        size_t k, i
+        double tmp = 0.0, xn
 
     if lam != 0:
         if n == 2:
             for k in range(nG):
                 idx = subtree[k]
-                tmp += weight[k] * sqrt( sum(v[idx]**2) )
+                xn = 0.0
+                for i in idx:
+                    xn += <double>v[i] * v[i]
+                tmp += weight[k] * sqrt( xn )
         elif n == np.Inf:
             for k in range(nG):
                 idx = subtree[k]
@@ -83,13 +179,13 @@ cpdef omega_group_sparsity(np.ndarray[np.float64_t] v, np.ndarray[object] subtre
     return lam*tmp
 
 
-cpdef prox_group_sparsity( np.ndarray[np.float64_t] x, np.ndarray[object] subtree, np.ndarray[np.float64_t] weight, double lam, double n ) :
+cpdef prox_group_sparsity( np.ndarray[floating] x, np.ndarray[object] subtree, np.ndarray[np.float64_t] weight, double lam, double n ) :
     """
     References:
         [1] Jenatton et al. - `Proximal Methods for Hierarchical Sparse Coding`
     """
     cdef:
-        np.ndarray[np.float64_t] v
+        np.ndarray[floating] v
         int nG = weight.size
         size_t k, i
         double r, xn
@@ -111,7 +207,10 @@ cpdef prox_group_sparsity( np.ndarray[np.float64_t] x, np.ndarray[object] subtre
         if n == 2:
             for k in range(nG):
                 idx = subtree[k]
-                xn = sqrt( sum(v[idx]**2) )
+                xn = 0.0
+                for i in idx:
+                    xn += <double>v[i] * v[i]
+                xn = sqrt( xn )
                 r = weight[k] * lam
                 if xn > r:
                     r = (xn-r)/xn
@@ -121,3 +220,152 @@ cpdef prox_group_sparsity( np.ndarray[np.float64_t] x, np.ndarray[object] subtre
                     for i in idx:
                         v[i] = 0.0
     return v
+
+
+def group_structure( structure, weights ) :
+    """
+    Compile the groups of the group sparsity in the flat layout used by prox_groups
+    and omega_groups: group g holds indices[indptr[g]:indptr[g+1]] and has weight
+    weights[g].
+
+    If the groups overlap, e.g. in a hierarchical structure, they are first sorted by
+    size, so that every group comes after those nested in it as required by [1]. The
+    groups are then split in levels, each made of disjoint groups that can be processed
+    in parallel: a group belongs to the level following the last one holding a group
+    that overlaps with it, hence the overlapping groups keep their order.
+
+    Returns
+    -------
+    indptr, indices, weights, levels : np.ndarray
+        The groups of level l are those from levels[l] to levels[l+1]
+
+    References:
+        [1] Jenatton et al. - `Proximal Methods for Hierarchical Sparse Coding`
+    """
+    cdef:
+        Py_ssize_t[::1] ptr, idx, last, lvl
+        Py_ssize_t g, k, l, nG = len(structure)
+
+    if len(weights) != nG:
+        raise ValueError('Number of groups and weights do not coincide.')
+    sizes = np.array( [ len(grp) for grp in structure ], dtype=np.intp )
+    indices = np.concatenate( [ np.asarray(grp, dtype=np.intp).ravel() for grp in structure ] ) if nG > 0 else np.zeros( 0, dtype=np.intp )
+    weights = np.ascontiguousarray( weights, dtype=np.float64 )
+    if indices.size > 0 and indices.min() < 0:
+        raise ValueError('The groups must contain non-negative indices.')
+
+    if np.unique( indices ).size < indices.size:
+        order   = np.argsort( sizes, kind='mergesort' )
+        starts  = np.cumsum( sizes ) - sizes
+        indices = _gather( indices, starts[order], sizes[order] )
+        sizes   = sizes[order]
+        weights = weights[order]
+    indptr = np.zeros( nG+1, dtype=np.intp )
+    np.cumsum( sizes, out=indptr[1:] )
+
+    level = np.zeros( nG, dtype=np.intp )
+    ptr, idx, lvl = indptr, indices, level
+    last = np.zeros( indices.max()+1 if indices.size > 0 else 0, dtype=np.intp )
+    with nogil:
+        for g in range(nG):
+            l = 0
+            for k in range(ptr[g], ptr[g+1]):
+                if last[idx[k]] > l:
+                    l = last[idx[k]]
+            lvl[g] = l
+            for k in range(ptr[g], ptr[g+1]):
+                last[idx[k]] = l+1
+
+    order   = np.argsort( level, kind='mergesort' )
+    indices = _gather( indices, indptr[:nG][order], sizes[order] )
+    np.cumsum( sizes[order], out=indptr[1:] )
+    weights = np.ascontiguousarray( weights[order] )
+    levels  = np.searchsorted( level[order], np.arange( level.max()+2 if nG > 0 else 1 ) ).astype( np.intp )
+    return indptr, indices, weights, levels
+
+
+def _gather( indices, starts, sizes ) :
+    """Concatenate the slices of indices with the given starts and sizes."""
+    offsets = np.cumsum( sizes ) - sizes
+    return np.ascontiguousarray( indices[ np.repeat( starts - offsets, sizes ) + np.arange( sizes.sum(), dtype=np.intp ) ] )
+
+
+cdef inline double _group_norm( floating[::1] x, Py_ssize_t[::1] indptr, Py_ssize_t[::1] indices, Py_ssize_t g, bint use_max ) nogil :
+    cdef:
+        Py_ssize_t k
+        double xn = 0.0
+    if indptr[g] == indptr[g+1]:
+        return 0.0
+    if use_max:
+        xn = x[indices[indptr[g]]]
+        for k in range(indptr[g]+1, indptr[g+1]):
+            if x[indices[k]] > xn:
+                xn = x[indices[k]]
+        return xn
+    for k in range(indptr[g], indptr[g+1]):
+        xn += <double>x[indices[k]] * x[indices[k]]
+    return sqrt( xn )
+
+
+cdef inline void _prox_group( floating[::1] x, Py_ssize_t[::1] indptr, Py_ssize_t[::1] indices, Py_ssize_t g, double r, bint use_max ) nogil :
+    cdef:
+        Py_ssize_t k
+        double xn
+    if use_max:
+        for k in range(indptr[g], indptr[g+1]):
+            if x[indices[k]] <= r:
+                x[indices[k]] = 0.0
+            else:
+                x[indices[k]] -= r
+        return
+    xn = _group_norm( x, indptr, indices, g, False )
+    if xn > r:
+        r = (xn-r)/xn
+        for k in range(indptr[g], indptr[g+1]):
+            x[indices[k]] *= r
+    else:
+        for k in range(indptr[g], indptr[g+1]):
+            x[indices[k]] = 0.0
+
+
+cpdef prox_groups( floating[::1] x, Py_ssize_t[::1] indptr, Py_ssize_t[::1] indices, double[::1] weights, Py_ssize_t[::1] levels, double lam, double n ) :
+    """
+    Proximal of the group sparsity penalty, in place, with the groups compiled by
+    group_structure; the groups of each level are processed in parallel. Same as
+    prox_group_sparsity, except that x must already be non-negative.
+    """
+    cdef:
+        Py_ssize_t l, g, start, end
+        bint use_max = n == np.inf
+
+    if lam == 0:
+        return
+    with nogil:
+        for l in range(levels.shape[0]-1):
+            start = levels[l]
+            end   = levels[l+1]
+            for g in prange(start, end, schedule='guided'):
+                _prox_group( x, indptr, indices, g, weights[g]*lam, use_max )
+
+
+cpdef double omega_groups( floating[::1] x, Py_ssize_t[::1] indptr, Py_ssize_t[::1] indices, double[::1] weights, double lam, double n ) :
+    """
+    Group sparsity penalty with the groups compiled by group_structure, computed in
+    parallel; the norms of the groups are summed in their order, hence the result does
+    not depend on the number of threads. Same as omega_group_sparsity.
+    """
+    cdef:
+        Py_ssize_t g, nG = weights.shape[0]
+        bint use_max = n == np.inf
+        double tot = 0.0
+        double[::1] val
+
+    if lam == 0 or nG == 0:
+        return 0.0
+    val = np.empty( nG, dtype=np.float64 )
+    with nogil:
+        for g in prange(nG, schedule='guided'):
+            val[g] = weights[g] * _group_norm( x, indptr, indices, g, use_max )
+        for g in range(nG):
+            tot += val[g]
+    return lam*tot
@@ -6,7 +6,10 @@ supported by the LTS5 laboratory at EPFL, Lausanne.
 """
 import numpy as np
 from math import sqrt
+import os
+from os.path import join as pjoin, exists
 import sys
+import time
 import warnings
 eps = np.finfo(float).eps
 
@@ -14,7 +17,13 @@ from commit.proximals import (non_negativity,
                              omega_group_sparsity,
                              prox_group_sparsity,
                              soft_thresholding,
-                             projection_onto_l2_ball)
+                             projection_onto_l2_ball,
+                             prox_compartments,
+                             omega_compartments,
+                             group_structure,
+                             prox_groups,
+                             omega_groups)
+from commit.history import HistoryWriter, FILENAME as HISTORY_FILENAME
 group_sparsity = -1
 non_negative = 0
 norm1 = 1
@@ -80,6 +89,9 @@ def init_regularisation(commit_evaluation,
                         [0,2,5]       [1,3,4]
                 which has two non overlapping groups, one of which is the union
                 of two other non-overlapping groups.
+            If the groups overlap, they are processed from the smallest to the
+            largest, i.e. every group after those nested in it, whatever their
+            order in structureIC; disjoint groups are processed in parallel.
 
 
     weightsIC - np.array(np.float64) :
@@ -130,6 +142,20 @@ def init_regularisation(commit_evaluation,
     regularisation['lambdaEC']  = float( lambdas[1] )
     regularisation['lambdaISO'] = float( lambdas[2] )
 
+    # the groups refer to the fibers of the input tractogram, which may have been
+    # reordered when loading the dictionary (see DICTIONARY['TRK']['perm'])
+    perm = commit_evaluation.DICTIONARY['TRK'].get('perm')
+    if structureIC is not None and perm is not None:
+        if group_is_ordered:
+            bundles = np.insert(structureIC,0,0)
+            structureIC = [np.arange(sum(bundles[:k+1]),sum(bundles[:k+1])+bundles[k+1]) for k in range(len(bundles)-1)]
+            group_is_ordered = False
+            del bundles
+        inv = np.zeros(perm.size, dtype=np.int64)
+        inv[perm] = np.arange(perm.size)
+        structureIC = np.array([inv[np.asarray(g, dtype=np.int64)] for g in structureIC])
+        del inv
+
     # Solver-specific fields
     regularisation['group_is_ordered'] = group_is_ordered  # This option will be deprecated in future release
     regularisation['structureIC']      = structureIC
@@ -139,7 +165,18 @@ def init_regularisation(commit_evaluation,
     return regularisation
 
 
+_NO_COMPARTMENTS = ( np.zeros( (0,2), dtype=np.intp ), np.zeros( 0, dtype=np.intc ), np.zeros( 0, dtype=np.float64 ) )
+
+def _nonnegativity_inplace(x):
+    prox_compartments( x, *_NO_COMPARTMENTS )
+    return x
+
 def regularisation2omegaprox(regularisation):
+    """
+    Penalty Omega and its proximal operator for the given regularisation (see
+    init_regularisation). The proximal operator works in place on a contiguous
+    vector of np.float64 or np.float32, which it also returns.
+    """
     lambdaIC  = float(regularisation.get('lambdaIC'))
     lambdaEC  = float(regularisation.get('lambdaEC'))
     lambdaISO = float(regularisation.get('lambdaISO'))
@@ -159,26 +196,36 @@ def regularisation2omegaprox(regularisation):
     ## NNLS case
     if (lambdaIC == 0.0 and lambdaEC == 0.0 and lambdaISO == 0.0) or (normIC == non_negative and normEC == non_negative and normISO == non_negative):
         omega = lambda x: 0.0
-        prox  = lambda x: non_negativity(x, 0, len(x))
+        prox  = _nonnegativity_inplace
         return omega, prox
 
     ## All other cases
-    # Intracellular Compartment
-    startIC = regularisation.get('startIC')
-    sizeIC  = regularisation.get('sizeIC')
-    if lambdaIC == 0.0:
-        omegaIC = lambda x: 0.0
-        proxIC  = lambda x: x
-    elif normIC == norm2:
-        omegaIC = lambda x: lambdaIC * np.linalg.norm(x[startIC:sizeIC])
-        proxIC  = lambda x: projection_onto_l2_ball(x, lambdaIC, startIC, sizeIC)
-    elif normIC == norm1:
-        omegaIC = lambda x: lambdaIC * sum( x[startIC:sizeIC] )
-        proxIC  = lambda x: soft_thresholding(x, lambdaIC, startIC, sizeIC)
-    elif normIC == non_negative:
-        omegaIC = lambda x: 0.0
-        proxIC  = lambda x: non_negativity(x, startIC, sizeIC)
-    elif normIC == group_sparsity:
+    # The norm1, norm2 and non-negativity penalties of all the compartments, followed by
+    # the non-negativity of the whole vector, are applied in place by a single kernel;
+    # the group sparsity of the IC compartment is applied after it
+    compartments = []
+    for c, lam, norm in [('IC', lambdaIC, normIC), ('EC', lambdaEC, normEC), ('ISO', lambdaISO, normISO)]:
+        if norm == group_sparsity and c != 'IC':
+            raise ValueError('Type of regularisation for %s compartment not recognized.' % c)
+        if lam == 0.0 or norm == group_sparsity:
+            norm = non_negative
+        compartments.append( (int(regularisation.get('start'+c)), int(regularisation.get('size'+c)), norm, lam) )
+    compartments.sort()
+    for i in range(1, len(compartments)):
+        if compartments[i][0] < compartments[i-1][0] + compartments[i-1][1]:
+            raise ValueError('The compartments must not overlap.')
+    bounds  = np.array( [c[:2] for c in compartments], dtype=np.intp ).reshape( (-1,2) )
+    norms   = np.array( [c[2] for c in compartments], dtype=np.intc )
+    lambdas = np.array( [c[3] for c in compartments], dtype=np.float64 )
+
+    def omega(x):
+        return omega_compartments( np.ascontiguousarray(x), bounds, norms, lambdas )
+
+    def prox(x):
+        prox_compartments( x, bounds, norms, lambdas )
+        return x
+
+    if normIC == group_sparsity and lambdaIC != 0.0:
         weightsIC   = regularisation.get('weightsIC')
         structureIC = regularisation.get('structureIC')
         if regularisation.get('group_is_ordered'): # This option will be deprecated in future release
@@ -194,50 +241,17 @@ def regularisation2omegaprox(regularisation):
         if not group_norm in list_group_sparsity_norms:
             raise ValueError('Wrong norm in the structured sparsity term. Choose between %s.' % str(list_group_sparsity_norms))
 
-        omegaIC = lambda x: omega_group_sparsity( x, structureIC, weightsIC, lambdaIC, group_norm )
-        proxIC  = lambda x:  prox_group_sparsity( x, structureIC, weightsIC, lambdaIC, group_norm )
-    else:
-        raise ValueError('Type of regularisation for IC compartment not recognized.')
-
-
-    # Extracellular Compartment
-    startEC = regularisation.get('startEC')
-    sizeEC  = regularisation.get('sizeEC')
-    if lambdaEC == 0.0:
-        omegaEC = lambda x: 0.0
-        proxEC  = lambda x: x
-    elif normEC == norm2:
-        omegaEC = lambda x: lambdaEC * np.linalg.norm(x[startEC:sizeEC])
-        proxEC  = lambda x: projection_onto_l2_ball(x, lambdaEC, startEC, sizeEC)
-    elif normEC == norm1:
-        omegaEC = lambda x: lambdaEC * sum( x[startEC:sizeEC] )
-        proxEC  = lambda x: soft_thresholding(x, lambdaEC, startEC, sizeEC)
-    elif normEC == non_negative:
-        omegaEC = lambda x: 0.0
-        proxEC  = lambda x: non_negativity(x, startEC, sizeEC)
-    else:
-        raise ValueError('Type of regularisation for EC compartment not recognized.')
-
-    # Isotropic Compartment
-    startISO = regularisation.get('startISO')
-    sizeISO  = regularisation.get('sizeISO')
-    if lambdaISO == 0.0:
-        omegaISO = lambda x: 0.0
-        proxISO  = lambda x: x
-    elif normISO == norm2:
-        omegaISO = lambda x: lambdaISO * np.linalg.norm(x[startISO:sizeISO])
-        proxISO  = lambda x: projection_onto_l2_ball(x, lambdaISO, startISO, sizeISO)
-    elif normISO == norm1:
-        omegaISO = lambda x: lambdaISO * sum( x[startISO:sizeISO] )
-        proxISO  = lambda x: soft_thresholding(x, lambdaISO, startISO, sizeISO)
-    elif normISO == non_negative:
-        omegaISO = lambda x: 0.0
-        proxISO  = lambda x: non_negativity(x, startISO, sizeISO)
-    else:
-        raise ValueError('Type of regularisation for ISO compartment not recognized.')
+        # the groups are compiled once in a flat layout, split in levels of disjoint groups
+        indptr, indices, weights, levels = group_structure(structureIC, weightsIC)
+        if indices.size > 0 and indices.max() >= int(regularisation.get('startIC')) + int(regularisation.get('sizeIC')):
+            raise ValueError('The groups must contain indices of the IC compartment.')
 
-    omega = lambda x: omegaIC(x) + omegaEC(x) + omegaISO(x)
-    prox = lambda x: non_negativity(proxIC(proxEC(proxISO(x))),0,x.size) # non negativity is redunduntly forced
+        omega_fused, prox_fused = omega, prox
+        omega = lambda x: omega_fused(x) + omega_groups( np.ascontiguousarray(x), indptr, indices, weights, lambdaIC, group_norm )
+        def prox(x):
+            prox_fused(x)
+            prox_groups( x, indptr, indices, weights, levels, lambdaIC, group_norm )
+            return x
 
     return omega, prox
 
@@ -250,7 +264,7 @@ def evaluate_model(y, A, x, regularisation = None):
 
     return 0.5*np.linalg.norm(A.dot(x)-y)**2 + omega(x)
 
-def solve(y, A, At, tol_fun = 1e-4, tol_x = 1e-6, max_iter = 1000, verbose = 1, x0 = None, regularisation = None, coeff_path = None, save_x_interval = None):
+def solve(y, A, At, tol_fun = 1e-4, tol_x = 1e-6, max_iter = 1000, verbose = 1, x0 = None, regularisation = None, coeff_path = None, save_x_interval = None, L = None, L_tol = 1e-3, solver = 'fista', screen_interval = 0, restart = None, monotone = False, callback = None, checkpoint = None):
     """
     Solve the regularised least squares problem
 
@@ -258,21 +272,311 @@ def solve(y, A, At, tol_fun = 1e-4, tol_x = 1e-6, max_iter = 1000, verbose = 1,
 
     with the Omega described by 'regularisation'.
 
+    If y is a 2D array, each of its columns defines an independent problem
+    with the same A and Omega; all the problems are solved at once and x
+    has one column per problem.
+
+    If y is np.float32, the problem is solved in single precision (see fista).
+
+    The step size is 1/L, with L the Lipschitz constant of the gradient, i.e.
+    ||A||_2^2; if L is None, it is estimated with estimate_lipschitz() up to the
+    relative tolerance L_tol. The step used to be 1.9 over a cruder estimate of L;
+    as the proximal operators apply the penalty without scaling it by the step,
+    the solutions with a regularisation differ from those of the older step.
+
+    The algorithm is chosen by name among those in commit.solvers.SOLVERS
+    (see register_solver):
+        'fista' : any regularisation (default)
+        'lbfgs' : projected quasi-Newton method, only for the non-negative
+                  least squares problem (see nnls_lbfgs)
+
+    For the non-negative least squares problem, 'fista' can discard every
+    screen_interval iterations the columns whose coefficients are proven to
+    be zero at the solution (see gap_safe_screening); 0 disables it. The test
+    removes columns only close to the solution, hence it is a late-stage
+    feature: it rarely saves products, unless the tolerances are very tight.
+
+    The momentum of 'fista' can be reset when it stops helping (restart =
+    'function' or 'gradient'), and the objective can be made non-increasing
+    (monotone = True); see fista.
+
+    If callback is given, it is called at every iteration with a dictionary
+    that describes it (timings, products, step size and stopping metrics);
+    see commit.telemetry for the fields and for sinks that write them to file.
+
+    With 'fista', the state of the solver can be saved periodically and a run
+    continued from it (see the checkpoint argument of fista).
+
     Check the documentation of commit.solvers.init_regularisation to see how to
     solve a specific problem.
     """
+    if solver not in SOLVERS:
+        raise ValueError('Solver "%s" not recognized; available: %s' % (solver, ', '.join(sorted(SOLVERS))))
+
+    if x0 is None:
+        x0 = np.zeros( (A.shape[1],) + y.shape[1:], dtype=y.dtype )
+
+    return SOLVERS[solver]( y, A, At, tol_fun = tol_fun, tol_x = tol_x, max_iter = max_iter, verbose = verbose, x0 = x0,
+                            regularisation = regularisation, coeff_path = coeff_path, save_x_interval = save_x_interval, L = L, L_tol = L_tol,
+                            screen_interval = screen_interval, restart = restart, monotone = monotone, callback = callback,
+                            checkpoint = checkpoint )
+
+def register_solver(name, function):
+    """
+    Make a solver available to solve() and Evaluation.fit() with the given name.
+    The function is called as
+
+        x, opt_details = function(y, A, At, tol_fun = ..., tol_x = ..., max_iter = ...,
+                                  verbose = ..., x0 = ..., regularisation = ...,
+                                  coeff_path = ..., save_x_interval = ..., L = ..., L_tol = ...,
+                                  screen_interval = ..., restart = ..., monotone = ...,
+                                  callback = ..., checkpoint = ...)
+
+    with the arguments of solve(); it can ignore those it does not need. It must
+    raise ValueError if it cannot handle the given regularisation.
+    """
+    SOLVERS[name] = function
+
+def is_nnls(regularisation):
+    """True if the regularisation only constrains the coefficients to be non-negative."""
+    if regularisation is None:
+        return True
+    for c in ['IC', 'EC', 'ISO']:
+        if regularisation['lambda'+c] != 0.0 and regularisation['norm'+c] != non_negative:
+            return False
+    return True
+
+def _solve_fista(y, A, At, tol_fun, tol_x, max_iter, verbose, x0, regularisation, coeff_path, save_x_interval, L, L_tol, screen_interval = 0, restart = None, monotone = False, callback = None, checkpoint = None):
     if regularisation is None:
         omega = lambda x: 0.0
-        prox  = lambda x: non_negativity(x, 0, x.size)
+        prox  = _nonnegativity_inplace
     else:
         omega, prox = regularisation2omegaprox(regularisation)
+    if screen_interval > 0 and not is_nnls(regularisation):
+        warnings.warn('Screening is available only for the non-negative least squares problem; disabled.')
+        screen_interval = 0
+    try:
+        return fista( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, omega, prox, coeff_path, save_x_interval, L, L_tol, screen_interval, restart, monotone, callback, checkpoint )
+    finally:
+        # the working set of the operator is restricted only during the solution
+        if screen_interval > 0 and hasattr(A, 'set_mask'):
+            A.set_mask( None )
+
+def _solve_nnls_lbfgs(y, A, At, tol_fun, tol_x, max_iter, verbose, x0, regularisation, coeff_path, save_x_interval, callback = None, checkpoint = None, **kwargs):
+    if not is_nnls(regularisation):
+        raise ValueError('The "lbfgs" solver supports only the non-negativity constraint; use "fista".')
+    if checkpoint is not None:
+        warnings.warn('Checkpoints are available only with the "fista" solver; ignored.')
+    return nnls_lbfgs( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, coeff_path, save_x_interval, callback = callback )
+
+def _dot( A, v, out ) :
+    """Compute A.dot(v) in the preallocated array out (also returned); operators whose
+    dot() does not accept the out parameter are supported with a copy."""
+    try :
+        return A.dot( v, out=out )
+    except ( TypeError, ValueError ) :
+        out[...] = A.dot( v ).reshape( out.shape )
+        return out
+
+def _timed_dot( A, v, out, clock, key ) :
+    """_dot() that adds the time it takes to clock[key]."""
+    tic = time.time()
+    _dot( A, v, out )
+    clock[key] += time.time() - tic
+    return out
+
+def solve_path(y, A, At, regularisation, lambdas, tol_fun = 1e-4, tol_x = 1e-6, max_iter = 1000, verbose = 1, x0 = None, L = None, L_tol = 1e-3, validation = None, patience = 1, solver = 'fista'):
+    """
+    Solve the problem of solve() for a sequence of regularisation parameters,
+    from the largest to the smallest, starting each solution from the previous
+    one and computing the step size only once.
 
-    if x0 is None:
-        x0 = np.zeros(A.shape[1])
+    Input
+    -----
+    regularisation - dict :
+        output of commit.solvers.init_regularisation; its lambdas are replaced
+        by those of the path.
+
+    lambdas - list :
+        regularisation parameters of the path; each element is either a tuple
+        (lambdaIC, lambdaEC, lambdaISO) or a number used for all the compartments.
+        They are solved in decreasing order of their sum.
+
+    validation - function :
+        if given, validation(x) returns a score of the solution x (lower is
+        better) and the path stops once the score has not improved for
+        'patience' consecutive lambdas. Default: None (solve the whole path).
+
+    Output
+    ------
+    X - np.array :
+        the solutions, one per solved lambda along the last axis
+    lambdas - np.array :
+        the lambdas actually solved (one row per solution), in the order of X
+    scores - np.array :
+        validation score of each solution (NaN if validation is None)
+    details - list :
+        opt_details of each solution
+    """
+    if regularisation is None:
+        raise ValueError('A regularisation is needed to define the path (see init_regularisation).')
+    lambdas = np.array([np.broadcast_to(np.asarray(l, dtype=np.float64), (3,)) for l in lambdas])
+    if lambdas.size == 0 or (lambdas < 0).any():
+        raise ValueError('lambdas must be a non-empty list of non-negative values.')
+    lambdas = lambdas[np.argsort(-lambdas.sum(axis=1), kind='mergesort')]
+
+    if L is None and solver == 'fista':
+        L, _ = estimate_lipschitz(A, At, L_tol)
+
+    X, scores, details = [], [], []
+    best, since_best = np.inf, 0
+    x = x0
+    for i in xrange(lambdas.shape[0]):
+        reg = dict(regularisation)
+        reg['lambdaIC'], reg['lambdaEC'], reg['lambdaISO'] = lambdas[i]
+        if verbose >= 1:
+            print '\n< lambdas = ( %g, %g, %g ) >' % tuple(lambdas[i])
+        x, opt_details = solve(y, A, At, tol_fun = tol_fun, tol_x = tol_x, max_iter = max_iter, verbose = verbose, x0 = x, regularisation = reg, save_x_interval = 0, L = L, solver = solver)
+        X.append(x)
+        details.append(opt_details)
+        if validation is None:
+            scores.append(np.nan)
+            continue
+        scores.append(float(validation(x)))
+        if scores[-1] < best:
+            best, since_best = scores[-1], 0
+        else:
+            since_best += 1
+            if since_best >= patience:
+                break
+
+    return np.stack(X, axis=-1), lambdas[:len(X)], np.array(scores), details
+
+def estimate_lipschitz( A, At, tol = 1e-3, max_iter = 100 ) :
+    """
+    Estimate the Lipschitz constant of the gradient of 0.5*||Ax-y||_2^2, i.e. the
+    largest eigenvalue of A'A, with the power method. As the entries of A are
+    non-negative, the iterations start from a constant vector, which is close to
+    the leading eigenvector. They stop when the relative change of the estimate is
+    below tol; the returned value is enlarged by the same amount, as the estimates
+    of the power method approach the eigenvalue from below. The stopping rule
+    bounds the change between two iterations, not the error, hence the value
+    can still be slightly lower than ||A||_2^2 (e.g. 78.75 instead of 78.87):
+    the step 1/L is then a little too large at times, and fista reduces it by
+    backtracking, which is not bounded.
+
+    Returns
+    -------
+    L : float
+        Estimate of ||A||_2^2
+    n_iter : int
+        Number of iterations, each costing one product with A and one with At
+    """
+    v  = np.full( A.shape[1], 1.0/sqrt(A.shape[1]) )
+    Av = np.empty( A.shape[0] )
+    w  = np.empty( A.shape[1] )
+    L = 0.0
+    for i in xrange(1, max_iter+1) :
+        _dot( A, v, Av )
+        _dot( At, Av, w )
+        L_old, L = L, np.dot( v, w ) # Rayleigh quotient, as ||v|| = 1
+        w_norm = np.linalg.norm( w )
+        if w_norm == 0 :
+            return 1.0, i # A = 0: any step is fine
+        np.multiply( w, 1.0/w_norm, out=v )
+        if abs(L - L_old) <= tol * L :
+            break
+    return L * (1 + tol), i
+
+def gap_safe_screening( y, res, grad, res_norm, col_norms, col_sums, screened = None ) :
+    """
+    Gap safe screening rule [1] for the non-negative least squares problem
+
+        argmin_{x>=0} 0.5*||Ax-y||_2^2
+
+    whose dual is max -0.5*||theta||^2 - <theta,y> subject to A'theta >= 0,
+    with solution theta* = Ax*-y. A coefficient is zero at the solution if
+    the corresponding entry of A'theta* is positive; as the dual objective is
+    1-strongly concave, theta* lies in the ball of radius sqrt(2*gap) around
+    any feasible theta, which gives a test valid for any iterate.
+
+    The gap is the primal objective at a feasible x >= 0, given by the norm
+    of its residual, minus the dual objective at a feasible theta. The latter
+    is the residual res at any point (e.g. the extrapolated point of FISTA,
+    whose gradient is available) moved along the constant vector until
+    A'theta >= 0, which is possible as A is non-negative; the columns already
+    screened are left out, as they do not belong to the reduced problem. The
+    shift, and thus the gap, vanish only as the iterate approaches the
+    solution, so the test becomes effective late in the fit.
 
-    return fista( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, omega, prox, coeff_path, save_x_interval )
+    Input
+    -----
+    res, grad : the residual Az-y and the gradient A'(Az-y) at some point z, one
+                column per problem
+    res_norm : the norm of the residual Ax-y at a feasible x, i.e. x >= 0 and zero
+               on the columns already screened, for each problem
+    col_norms : upper bounds of the norms of the columns of A
+    col_sums : A'1, i.e. the sums of the columns of A
+    screened : boolean array of the columns already screened (default : none)
+
+    Output
+    ------
+    Boolean array, True for the coefficients that are zero at the solution of
+    all the problems.
 
-def fista( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, omega, proximal, coeff_path, save_x_interval ) :
+    References:
+        [1] Ndiaye et al. - `Gap Safe Screening Rules for Sparsity Enforcing
+            Penalties`
+    """
+    valid = col_sums > 0 # the empty columns do not change the objective
+    if screened is not None :
+        valid &= ~screened
+    screen = valid.copy()
+    eps = np.finfo(grad.dtype).eps
+    for k in xrange(y.shape[1]):
+        theta = res[:,k].astype( np.float64 )
+        g = grad[:,k].astype( np.float64 )
+        t = max( 0.0, np.max( -g[valid] / col_sums[valid] ) ) if valid.any() else 0.0
+        # rounding guard: the products are accumulated in double precision, but the
+        # gradient is stored in the working precision, i.e. g_j is exact up to
+        # eps*|g_j| <= eps*||a_j||*||res||
+        guard = eps * sqrt( np.dot( theta, theta ) )
+        primal = 0.5 * float(res_norm[k])**2
+        theta += t
+        dual = -0.5 * np.dot( theta, theta ) - np.dot( theta, y[:,k] )
+        radius = sqrt( 2 * max( primal - dual, 0.0 ) ) + guard
+        screen &= g + t * col_sums > col_norms * radius
+    return screen
+
+def save_checkpoint( filename, state ) :
+    """Save the dictionary of arrays state in filename (npz format) atomically: the data
+    are written to a temporary file in the same folder, which then replaces filename, so
+    that an interruption leaves either the previous state or the new one."""
+    tmp = filename + '.tmp'
+    with open( tmp, 'wb' ) as f :
+        np.savez( f, **state )
+        f.flush()
+        os.fsync( f.fileno() )
+    getattr( os, 'replace', os.rename )( tmp, filename )
+
+def load_checkpoint( filename ) :
+    """Load a state saved by save_checkpoint()."""
+    with np.load( filename ) as data :
+        return { k : data[k] for k in data.files }
+
+def _gradient( A, At, x, y, res, grad ) :
+    """Compute the residual A.dot(x)-y in res and the gradient At.dot(res) in grad and
+    return the norm of the residual of each column; operators with a gradient() method
+    compute everything with a single call, the others with two products."""
+    if hasattr( A, 'gradient' ) :
+        res_norm, _ = A.gradient( x, y, out=grad, res=res )
+        return np.atleast_1d( res_norm )
+    _dot( A, x, res )
+    res -= y
+    _dot( At, res, grad )
+    return np.sqrt( np.einsum( 'ij,ij->j', res, res, dtype=np.float64 ) )
+
+def fista( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, omega, proximal, coeff_path, save_x_interval, L = None, L_tol = 1e-3, screen_interval = 0, restart = None, monotone = False, callback = None, checkpoint = None ) :
     """
     Solve the regularised least squares problem
 
@@ -281,130 +585,663 @@ def fista( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, omega, proximal, coe
     with the FISTA algorithm described in [1].
 
     The penalty term and its proximal operator must be defined in such a way
-    that they already contain the regularisation parameter.
+    that they already contain the regularisation parameter. The proximal
+    operator receives a contiguous vector, which it may modify in place, and
+    returns the result.
+
+    If y and x0 are 2D arrays with k columns, the k independent problems are
+    solved in lock-step: the products with A and At are computed for all the
+    columns at once, while step size, momentum and stopping criteria are kept
+    separately for each problem. The solution of a problem is the iterate at
+    which its own stopping criterion is met, as if it were solved alone, and
+    the fields of the returned opt_details hold one value per problem.
+
+    If y is np.float32, the vectors (x, the residual, the gradient, etc.) are
+    stored and multiplied by A and At in single precision, which halves the
+    memory traffic; the norms, the objective and the step sizes are still
+    computed in double precision.
+
+    The product A*xhat needed by the gradient is obtained by linearity from
+    A*x and A*prev_x, which are already known, hence every iteration costs
+    one product with A for each trial step size and one product with At;
+    the counts are returned in opt_details ('matvecs' and related fields).
+
+    The step size is 1/L, where L is the Lipschitz constant of the gradient;
+    if it is not given, it is estimated with estimate_lipschitz() up to the
+    relative tolerance L_tol, and backtracking only guards against errors. A
+    problem whose objective is not finite, e.g. because of NaN values in the
+    data, is stopped with the criterion "Non-finite objective" and a warning.
+
+    If save_x_interval > 0, x is saved every save_x_interval iterations in the
+    file commit.history.FILENAME of the folder coeff_path; the snapshots are
+    written by a background thread and read with commit.history.HistoryReader.
+
+    If callback is given, it is called at the end of every iteration with a
+    dictionary describing it (see commit.telemetry): wall time, time spent in
+    the products with A and At, number of step reductions, step size, stopping
+    metrics, restart and number of screened columns. For a block of problems,
+    the values specific to each problem are arrays.
+
+    The state of the solver can be saved periodically, so that an interrupted
+    run can be continued exactly where it stopped. checkpoint is a dictionary:
+        'filename' : file of the state, replaced atomically at every save
+        'interval' : number of iterations between two saves (0 : never)
+        'id'       : string identifying the problem, e.g. a hash of A and y
+        'resume'   : if True and the file exists, x0 is ignored and the run
+                     continues from the saved state, provided it has the same id
+    The file is removed when the solver returns, i.e. when it converges or
+    reaches max_iter, so that only an interrupted run can be resumed.
+
+    If screen_interval > 0, every screen_interval iterations the coefficients
+    that are proven to be zero at the solution of all the problems by
+    gap_safe_screening() are set to zero for the rest of the solution and,
+    if the operator supports it (set_mask), the fibers whose coefficients are
+    all zero are skipped by the products. This is valid only for the non-
+    negative least squares problem (omega = 0) and requires the column norms
+    of the operator (column_norms); opt_details['screening'] holds, for each
+    stage, the iteration, the number of columns screened and the number of
+    fibers removed from the products. As the radius of the test is given by
+    the duality gap, the columns are removed only close to the solution,
+    typically in the last iterations; each stage that removes some costs 3
+    products with A and one with At, which are subtracted from the products
+    saved reported in opt_details ('matvecs_saved').
+
+    The momentum can be reset adaptively [2], which removes the oscillations
+    of the objective near the solution:
+        restart = 'function' : when the objective increases
+        restart = 'gradient' : when the step and the momentum point in opposite
+                               directions, i.e. <xhat-x, x-prev_x> > 0
+    The iterations at which each problem restarted are in opt_details['restarts'].
+    With monotone = True, the monotone variant of [3] is used: a step that
+    increases the objective only moves the extrapolation point and the iterate
+    is kept. Both options change neither the cost nor the number of products
+    of an iteration.
 
     References:
         [1] Beck & Teboulle - `A Fast Iterative Shrinkage Thresholding
             Algorithm for Linear Inverse Problems`
+        [2] O'Donoghue & Candes - `Adaptive Restart for Accelerated Gradient
+            Schemes`
+        [3] Beck & Teboulle - `Fast Gradient-Based Algorithms for Constrained
+            Total Variation Image Denoising and Deblurring Problems`
     """
+    if restart not in ( None, 'function', 'gradient' ) :
+        raise ValueError( 'Restart scheme "%s" not recognized; use None, "function" or "gradient"' % restart )
+
+    # Working precision; the reductions are always accumulated in double precision
+    dtype = np.float32 if y.dtype == np.float32 else np.float64
+    y  = y.astype( dtype, copy=False )
+    x0 = x0.astype( dtype, copy=False )
+    norm  = lambda v: np.sqrt( np.einsum( 'ij,ij->j', v, v, dtype=np.float64 ) )
+    inner = lambda u, v: np.einsum( 'ij,ij->j', u, v, dtype=np.float64 )
+
+    # Internally, each problem is a column
+    is_block = y.ndim == 2
+    if not is_block :
+        y  = y.reshape( (-1,1) )
+        x0 = x0.reshape( (-1,1) )
+    K = y.shape[1]
+    omega_k = lambda v: np.array( [ omega( v[:,k] ) for k in xrange(K) ] )
+    def prox_k( v ) :
+        # the columns are contiguous, hence an in-place proximal updates v directly
+        for k in xrange(K) :
+            col = v[:,k]
+            out = proximal( col )
+            if out is not col :
+                col[...] = out
+
+    # Work buffers, allocated once; the vectors are updated in place and the products
+    # with A and At are written in them. They are stored in Fortran order, so that the
+    # columns are contiguous as expected by the block products of the operators
+    xhat   = np.array( x0, dtype=dtype, order='F' )
+    x      = np.empty_like( xhat )
+    prev_x = np.empty_like( xhat )
+    tmp    = np.empty_like( xhat )
+    grad   = np.empty_like( xhat )
+    res    = np.empty( (A.shape[0],K), dtype=dtype, order='F' )
+
+    # Products A*x and A*prev_x, kept to obtain A*xhat as their combination instead of
+    # multiplying xhat again; A*prev_x is not used until prev_x is an iterate (the first
+    # momentum coefficient is 0), hence it starts at zero
+    Ax      = np.empty_like( res )
+    Aprev_x = np.zeros_like( res )
+    n_A, n_At = 1, 1 # products computed so far (all the columns at once)
+
+    # State saved by a previous run, which is continued instead of starting from x0
+    state = None
+    if checkpoint is not None and checkpoint.get( 'resume', False ) and exists( checkpoint['filename'] ) :
+        state = load_checkpoint( checkpoint['filename'] )
+        if str( state['id'] ) != checkpoint.get( 'id', '' ) or state['xhat'].shape != xhat.shape or state['xhat'].dtype != dtype :
+            raise ValueError( 'The checkpoint "%s" was saved for a different problem' % checkpoint['filename'] )
+        L = float( state['L'] )
 
     # Initialization
-    res = -y.copy()
-    xhat = x0.copy()
-    x = np.zeros_like(xhat)
-    res += A.dot(xhat)
-    xhat = proximal( xhat )
-    reg_term = omega( xhat )
-    prev_obj = 0.5 * np.linalg.norm(res)**2 + reg_term
-
-    told = 1
     beta = 0.9
-    prev_x = xhat.copy()
-    grad = np.asarray(At.dot(res))
-    qfval = prev_obj
+    if state is None :
+        res_norm = _gradient( A, At, xhat, y, res, grad )
+        prox_k( xhat )
+        reg_term = omega_k( xhat )
+        prev_obj = 0.5 * res_norm**2 + reg_term
+
+        told = np.ones( K )
+        np.copyto( prev_x, xhat )
+        qfval = prev_obj
+        prev_res_norm = res_norm
+        if monotone and prev_x.any() :
+            # a rejected first step falls back on the starting point, whose product is then needed
+            _dot( A, prev_x, Aprev_x )
+            n_A += 1
+
+    # Step size computation; backtracking is needed only if L is underestimated
+    if L is None :
+        L, n_L = estimate_lipschitz( A, At, L_tol )
+        n_A  += n_L
+        n_At += n_L
+    mu = np.full( K, 1.0 / L )
+    # the sufficient decrease test tolerates the rounding errors of the objective, which
+    # come from those of the residual: eps*(|Ax|+|y|) on each entry, i.e. at most about
+    # 2*eps*(obj + sqrt(2*obj)*||y||)
+    rtol = 2 * np.finfo( dtype ).eps
+    y_norm = norm( y )
+
+    # Safe screening
+    screened = np.zeros( A.shape[1], dtype=bool )
+    screened_idx = np.flatnonzero( screened )
+    screening = []
+    if screen_interval > 0 and not hasattr( A, 'column_norms' ) :
+        warnings.warn( 'The operator does not provide column_norms(); screening disabled.' )
+        screen_interval = 0
+    if screen_interval > 0 :
+        col_norms = A.column_norms()
+        col_sums  = _dot( At, np.ones( A.shape[0] ), np.empty( A.shape[1] ) )
+        n_At += 1
+
+    # Momentum restarts of each problem
+    restarts = [ [] for k in xrange(K) ]
+
+    # Problems still running and outcome of those already stopped
+    active    = np.ones( K, dtype=bool )
+    criterion = [ None ] * K
+    x_out     = np.zeros_like( xhat )
+    out       = np.zeros( (7,K) ) # residual, cost_function, abs_cost, rel_cost, abs_x, rel_x, iterations
 
-    # Step size computation
-    L = ( np.linalg.norm( A.dot(grad) ) / np.linalg.norm(grad) )**2
-    mu = 1.9 / L
+    iter = 1
+    if state is not None :
+        iter = int( state['iter'] )
+        for v, key in [ (xhat, 'xhat'), (prev_x, 'prev_x'), (Aprev_x, 'Aprev_x'), (grad, 'grad'), (x_out, 'x_out'), (out, 'out'), (screened, 'screened'), (active, 'active') ] :
+            v[...] = state[key]
+        told, mu, qfval = state['told'], state['mu'], state['qfval']
+        prev_obj, prev_res_norm = state['prev_obj'], state['prev_res_norm']
+        criterion = [ str(c) if c else None for c in state['criterion'] ]
+        for k, i in state['restarts'] :
+            restarts[k].append( int(i) )
+        screening = [ tuple( int(v) for v in s ) for s in state['screening'] ]
+        n_A, n_At = int( state['n_A'] ), int( state['n_At'] )
+        screened_idx = np.flatnonzero( screened )
+        if screened.any() and hasattr( A, 'set_mask' ) :
+            A.set_mask( ~screened )
+        if verbose >= 1 :
+            print "      < resumed at iteration %d from \"%s\" >" % ( iter, checkpoint['filename'] )
+
+    # Snapshots of x, written in the background (see commit.history); when resuming,
+    # those taken after the checkpoint are discarded
+    if save_x_interval > 0 :
+        history = HistoryWriter( pjoin( coeff_path, HISTORY_FILENAME ), x0.shape if is_block else x0.shape[:1], dtype,
+                                 keep_until = iter-1 if state is not None else None )
+
+    # Telemetry: time spent in the products of the current iteration
+    clock = { 'A' : 0.0, 'At' : 0.0 }
+    per_problem = ( lambda v: np.array(v) ) if is_block else ( lambda v: v[0] )
+    def emit( restarted ) :
+        callback( {
+            'iteration'     : iter,
+            'time'          : time.time() - tic_start,
+            'time_iteration': time.time() - tic_iter,
+            'time_A'        : clock['A'],
+            'time_At'       : clock['At'],
+            'products_A'    : n_A - n_A_iter,
+            'products_At'   : n_At - n_At_iter,
+            'backtracking'  : per_problem( n_backtrack ),
+            'step_size'     : per_problem( mu ),
+            'residual'      : per_problem( res_norm ),
+            'cost_function' : per_problem( curr_obj ),
+            'abs_cost'      : per_problem( abs_obj ),
+            'rel_cost'      : per_problem( rel_obj ),
+            'abs_x'         : per_problem( abs_x ),
+            'rel_x'         : per_problem( rel_x ),
+            'restart'       : per_problem( restarted ),
+            'screened'      : screened_idx.size,
+        } )
 
     # Main loop
     if verbose >= 1 :
         print
         print "      |     ||Ax-y||     |  Cost function    Abs error      Rel error    |     Abs x          Rel x"
         print "------|------------------|-----------------------------------------------|------------------------------"
-    iter = 1
+    tic_start = time.time()
     while True :
         if verbose >= 1 :
             print "%4d  |" % iter,
             sys.stdout.flush()
+        tic_iter = time.time()
+        clock['A'] = clock['At'] = 0.0
+        n_A_iter, n_At_iter = n_A, n_At
+        n_backtrack = np.zeros( K, dtype=int )
 
-        # Smooth step
-        x = xhat - mu*grad
-
-        # Non-smooth step
-        x = proximal( x )
-        reg_term_x = omega( x )
-
-        # Check stepsize
-        tmp = x-xhat
-        q = qfval + np.real( np.dot(tmp,grad) ) + 0.5/mu * np.linalg.norm(tmp)**2 + reg_term_x
-        res = A.dot(x) - y
-        res_norm = np.linalg.norm(res)
-        curr_obj = 0.5 * res_norm**2 + reg_term_x
-
-        # Backtracking
-        while curr_obj > q :
+        backtrack = active
+        while backtrack.any() :
             # Smooth step
-            mu = beta*mu
-            x = xhat - mu*grad
+            np.multiply( grad, mu.astype(dtype), out=x )
+            np.subtract( xhat, x, out=x )
 
             # Non-smooth step
-            x = proximal( x )
-            reg_term_x = omega( x )
+            prox_k( x )
+            x[screened_idx] = 0
+            reg_term_x = omega_k( x )
 
             # Check stepsize
-            tmp = x-xhat
-            q = qfval + np.real( np.dot(tmp,grad) ) + 0.5/mu * np.linalg.norm(tmp)**2 + reg_term_x
-            res = A.dot(x) - y
-            res_norm = np.linalg.norm(res)
+            np.subtract( x, xhat, out=tmp )
+            q = qfval + np.real( inner(tmp, grad) ) + 0.5/mu * norm(tmp)**2 + reg_term_x
+            _timed_dot( A, x, Ax, clock, 'A' )
+            np.subtract( Ax, y, out=res )
+            n_A += 1
+            res_norm = norm(res)
             curr_obj = 0.5 * res_norm**2 + reg_term_x
 
+            # Backtracking (only the problems whose step is too large); without the rounding
+            # tolerance the test could fail for every step, e.g. in single precision, as the
+            # objective at xhat is computed in two ways. A non-finite objective (an overflow)
+            # means that the step is too large, unless the objective at xhat is not finite
+            # itself; a step that underflows to zero ends the backtracking in any case
+            slack = rtol * ( np.abs(q) + np.sqrt( 2*np.abs(q) ) * y_norm )
+            backtrack = active & np.isfinite(qfval) & (mu > 0) & ~(curr_obj <= q + slack)
+            mu[backtrack] *= beta
+            n_backtrack += backtrack
+
+        # Monotone variant: the steps that increase the objective are rejected
+        rejected = active & (curr_obj > prev_obj) if monotone else np.zeros( K, dtype=bool )
+
         # Global stopping criterion
         abs_obj = abs(curr_obj - prev_obj)
         rel_obj = abs_obj / curr_obj
-        abs_x   = np.linalg.norm(x - prev_x)
-        rel_x   = abs_x / ( np.linalg.norm(x) + eps )
+        np.subtract( x, prev_x, out=tmp )
+        abs_x   = norm(tmp)
+        rel_x   = abs_x / ( norm(x) + eps )
         if verbose >= 1 :
-            print "  %13.7e  |  %13.7e  %13.7e  %13.7e  |  %13.7e  %13.7e" % ( res_norm, curr_obj, abs_obj, rel_obj, abs_x, rel_x )
+            # worst case among the problems still running
+            print "  %13.7e  |  %13.7e  %13.7e  %13.7e  |  %13.7e  %13.7e" % tuple( v[active].max() for v in (res_norm, curr_obj, abs_obj, rel_obj, abs_x, rel_x) )
+
+        for k in np.flatnonzero( active ) :
+            if not np.isfinite( curr_obj[k] ) :
+                criterion[k] = "Non-finite objective"
+            elif abs_obj[k] < eps :
+                criterion[k] = "Absolute tolerance on the objective"
+            elif rel_obj[k] < tol_fun :
+                criterion[k] = "Relative tolerance on the objective"
+            elif abs_x[k] < eps :
+                criterion[k] = "Absolute tolerance on the unknown"
+            elif rel_x[k] < tol_x :
+                criterion[k] = "Relative tolerance on the unknown"
+            elif iter >= max_iter :
+                criterion[k] = "Maximum number of iterations"
+            else :
+                continue
+            active[k] = False
+            if rejected[k] :
+                # monotone variant: the iterate is still the previous one
+                x_out[:,k] = prev_x[:,k]
+                out[:,k] = ( prev_res_norm[k], prev_obj[k], abs_obj[k], rel_obj[k], abs_x[k], rel_x[k], iter )
+            else :
+                x_out[:,k] = x[:,k]
+                out[:,k] = ( res_norm[k], curr_obj[k], abs_obj[k], rel_obj[k], abs_x[k], rel_x[k], iter )
+        if not active.any() :
+            if callback is not None :
+                emit( np.zeros( K, dtype=bool ) )
+            break
+
+        # Momentum restart: the next extrapolation point is the iterate itself
+        if restart == 'function' :
+            reset = active & (curr_obj > prev_obj)
+        elif restart == 'gradient' :
+            reset = active & (inner(xhat, tmp) - inner(x, tmp) > 0)
+        else :
+            reset = np.zeros( K, dtype=bool )
+        for k in np.flatnonzero( reset ) :
+            restarts[k].append( iter )
+        told[reset] = 1.0
+
+        # FISTA update (tmp already holds x - prev_x), xhat = x + c*(x - prev_x); in the
+        # monotone variant, a rejected step x is used only to extrapolate from the kept
+        # iterate prev_x, i.e. xhat = prev_x + told/t*(x - prev_x) [3], which is obtained
+        # with c = (told-t)/t, or c = -1 if the momentum is reset
+        t = 0.5 * ( 1 + np.sqrt(1+4*told**2) )
+        c = np.where( rejected, (told-t)/t, (told-1)/t )
+        c[reset] = np.where( rejected[reset], -1.0, 0.0 )
+        c = c.astype(dtype)
+        np.multiply( tmp, c, out=xhat )
+        xhat += x
+
+        # Gradient computation (A*xhat = A*x + c*(A*x - A*prev_x), by linearity)
+        np.subtract( Ax, Aprev_x, out=res )
+        res *= c
+        res += Ax
+        res -= y
+        _timed_dot( At, res, grad, clock, 'At' )
+        n_At += 1
+        res_norm_xhat = norm(res)
+
+        # Monotone variant: the rejected steps are replaced by the previous iterate
+        for k in np.flatnonzero( rejected ) :
+            x[:,k]  = prev_x[:,k]
+            Ax[:,k] = Aprev_x[:,k]
+        curr_obj = np.where( rejected, prev_obj, curr_obj )
+        res_norm = np.where( rejected, prev_res_norm, res_norm )
+
+        # Screening: the coefficients proven to be zero are removed, then the products
+        # with x, prev_x and xhat are updated as the operator may have changed
+        if screen_interval > 0 and iter % screen_interval == 0 :
+            new = gap_safe_screening( y, res, grad, res_norm, col_norms, col_sums, screened )
+            if new.any() :
+                screened |= new
+                screened_idx = np.flatnonzero( screened )
+                x[screened_idx] = 0
+                prev_x[screened_idx] = 0
+                xhat[screened_idx] = 0
+                if hasattr( A, 'set_mask' ) :
+                    A.set_mask( ~screened )
+                _timed_dot( A, x, Ax, clock, 'A' )
+                _timed_dot( A, prev_x, Aprev_x, clock, 'A' )
+                _timed_dot( A, xhat, res, clock, 'A' )
+                res -= y
+                _timed_dot( At, res, grad, clock, 'At' )
+                res_norm_xhat = norm(res)
+                n_A  += 3
+                n_At += 1
+            screening.append( ( iter, screened_idx.size, A.masked_fibers() if hasattr( A, 'masked_fibers' ) else 0 ) )
+            if verbose >= 1 :
+                print "      < screening: %d columns, %d fibers removed from the products >" % screening[-1][1:]
+
+        # Update variables
+        if save_x_interval > 0 and iter % save_x_interval == 0 :
+            history.append( iter, x )
+        if callback is not None :
+            emit( reset )
+        iter += 1
+        prev_obj = curr_obj
+        prev_res_norm = res_norm
+        x, prev_x = prev_x, x # x is fully overwritten in the next iteration
+        Ax, Aprev_x = Aprev_x, Ax
+        told = t
+        qfval = 0.5 * res_norm_xhat**2
+
+        # Checkpoint of the state needed to continue from the next iteration
+        if checkpoint is not None and checkpoint.get( 'interval', 0 ) > 0 and (iter-1) % checkpoint['interval'] == 0 :
+            save_checkpoint( checkpoint['filename'], {
+                'id' : checkpoint.get( 'id', '' ), 'iter' : iter, 'L' : L, 'n_A' : n_A, 'n_At' : n_At,
+                'xhat' : xhat, 'prev_x' : prev_x, 'Aprev_x' : Aprev_x, 'grad' : grad,
+                'told' : told, 'mu' : mu, 'qfval' : qfval, 'prev_obj' : prev_obj, 'prev_res_norm' : prev_res_norm,
+                'active' : active, 'x_out' : x_out, 'out' : out, 'criterion' : [ c or '' for c in criterion ],
+                'restarts' : np.array( [ (k, i) for k in xrange(K) for i in restarts[k] ], dtype=int ).reshape( (-1,2) ),
+                'screened' : screened, 'screening' : np.array( screening, dtype=int ).reshape( (-1,3) ) } )
+
+    if save_x_interval > 0 :
+        history.close()
+    # the run is complete, so its state must not be resumed by a later call
+    if checkpoint is not None :
+        for f in ( checkpoint['filename'], checkpoint['filename'] + '.tmp' ) :
+            if exists( f ) :
+                os.remove( f )
+    if "Non-finite objective" in criterion :
+        warnings.warn( 'fista: the objective is not finite (%d problems); the data or the starting point may contain NaN or Inf values' % criterion.count( "Non-finite objective" ) )
+    if verbose >= 1 :
+        for c in sorted( set(criterion) ) :
+            if K == 1 :
+                print "< Stopping criterion: %s >" % c
+            else :
+                print "< Stopping criterion: %s (%d problems) >" % ( c, criterion.count(c) )
+
+    if not is_block :
+        x_out = x_out[:,0]
+        out = out[:,0]
+        criterion = criterion[0]
+
+    opt_details = {}
+    opt_details['residual'] = out[0]
+    opt_details['cost_function'] = out[1]
+    opt_details['abs_cost'] = out[2]
+    opt_details['rel_cost'] = out[3]
+    opt_details['abs_x'] = out[4]
+    opt_details['rel _x'] = out[5]
+    opt_details['iterations'] = out[6].astype(int) if is_block else int(out[6])
+    opt_details['stopping_criterion'] = criterion
+    opt_details['lipschitz'] = L
+    opt_details['screening'] = screening
+    opt_details['restarts'] = restarts if is_block else restarts[0]
+    # products spent by the screening: the sums of the columns, then 3 with A and 1 with
+    # At at every stage that removed new columns
+    n_screen = 0
+    if screen_interval > 0 :
+        counts = [ 0 ] + [ stage[1] for stage in screening ]
+        n_screen = 1 + 4 * sum( 1 for a, b in zip( counts[:-1], counts[1:] ) if b > a )
+    # products with A and At (each one for all the columns at once), and those saved
+    # by not multiplying xhat, i.e. one per iteration, net of those of the screening
+    opt_details['matvecs'] = n_A + n_At
+    opt_details['matvecs_per_iteration'] = float(n_A + n_At) / iter
+    opt_details['matvecs_saved'] = iter - 1 - n_screen
+    opt_details['matvecs_saved_per_iteration'] = float(iter - 1 - n_screen) / iter
+
+    return x_out, opt_details
+
+def nnls_lbfgs( y, A, At, tol_fun, tol_x, max_iter, verbose, x0, coeff_path = None, save_x_interval = 0, memory = 10, callback = None ) :
+    """
+    Solve the non-negative least squares problem
+
+        argmin_{x>=0} 0.5*||Ax-y||_2^2
+
+    with a projected quasi-Newton method in the spirit of L-BFGS-B [1]. At each
+    iteration the variables at the bound whose gradient points outside the
+    feasible set are kept fixed; on the others, the direction is given by the
+    L-BFGS approximation of the inverse Hessian built from the last 'memory'
+    steps, and the step length is the exact minimizer of the quadratic along
+    it, followed by the projection onto x >= 0 (halved if the projection does
+    not decrease the objective). Only products with A and At are used: A*x is
+    updated by linearity and recomputed only when the projection is active,
+    and the change of the gradient needed by L-BFGS comes for free.
+
+    The stopping criteria, the arguments and the opt_details are the same as
+    in fista; if y is a 2D array, its columns are solved one after the other.
+    The records passed to callback have the same fields as in fista, where
+    'backtracking' counts the halvings of the step, 'step_size' is the final
+    step length along the direction and 'restart' tells whether the history
+    was discarded as the direction was not a descent one.
+
+    References:
+        [1] Kim, Sra & Dhillon - `Tackling Box-Constrained Optimization via a
+            New Projected Quasi-Newton Approach`
+    """
+    if y.ndim == 2 :
+        results = [ nnls_lbfgs( y[:,k], A, At, tol_fun, tol_x, max_iter, verbose, x0[:,k], None, 0, memory, callback ) for k in xrange(y.shape[1]) ]
+        x = np.column_stack( [ r[0] for r in results ] )
+        opt_details = {}
+        for key in results[0][1] :
+            opt_details[key] = [ r[1][key] for r in results ]
+            if key != 'stopping_criterion' :
+                opt_details[key] = np.array( opt_details[key] )
+        opt_details['matvecs'] = opt_details['matvecs'].sum()
+        return x, opt_details
+
+    dtype = np.float32 if y.dtype == np.float32 else np.float64
+    y   = y.astype( dtype, copy=False )
+    dot = lambda u, v: np.dot( u.astype(np.float64, copy=False), v.astype(np.float64, copy=False) )
+
+    # Work buffers
+    x      = np.maximum( x0.astype( dtype ), 0 )
+    x_new  = np.empty_like( x )
+    grad   = np.empty_like( x )
+    d      = np.empty_like( x )
+    Ax     = np.empty( A.shape[0], dtype=dtype )
+    Ax_new = np.empty_like( Ax )
+    Ad     = np.zeros_like( Ax )
+    res    = np.empty_like( Ax )
+    S, Y   = [], [] # last steps and changes of the gradient
+    if save_x_interval > 0 :
+        history = HistoryWriter( pjoin( coeff_path, HISTORY_FILENAME ), x.shape, dtype )
+
+    _dot( A, x, Ax )
+    np.subtract( Ax, y, out=res )
+    _dot( At, res, grad )
+    n_A, n_At = 1, 1
+    obj = 0.5 * dot(res, res)
+
+    if verbose >= 1 :
+        print
+        print "      |     ||Ax-y||     |  Cost function    Abs error      Rel error    |     Abs x          Rel x"
+        print "------|------------------|-----------------------------------------------|------------------------------"
+    clock = { 'A' : 0.0, 'At' : 0.0 }
+    tic_start = time.time()
+    iter = 1
+    while True :
+        if verbose >= 1 :
+            print "%4d  |" % iter,
+            sys.stdout.flush()
+        tic_iter = time.time()
+        clock['A'] = clock['At'] = 0.0
+        n_A_iter, n_At_iter = n_A, n_At
+        n_backtrack = 0
+        restarted = False
+
+        # L-BFGS direction (two-loop recursion) on the free variables
+        free = np.flatnonzero( (x > 0) | (grad < 0) )
+        q = grad[free].astype( np.float64 )
+        pairs = []
+        for s_, y_ in zip( S, Y ) :
+            sF, yF = s_[free], y_[free]
+            sy = np.dot( sF, yF )
+            if sy > eps * np.dot( yF, yF ) :
+                pairs.append( ( sF, yF, 1.0/sy ) )
+        alphas = []
+        for sF, yF, rho in reversed( pairs ) :
+            a = rho * np.dot( sF, q )
+            q -= a * yF
+            alphas.append( a )
+        for ( sF, yF, rho ), a in zip( pairs, reversed(alphas) ) :
+            q += ( a - rho * np.dot( yF, q ) ) * sF
+        d.fill( 0 )
+        d[free] = -q
+        gd = dot( grad, d )
+        if not gd < 0 :
+            # not a descent direction: restart from the projected gradient
+            del S[:], Y[:]
+            restarted = True
+            d.fill( 0 )
+            d[free] = -grad[free]
+            gd = dot( grad, d )
+
+        # Exact step along d, projected onto x >= 0
+        if gd < 0 :
+            _timed_dot( A, d, Ad, clock, 'A' )
+            n_A += 1
+            alpha = -gd / dot( Ad, Ad )
+        else :
+            alpha = 0.0 # the projected gradient is zero
+        while True :
+            np.multiply( d, dtype(alpha), out=x_new )
+            x_new += x
+            if ( x_new < 0 ).any() :
+                np.maximum( x_new, 0, out=x_new )
+                _timed_dot( A, x_new, Ax_new, clock, 'A' )
+                n_A += 1
+            else :
+                np.multiply( Ad, dtype(alpha), out=Ax_new )
+                Ax_new += Ax
+            np.subtract( Ax_new, y, out=res )
+            obj_new = 0.5 * dot(res, res)
+            if obj_new <= obj or alpha < eps :
+                break
+            alpha *= 0.5
+            n_backtrack += 1
+
+        # Update the gradient and the history
+        S.append( x_new - x )
+        Y.append( -grad )
+        _timed_dot( At, res, grad, clock, 'At' )
+        n_At += 1
+        Y[-1] += grad
+        if len(S) > memory :
+            del S[0], Y[0]
+
+        # Stopping criteria (the same as fista)
+        res_norm = sqrt( 2*obj_new )
+        abs_obj  = abs( obj_new - obj )
+        rel_obj  = abs_obj / obj_new if obj_new > 0 else 0.0
+        abs_x    = sqrt( dot( S[-1], S[-1] ) )
+        rel_x    = abs_x / ( sqrt( dot( x_new, x_new ) ) + eps )
+        if verbose >= 1 :
+            print "  %13.7e  |  %13.7e  %13.7e  %13.7e  |  %13.7e  %13.7e" % ( res_norm, obj_new, abs_obj, rel_obj, abs_x, rel_x )
+
+        x, x_new = x_new, x
+        Ax, Ax_new = Ax_new, Ax
+        obj = obj_new
+
+        if save_x_interval > 0 and iter % save_x_interval == 0 :
+            history.append( iter, x )
+        if callback is not None :
+            callback( {
+                'iteration'     : iter,
+                'time'          : time.time() - tic_start,
+                'time_iteration': time.time() - tic_iter,
+                'time_A'        : clock['A'],
+                'time_At'       : clock['At'],
+                'products_A'    : n_A - n_A_iter,
+                'products_At'   : n_At - n_At_iter,
+                'backtracking'  : n_backtrack,
+                'step_size'     : alpha,
+                'residual'      : res_norm,
+                'cost_function' : obj,
+                'abs_cost'      : abs_obj,
+                'rel_cost'      : rel_obj,
+                'abs_x'         : abs_x,
+                'rel_x'         : rel_x,
+                'restart'       : restarted,
+                'screened'      : 0,
+            } )
 
         if abs_obj < eps :
             criterion = "Absolute tolerance on the objective"
-            break
         elif rel_obj < tol_fun :
             criterion = "Relative tolerance on the objective"
-            break
         elif abs_x < eps :
             criterion = "Absolute tolerance on the unknown"
-            break
         elif rel_x < tol_x :
             criterion = "Relative tolerance on the unknown"
-            break
         elif iter >= max_iter :
             criterion = "Maximum number of iterations"
-            break
-
-        # FISTA update
-        t = 0.5 * ( 1 + sqrt(1+4*told**2) )
-        xhat = x + (told-1)/t * (x - prev_x)
-
-        # Gradient computation
-        res = A.dot(xhat) - y
-        xarr = np.asarray(x)
-
-        grad = np.asarray(At.dot(res))
-
-        # Update variables
-        if save_x_interval > 0 :
-                if iter % save_x_interval == 0:
-                        np.save( coeff_path + '/' + str(iter).zfill(4) + '.npy', x )
-        iter += 1
-        prev_obj = curr_obj
-        prev_x = x.copy()
-        told = t
-        qfval = 0.5 * np.linalg.norm(res)**2
-
+        else :
+            iter += 1
+            continue
+        break
 
+    if save_x_interval > 0 :
+        history.close()
     if verbose >= 1 :
         print "< Stopping criterion: %s >" % criterion
 
     opt_details = {}
     opt_details['residual'] = res_norm
-    opt_details['cost_function'] = curr_obj
+    opt_details['cost_function'] = obj
     opt_details['abs_cost'] = abs_obj
     opt_details['rel_cost'] = rel_obj
     opt_details['abs_x'] = abs_x
     opt_details['rel _x'] = rel_x
     opt_details['iterations'] = iter
     opt_details['stopping_criterion'] = criterion
+    opt_details['matvecs'] = n_A + n_At
+    opt_details['matvecs_per_iteration'] = float(n_A + n_At) / iter
 
     return x, opt_details
+
+
+# Solvers available to solve() and Evaluation.fit(), by name (see register_solver)
+SOLVERS = {}
+register_solver( 'fista', _solve_fista )
+register_solver( 'lbfgs', _solve_nnls_lbfgs )
@@ -0,0 +1,117 @@
+"""
+Per-iteration telemetry of the solvers.
+
+When a callback is given to commit.solvers.solve() or Evaluation.fit(), the
+solver calls it at the end of every iteration with a dictionary holding:
+
+    iteration      : number of the iteration
+    time           : wall time since the start of the iterations [s]
+    time_iteration : wall time of the iteration [s]
+    time_A         : time spent in the products with A during the iteration [s]
+    time_At        : time spent in the products with A' during the iteration [s]
+    products_A     : number of products with A during the iteration
+    products_At    : number of products with A' during the iteration
+    backtracking   : number of reductions of the step size
+    step_size      : step size used
+    residual       : ||Ax-y||
+    cost_function  : objective
+    abs_cost       : absolute change of the objective
+    rel_cost       : relative change of the objective
+    abs_x          : norm of the change of x
+    rel_x          : relative change of x
+    restart        : True if the momentum (or the history of L-BFGS) was reset
+    screened       : number of columns removed by the screening
+
+For a block of problems solved by fista, the values specific to each problem
+are arrays. The classes below are callbacks that keep the records or write
+them to file.
+"""
+from __future__ import print_function
+import csv
+import json
+import numpy as np
+
+FIELDS = [ 'iteration', 'time', 'time_iteration', 'time_A', 'time_At', 'products_A', 'products_At',
+           'backtracking', 'step_size', 'residual', 'cost_function', 'abs_cost', 'rel_cost',
+           'abs_x', 'rel_x', 'restart', 'screened' ]
+
+
+def _plain( value ) :
+    """Convert numpy scalars and arrays to the corresponding Python types."""
+    if isinstance( value, np.ndarray ) :
+        return value.tolist()
+    if isinstance( value, np.generic ) :
+        return value.item()
+    return value
+
+
+class Recorder :
+    """Keep the records in memory, in the list self.records."""
+
+    def __init__( self ) :
+        self.records = []
+
+    def __call__( self, record ) :
+        self.records.append( dict( (k, _plain(v)) for k, v in record.items() ) )
+
+    def column( self, field ) :
+        """Values of a field for all the iterations, as an array."""
+        return np.array( [ r[field] for r in self.records ] )
+
+
+class _FileSink :
+    """Base of the sinks writing to file; the file is flushed after each record, so that
+    a running fit can be monitored, and closed by close() or at the end of a with block."""
+
+    def __init__( self, filename ) :
+        self.filename = filename
+        self.file = open( filename, 'w' )
+
+    def close( self ) :
+        if self.file is not None :
+            self.file.close()
+            self.file = None
+
+    def __enter__( self ) :
+        return self
+
+    def __exit__( self, *args ) :
+        self.close()
+
+
+class JSONLinesWriter( _FileSink ) :
+    """Write each record as a JSON object on its own line.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the output file; an existing file is overwritten
+    """
+
+    def __call__( self, record ) :
+        self.file.write( json.dumps( dict( (k, _plain(v)) for k, v in record.items() ), sort_keys=True ) + '\n' )
+        self.file.flush()
+
+
+class CSVWriter( _FileSink ) :
+    """Write the records as the rows of a CSV file, with a header of the field names.
+    The values of a block of problems are separated by spaces in the same cell.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the output file; an existing file is overwritten
+    """
+
+    def __init__( self, filename ) :
+        _FileSink.__init__( self, filename )
+        self.writer = csv.writer( self.file )
+        self.writer.writerow( FIELDS )
+
+    def __call__( self, record ) :
+        row = []
+        for f in FIELDS :
+            v = _plain( record.get( f, '' ) )
+            row.append( ' '.join( repr(e) for e in v ) if isinstance( v, list ) else repr(v) if isinstance( v, float ) else v )
+        self.writer.writerow( row )
+        self.file.flush()
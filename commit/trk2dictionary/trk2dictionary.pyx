@@ -15,14 +15,15 @@ cdef extern from "trk2dictionary_c.cpp":
         char* strTRKfilename, int Nx, int Ny, int Nz, float Px, float Py, float Pz, int n_count, int n_scalars, int n_properties, float fiber_shiftX, float fiber_shiftY, float fiber_shiftZ, int points_to_skip, float min_seg_len,
         float* ptrPEAKS, int Np, float vf_THR, int ECix, int ECiy, int ECiz,
         float* _ptrMASK, float* ptrTDI, char* path_out, int c, double* ptrAFFINE,
-        int nBlurRadii, double blurSigma, double* ptrBlurRadii, int* ptrBlurSamples, double* ptrBlurWeights
+        int nBlurRadii, double blurSigma, double* ptrBlurRadii, int* ptrBlurSamples, double* ptrBlurWeights,
+        int nThreads
     ) nogil
 
 
 cpdef run( filename_trk, path_out, filename_peaks = None, filename_mask = None, do_intersect = True,
     fiber_shift = 0, points_to_skip = 0, vf_THR = 0.1, peaks_use_affine = False,
     flip_peaks = [False,False,False], min_seg_len = 1e-3, gen_trk = True,
-    blur_radii = [], blur_samples = [], blur_sigma = 1.0
+    blur_radii = [], blur_samples = [], blur_sigma = 1.0, nthreads = None
     ):
     """Perform the conversion of a tractoram to the sparse data-structure internally
     used by COMMIT to perform the matrix-vector multiplications with the operator A
@@ -79,6 +80,10 @@ cpdef run( filename_trk, path_out, filename_peaks = None, filename_mask = None,
         Segments are duplicated along a circle at a given radius; this parameter controls the number of samples to take over a given circle (defaut : [])
     blur_sigma
         The contributions of the segments at different radii are damped as a Gaussian (default : 1.0)
+    nthreads : integer
+        Number of threads computing the segments of the fibers (default : number of CPUs in
+        the system). The fibers are read and written in batches, in their order, hence the
+        dictionary and the TDI do not depend on the number of threads
     """
 
     # check conflicts of fiber_shift
@@ -93,6 +98,16 @@ cpdef run( filename_trk, path_out, filename_peaks = None, filename_mask = None,
     else :
         raise RuntimeError( 'fiber_shift must be a scalar or a vector with 3 elements' )
 
+    # check the number of threads
+    if nthreads is None :
+        try :
+            import multiprocessing
+            nthreads = multiprocessing.cpu_count()
+        except :
+            nthreads = 1
+    if nthreads < 1 or nthreads > 255 :
+        raise RuntimeError( 'Number of threads must be between 1 and 255' )
+
     tic = time.time()
     print '\n-> Creating the dictionary from tractogram:'
     print '\t* Segment position = %s' % ( 'COMPUTE INTERSECTIONS' if do_intersect else 'CENTROID' )
@@ -101,6 +116,7 @@ cpdef run( filename_trk, path_out, filename_peaks = None, filename_mask = None,
     print '\t* Fiber shift Z    = %.3f (voxel-size units)' % fiber_shiftZ
     print '\t* Points to skip   = %d' % points_to_skip
     print '\t* Min segment len  = %.2e' % min_seg_len
+    print '\t* Threads          = %d' % nthreads
 
     # check blur params
     cdef :
@@ -242,7 +258,7 @@ cpdef run( filename_trk, path_out, filename_peaks = None, filename_mask = None,
         trk_hdr['n_count'], trk_hdr['n_scalars'], trk_hdr['n_properties'], fiber_shiftX, fiber_shiftY, fiber_shiftZ, points_to_skip, min_seg_len,
         ptrPEAKS, Np, vf_THR, -1 if flip_peaks[0] else 1, -1 if flip_peaks[1] else 1, -1 if flip_peaks[2] else 1,
         ptrMASK, ptrTDI, path_out, 1 if do_intersect else 0, ptrAFFINE,
-        nBlurRadii, blur_sigma, ptrBlurRadii, ptrBlurSamples, ptrBlurWeights );
+        nBlurRadii, blur_sigma, ptrBlurRadii, ptrBlurSamples, ptrBlurWeights, nthreads );
     if ret == 0 :
         print '   [ DICTIONARY not generated ]'
         return None
@@ -3,10 +3,14 @@
 #include <string>
 #include <map>
 #include <vector>
+#include <algorithm>
+#include <pthread.h>
 #include "Vector.h"
 #include "ProgressBar.h"
 
 #define MAX_FIB_LEN 10000
+#define FIBERS_PER_THREAD 1000  // fibers of a batch for each thread
+#define FIBERS_PER_CHUNK  16    // fibers taken at once by a thread
 
 
 // CLASS to store the segments of one fiber
@@ -50,9 +54,30 @@ class segInVoxKey
     }
 };
 
-// global variables (to avoid passing them at each call)
-std::map<segKey,float> FiberSegments;
+// segments of a fiber, in the order of the keys, and its norm and length
+class FiberOutput
+{
+    public:
+    std::vector<unsigned int>   v, tdi;
+    std::vector<unsigned short> o;
+    std::vector<float>          len;
+    float                       norm, length;
+};
 
+// batch of fibers processed by the threads: the points of fiber i are
+// points[3*offset[i]], ..., points[3*(offset[i]+nPoints[i])-1], as x,y,z triplets
+class FiberBatch
+{
+    public:
+    std::vector<float>        points;
+    std::vector<size_t>       offset;
+    std::vector<unsigned int> nPoints;
+    std::vector<FiberOutput>  out;
+    int                       n, next;
+};
+
+// global variables (to avoid passing them at each call); they are read-only while
+// the threads run, each of which stores the segments of its fiber in its own map
 Vector<int>     dim;
 Vector<float>   pixdim;
 float*          ptrMASK;
@@ -68,9 +93,10 @@ double              radiusSigma;   // modulates the impact of each segment as fu
 
 
 bool rayBoxIntersection( Vector<double>& origin, Vector<double>& direction, Vector<double>& vmin, Vector<double>& vmax, double & t);
-void fiberForwardModel( float fiber[3][MAX_FIB_LEN], unsigned int pts, std::vector<int> sectors, std::vector<double> radii, std::vector<double> weight );
-void segmentForwardModel( const Vector<double>& P1, const Vector<double>& P2, double w );
-unsigned int read_fiber( FILE* fp, float fiber[3][MAX_FIB_LEN], int ns, int np );
+void fiberForwardModel( const float* fiber, unsigned int pts, std::map<segKey,float>& FiberSegments );
+void segmentForwardModel( const Vector<double>& P1, const Vector<double>& P2, double w, std::map<segKey,float>& FiberSegments );
+unsigned int read_fiber( FILE* fp, std::vector<float>& points, int ns, int np );
+void* processBatch( void* ptr );
 
 
 // =========================
@@ -81,25 +107,21 @@ int trk2dictionary(
     float fiber_shiftX, float fiber_shiftY, float fiber_shiftZ, int points_to_skip, float min_seg_len,
     float* ptrPEAKS, int Np, float vf_THR, int ECix, int ECiy, int ECiz,
     float* _ptrMASK, float* ptrTDI, char* path_out, int c, double* ptrAFFINE,
-    int nBlurRadii, double blurSigma, double* ptrBlurRadii, int* ptrBlurSamples, double* ptrBlurWeights
+    int nBlurRadii, double blurSigma, double* ptrBlurRadii, int* ptrBlurSamples, double* ptrBlurWeights,
+    int nThreads
 )
 {
     /*=========================*/
     /*     IC compartments     */
     /*=========================*/
-    float          fiber[3][MAX_FIB_LEN];
-    float          fiberNorm, fiberLen;
     unsigned int   N, totICSegments = 0, totFibers = 0, v;
     unsigned short o;
     unsigned char  kept;
-    Vector<double> P;
     std::string    filename;
     std::string    OUTPUT_path(path_out);
-    std::map<segKey,float>::iterator it;
-
-    std::map<segInVoxKey,float> FiberNorm;
-    std::map<segInVoxKey,float>::iterator itNorm;
-    segInVoxKey         inVoxKey;
+    std::vector<unsigned int> fiberIdx;
+    std::vector<pthread_t>    threads( nThreads );
+    FiberBatch     batch;
 
     printf( "\t* Exporting IC compartments:\n" );
 
@@ -143,48 +165,59 @@ int trk2dictionary(
     filename = OUTPUT_path+"/dictionary_TRK_len.dict";     FILE* pDict_TRK_len   = fopen(filename.c_str(),"wb");
     filename = OUTPUT_path+"/dictionary_TRK_kept.dict";    FILE* pDict_TRK_kept  = fopen(filename.c_str(),"wb");
 
-    // iterate over fibers
+    // iterate over the fibers in batches: the fibers of a batch are read, then processed
+    // in parallel by the threads and finally written in their order, hence the output
+    // does not depend on the number of threads
     ProgressBar PROGRESS( n_count );
     PROGRESS.setPrefix("\t  ");
-    for(int f=0; f<n_count ;f++)
+    batch.out.resize( nThreads * FIBERS_PER_THREAD );
+    for(int f0=0; f0<n_count ;f0+=batch.n)
     {
-        PROGRESS.inc();
-        N = read_fiber( fpTRK, fiber, n_scalars, n_properties );
-        fiberForwardModel( fiber, N, sectors, radii, weights );
+        batch.n    = std::min( n_count-f0, nThreads * FIBERS_PER_THREAD );
+        batch.next = 0;
+        batch.points.clear();
+        batch.offset.resize( batch.n );
+        batch.nPoints.resize( batch.n );
+        for(int i=0; i<batch.n ;i++)
+        {
+            batch.offset[i]  = batch.points.size() / 3;
+            batch.nPoints[i] = read_fiber( fpTRK, batch.points, n_scalars, n_properties );
+        }
 
-        kept = 0;
-        if ( FiberSegments.size() > 0 )
+        int nStarted = 0;
+        for(int t=1; t<nThreads ;t++)
+            if ( pthread_create( &threads[t], NULL, processBatch, &batch ) == 0 )
+                nStarted = t;
+            else
+                break;
+        processBatch( &batch );
+        for(int t=1; t<=nStarted ;t++)
+            pthread_join( threads[t], NULL );
+
+        for(int i=0; i<batch.n ;i++)
         {
-            // add segments to files
-            fiberNorm = 0;
-            fiberLen = 0;
-            for (it=FiberSegments.begin(); it!=FiberSegments.end(); it++)
-            {
-                // NB: plese note inverted ordering for 'v'
-                v = it->first.x + dim.x * ( it->first.y + dim.y * it->first.z );
-                o = it->first.oy + 181 * it->first.ox;
-                fwrite( &totFibers,      4, 1, pDict_IC_f );
-                fwrite( &v,              4, 1, pDict_IC_v );
-                fwrite( &o,              2, 1, pDict_IC_o );
-                fwrite( &(it->second),   4, 1, pDict_IC_len );
-                ptrTDI[ it->first.z + dim.z * ( it->first.y + dim.y * it->first.x ) ] += it->second;
-                inVoxKey.set( it->first.x, it->first.y, it->first.z );
-                FiberNorm[inVoxKey] += it->second;
-                fiberLen += it->second;
-            }
-            for (itNorm=FiberNorm.begin(); itNorm!=FiberNorm.end(); itNorm++)
+            PROGRESS.inc();
+            FiberOutput& fib = batch.out[i];
+            N = fib.v.size();
+            kept = 0;
+            if ( N > 0 )
             {
-                fiberNorm += pow(itNorm->second,2);
+                // add segments to files
+                fiberIdx.assign( N, totFibers );
+                fwrite( &fiberIdx[0], 4, N, pDict_IC_f );
+                fwrite( &fib.v[0],    4, N, pDict_IC_v );
+                fwrite( &fib.o[0],    2, N, pDict_IC_o );
+                fwrite( &fib.len[0],  4, N, pDict_IC_len );
+                for(unsigned int j=0; j<N ;j++)
+                    ptrTDI[ fib.tdi[j] ] += fib.len[j];
+                fwrite( &fib.norm,   1, 4, pDict_TRK_norm ); // actual length considered in optimization
+                fwrite( &fib.length, 1, 4, pDict_TRK_len );
+                totICSegments += N;
+                totFibers++;
+                kept = 1;
             }
-            fiberNorm = sqrt(fiberNorm);
-            FiberNorm.clear();
-            fwrite( &fiberNorm,  1, 4, pDict_TRK_norm ); // actual length considered in optimization
-            fwrite( &fiberLen,   1, 4, pDict_TRK_len );
-            totICSegments += FiberSegments.size();
-            totFibers++;
-            kept = 1;
+            fwrite( &kept, 1, 1, pDict_TRK_kept );
         }
-        fwrite( &kept, 1, 1, pDict_TRK_kept );
     }
     PROGRESS.close();
 
@@ -300,22 +333,78 @@ int trk2dictionary(
 }
 
 
+/********************************************************************************************************************/
+/*                                                   processBatch                                                   */
+/********************************************************************************************************************/
+// Compute the segments of the fibers of a batch, taking FIBERS_PER_CHUNK fibers at a time
+void* processBatch( void* ptr )
+{
+    FiberBatch* batch = (FiberBatch*)ptr;
+    std::map<segKey,float>                FiberSegments;
+    std::map<segKey,float>::iterator      it;
+    std::map<segInVoxKey,float>           FiberNorm;
+    std::map<segInVoxKey,float>::iterator itNorm;
+    segInVoxKey                           inVoxKey;
+    int                                   i, i0, i1;
+
+    while( 1 )
+    {
+        i0 = __sync_fetch_and_add( &batch->next, FIBERS_PER_CHUNK );
+        if ( i0 >= batch->n )
+            break;
+        i1 = std::min( i0+FIBERS_PER_CHUNK, batch->n );
+        for(i=i0; i<i1 ;i++)
+        {
+            FiberOutput& fib = batch->out[i];
+            fib.v.clear();
+            fib.tdi.clear();
+            fib.o.clear();
+            fib.len.clear();
+            fiberForwardModel( &batch->points[3*batch->offset[i]], batch->nPoints[i], FiberSegments );
+            if ( FiberSegments.size() == 0 )
+                continue;
+
+            fib.norm = 0;
+            fib.length = 0;
+            for (it=FiberSegments.begin(); it!=FiberSegments.end(); it++)
+            {
+                // NB: plese note inverted ordering for 'v'
+                fib.v.push_back( it->first.x + dim.x * ( it->first.y + dim.y * it->first.z ) );
+                fib.o.push_back( it->first.oy + 181 * it->first.ox );
+                fib.len.push_back( it->second );
+                fib.tdi.push_back( it->first.z + dim.z * ( it->first.y + dim.y * it->first.x ) );
+                inVoxKey.set( it->first.x, it->first.y, it->first.z );
+                FiberNorm[inVoxKey] += it->second;
+                fib.length += it->second;
+            }
+            for (itNorm=FiberNorm.begin(); itNorm!=FiberNorm.end(); itNorm++)
+            {
+                fib.norm += pow(itNorm->second,2);
+            }
+            fib.norm = sqrt(fib.norm);
+            FiberNorm.clear();
+        }
+    }
+    return NULL;
+}
+
+
 /********************************************************************************************************************/
 /*                                                 fiberForwardModel                                                */
 /********************************************************************************************************************/
-void fiberForwardModel( float fiber[3][MAX_FIB_LEN], unsigned int pts, std::vector<int> sectors, std::vector<double> radii, std::vector<double> weights )
+void fiberForwardModel( const float* fiber, unsigned int pts, std::map<segKey,float>& FiberSegments )
 {
-    static Vector<double> S1, S2, S1m, S2m, P, q, n, qxn, qxqxn;
-    static Vector<double> vox, vmin, vmax, dir;
-    static double         len, t, alpha, w, R;
-    static int            i, j, k;
+    Vector<double> S1, S2, S1m, S2m, P, q, n, qxn, qxqxn;
+    Vector<double> vox, vmin, vmax, dir;
+    double         len, t, alpha, w, R;
+    int            i, j, k;
 
     FiberSegments.clear();
-    for(i=nPointsToSkip; i<pts-1-nPointsToSkip ;i++)
+    for(i=nPointsToSkip; i+1+nPointsToSkip<pts ;i++)
     {
         // original segment to be processed
-        S1.Set( fiber[0][i]   + fiberShiftXmm, fiber[1][i]   + fiberShiftYmm, fiber[2][i]   + fiberShiftZmm );
-        S2.Set( fiber[0][i+1] + fiberShiftXmm, fiber[1][i+1] + fiberShiftYmm, fiber[2][i+1] + fiberShiftZmm );
+        S1.Set( fiber[3*i]   + fiberShiftXmm, fiber[3*i+1] + fiberShiftYmm, fiber[3*i+2] + fiberShiftZmm );
+        S2.Set( fiber[3*i+3] + fiberShiftXmm, fiber[3*i+4] + fiberShiftYmm, fiber[3*i+5] + fiberShiftZmm );
         dir.x = S2.x-S1.x;
         dir.y = S2.y-S1.y;
         dir.z = S2.z-S1.z;
@@ -367,7 +456,7 @@ void fiberForwardModel( float fiber[3][MAX_FIB_LEN], unsigned int pts, std::vect
                 S2m.z = S2.z + R*n.z;
 
                 if ( doIntersect==false )
-                    segmentForwardModel( S1m, S2m, weights[k] );
+                    segmentForwardModel( S1m, S2m, weights[k], FiberSegments );
                 else
                     while( 1 )
                     {
@@ -387,13 +476,13 @@ void fiberForwardModel( float fiber[3][MAX_FIB_LEN], unsigned int pts, std::vect
                         {
                             // add the portion S1P, and then reiterate
                             P.Set( S1m.x + t*dir.x, S1m.y + t*dir.y, S1m.z + t*dir.z );
-                            segmentForwardModel( S1m, P, weights[k] );
+                            segmentForwardModel( S1m, P, weights[k], FiberSegments );
                             S1m.Set( P.x, P.y, P.z );
                         }
                         else
                         {
                             // add the segment S1S2 and stop iterating
-                            segmentForwardModel( S1m, S2m, weights[k] );
+                            segmentForwardModel( S1m, S2m, weights[k], FiberSegments );
                             break;
                         }
                     }
@@ -406,12 +495,12 @@ void fiberForwardModel( float fiber[3][MAX_FIB_LEN], unsigned int pts, std::vect
 /********************************************************************************************************************/
 /*                                                segmentForwardModel                                               */
 /********************************************************************************************************************/
-void segmentForwardModel( const Vector<double>& P1, const Vector<double>& P2, double w )
+void segmentForwardModel( const Vector<double>& P1, const Vector<double>& P2, double w, std::map<segKey,float>& FiberSegments )
 {
-    static Vector<int>    vox;
-    static Vector<double> dir, dirTrue;
-    static double         longitude, colatitude, len;
-    static segKey         key;
+    Vector<int>    vox;
+    Vector<double> dir, dirTrue;
+    double         longitude, colatitude, len;
+    segKey         key;
 
     // direction of the segment
     dir.y = P2.y-P1.y;
@@ -455,8 +544,8 @@ void segmentForwardModel( const Vector<double>& P1, const Vector<double>& P2, do
 /********************************************************************************************************************/
 bool rayBoxIntersection( Vector<double>& origin, Vector<double>& direction, Vector<double>& vmin, Vector<double>& vmax, double & t)
 {
-    static double tmin, tmax, tymin, tymax, tzmin, tzmax;
-    static Vector<double> invrd;
+    double tmin, tmax, tymin, tymax, tzmin, tzmax;
+    Vector<double> invrd;
 
     // inverse direction to catch float problems
     invrd.x = 1.0 / direction.x;
@@ -512,8 +601,8 @@ bool rayBoxIntersection( Vector<double>& origin, Vector<double>& direction, Vect
 }
 
 
-// Read a fiber from file
-unsigned int read_fiber( FILE* fp, float fiber[3][MAX_FIB_LEN], int ns, int np )
+// Read a fiber from file and append its points to 'points'
+unsigned int read_fiber( FILE* fp, std::vector<float>& points, int ns, int np )
 {
     int N;
     fread((char*)&N, 1, 4, fp);
@@ -525,9 +614,9 @@ unsigned int read_fiber( FILE* fp, float fiber[3][MAX_FIB_LEN], int ns, int np )
     for(int i=0; i<N; i++)
     {
         fread((char*)tmp, 1, 12, fp);
-        fiber[0][i] = tmp[0];
-        fiber[1][i] = tmp[1];
-        fiber[2][i] = tmp[2];
+        points.push_back( tmp[0] );
+        points.push_back( tmp[1] );
+        points.push_back( tmp[2] );
         fseek(fp,4*ns,SEEK_CUR);
     }
     fseek(fp,4*np,SEEK_CUR);
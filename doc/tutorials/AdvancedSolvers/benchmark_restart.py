@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+from __future__ import division, print_function
+
+import argparse
+
+import numpy as np
+import commit
+from commit import trk2dictionary
+
+DESCRIPTION = """
+Compare the momentum schemes of FISTA on the data of the "Getting started"
+tutorial (LausanneTwoShell): the plain scheme, the adaptive restarts based on
+the objective ('function') and on the gradient ('gradient'), and the monotone
+variant. For every scheme and relative tolerance on the objective, the number
+of iterations needed to meet the tolerance, the number of restarts and the
+distance of the final objective from the optimal one are reported; the latter
+is estimated beforehand with a tight tolerance.
+
+Run it from the folder where the archive of the tutorial has been unzipped.
+"""
+
+SCHEMES = [
+    ( 'plain',             None,       False ),
+    ( 'function',          'function', False ),
+    ( 'gradient',          'gradient', False ),
+    ( 'monotone',          None,       True  ),
+    ( 'monotone+gradient', 'gradient', True  ),
+]
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('--subject', action='store', default='LausanneTwoShell',
+                   help='Folder of the data of the tutorial.')
+    p.add_argument('--tol_fun', action='store', type=float, nargs='+', default=[1e-3, 1e-4, 1e-5, 1e-6],
+                   help='Relative tolerances on the objective.')
+    p.add_argument('--max_iter', action='store', type=int, default=5000,
+                   help='Maximum number of iterations of each fit.')
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    trk2dictionary.run(
+        filename_trk   = args.subject + '/fibers.trk',
+        path_out       = args.subject + '/CommitOutput',
+        filename_peaks = args.subject + '/peaks.nii.gz',
+        filename_mask  = args.subject + '/WM.nii.gz',
+        fiber_shift    = 0.5,
+        peaks_use_affine = True
+    )
+
+    commit.core.setup()
+    mit = commit.Evaluation( '.', args.subject )
+    mit.load_data( 'DWI.nii', 'DWI.scheme' )
+    mit.set_model( 'StickZeppelinBall' )
+    mit.model.set( 1.7E-3, [ 0.7 ], [ 1.7E-3, 3.0E-3 ] )
+    mit.generate_kernels( regenerate=True )
+    mit.load_kernels()
+    mit.load_dictionary( 'CommitOutput' )
+    mit.set_threads()
+    mit.build_operator()
+
+    # reference objective
+    mit.fit( tol_fun=1e-10, tol_x=0, max_iter=10*args.max_iter, verbose=0, restart='gradient' )
+    best = mit.get_config('optimization')['fit_details']['cost_function']
+
+    results = []
+    for tol in args.tol_fun:
+        for name, restart, monotone in SCHEMES:
+            mit.fit( tol_fun=tol, tol_x=0, max_iter=args.max_iter, verbose=0, restart=restart, monotone=monotone )
+            details = mit.get_config('optimization')['fit_details']
+            results.append( (tol, name, details['iterations'], len(details['restarts']), (details['cost_function']-best)/best) )
+
+    print()
+    print('%10s %-18s %10s %10s %16s' % ('tol_fun', 'scheme', 'iterations', 'restarts', 'rel. distance'))
+    for r in results:
+        print('%10.0e %-18s %10d %10d %16.4e' % r)
+
+
+if __name__ == "__main__":
+    main()
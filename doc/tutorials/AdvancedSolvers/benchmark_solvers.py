@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+from __future__ import division, print_function
+
+import argparse
+import time
+
+import numpy as np
+import commit
+from commit import trk2dictionary
+
+DESCRIPTION = """
+Compare the solvers available in commit.solvers.SOLVERS on the data of the
+"Getting started" tutorial (LausanneTwoShell), fitting the default non-negative
+least squares problem with each of them. For every solver, the number of
+products with A and A', the wall time and the final objective are reported.
+
+Run it from the folder where the archive of the tutorial has been unzipped.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('--subject', action='store', default='LausanneTwoShell',
+                   help='Folder of the data of the tutorial.')
+    p.add_argument('--solvers', action='store', nargs='+', default=['fista', 'lbfgs'],
+                   help='Names of the solvers to compare.')
+    p.add_argument('--max_iter', action='store', type=int, default=1000,
+                   help='Maximum number of iterations of each solver.')
+    p.add_argument('--tol_fun', action='store', type=float, default=1e-6,
+                   help='Relative tolerance on the objective.')
+    p.add_argument('--single_precision', action='store_true',
+                   help='Solve in single precision.')
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    trk2dictionary.run(
+        filename_trk   = args.subject + '/fibers.trk',
+        path_out       = args.subject + '/CommitOutput',
+        filename_peaks = args.subject + '/peaks.nii.gz',
+        filename_mask  = args.subject + '/WM.nii.gz',
+        fiber_shift    = 0.5,
+        peaks_use_affine = True
+    )
+
+    commit.core.setup()
+    mit = commit.Evaluation( '.', args.subject )
+    mit.load_data( 'DWI.nii', 'DWI.scheme' )
+    mit.set_model( 'StickZeppelinBall' )
+    mit.model.set( 1.7E-3, [ 0.7 ], [ 1.7E-3, 3.0E-3 ] )
+    mit.generate_kernels( regenerate=True )
+    mit.load_kernels()
+    mit.load_dictionary( 'CommitOutput' )
+    mit.set_threads()
+    mit.build_operator()
+
+    results = []
+    for solver in args.solvers:
+        tic = time.time()
+        mit.fit( tol_fun=args.tol_fun, max_iter=args.max_iter, verbose=0,
+                 single_precision=args.single_precision, solver=solver )
+        elapsed = time.time() - tic
+        details = mit.get_config('optimization')['fit_details']
+        results.append( (solver, details['iterations'], details['matvecs'], elapsed, details['cost_function']) )
+
+    print()
+    print('%-10s %10s %10s %12s %16s' % ('solver', 'iterations', 'matvecs', 'time [s]', 'cost function'))
+    for r in results:
+        print('%-10s %10d %10d %12.1f %16.8e' % r)
+    print()
+    print('NB: the time of fista includes the estimate of the step size, which is cached')
+    print('    for the following fits; its products are not counted in "matvecs".')
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ except ImportError:
                 run pip install vtk.""")
 from vtk.util.numpy_support import vtk_to_numpy
 import sys
+from commit.history import HistoryReader, FILENAME as HISTORY_FILENAME
 
 
 DESCRIPTION = """
@@ -63,6 +64,7 @@ model = None
 bar = None
 lut_cmap = None
 list_x_file = None
+history = None
 max_weight = None
 saturation = None
 renderer = None
@@ -70,6 +72,7 @@ norm_fib = None
 norm1 = None
 norm2 = None
 norm3 = None
+perm = None
 big_stream_actor = None
 good_stream_actor = None
 weak_stream_actor = None
@@ -100,6 +103,7 @@ def main():
     global bar
     global lut_cmap
     global list_x_file
+    global history
     global max_weight
     global saturation
     global renderer
@@ -107,6 +111,7 @@ def main():
     global norm1
     global norm2
     global norm3
+    global perm
     global big_stream_actor
     global good_stream_actor
     global weak_stream_actor
@@ -145,12 +150,17 @@ def main():
         sys.exit(0)
 
 
-    #formalizing the filenames of the iterations
-    list_x_file = [file for file in os.listdir(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/") if (file.endswith('.npy') and (file[:-4]).isdigit() )]
-    normalize_file_name(list_x_file)
-    list_x_file.sort()
+    #the iterations are read one at a time from the history file
+    history = HistoryReader(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+HISTORY_FILENAME)
+    list_x_file = [str(it).zfill(4) for it in history.iterations]
     num_iteration=len(list_x_file)
 
+    #the coefficients and norm_fib follow the order of the fibers in the dictionary,
+    #which differs from the one of the streamlines if it was loaded with sort_fibers
+    perm = None
+    if(os.path.isfile(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/perm.npy")):
+        perm = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/perm.npy").astype(np.int64)
+
     #number of streamlines we want to load
     num_computed_streamlines = int(args.streamlinesNumber)
     #computing interval of weights
@@ -178,10 +188,10 @@ def main():
         norm1 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm1.npy")
         norm2 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm2.npy")
         norm3 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm3.npy")
-        for itNbr in list_x_file:
+        for x in history:
             #computing diameter
-            x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+ itNbr +'.npy')
             x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+            x_norm = fibers_to_input_order(x_norm)
 
             for i in range(nIC):
                 den_ADI = den_ADI + x_norm[i*nF:(i+1)*nF]
@@ -200,9 +210,9 @@ def main():
         norm2 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm2.npy")
         norm3 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm3.npy")
         nF = object_file[0]['optimization']['regularisation']['sizeIC']
-        for itNbr in list_x_file:
-            x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+ itNbr +'.npy')
+        for x in history:
             x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+            x_norm = fibers_to_input_order(x_norm)
 
             Weight = x_norm[:nF]  #signal fractions
             smallWeight_safe = Weight[:num_computed_streamlines]
@@ -232,11 +242,12 @@ def main():
 
         norm_fib = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm_fib.npy")
         #add the normalisation
-        x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list_x_file[0]+'.npy')
+        x = history[0]
         norm1 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm1.npy")
         norm2 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm2.npy")
         norm3 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm3.npy")
         x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+        x_norm = fibers_to_input_order(x_norm)
 
         num_ADI = np.zeros( nF )
         den_ADI = np.zeros( nF )
@@ -254,11 +265,12 @@ def main():
         file = open( args.commitOutputPath+"/Results_"+model+"ZeppelinBall/results.pickle",'rb' )
         object_file = pickle.load( file )
         nF = object_file[0]['optimization']['regularisation']['sizeIC']
-        x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list_x_file[0]+'.npy')
+        x = history[0]
         norm1 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm1.npy")
         norm2 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm2.npy")
         norm3 = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/norm3.npy")
         x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+        x_norm = fibers_to_input_order(x_norm)
 
         Weight = x_norm[:nF]  #signal fractions
         smallWeight_safe = Weight[:num_computed_streamlines]
@@ -453,23 +465,6 @@ def main():
 
 #some usefull functions:
 
-def normalize_file_name(list):
-    """the iterations of COMMIT's files names has to be of the form xxxx.npy
-
-    Parameters
-    ----------
-    list : list
-        a list of each iteration's file that we will normalize
-    """
-    i=0
-    while(i<len(list)):
-        if list[i].endswith('.npy'):
-            list[i] = list[i][:-4]
-            os.rename(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list[i]+'.npy', args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list[i].zfill(4)+'.npy')
-            list[i] = list[i].zfill(4)
-        i=i+1
-    return
-    
 #to refresh the ShowManager each time there is a visual change
 def refresh_showManager(i_ren, obj, slider):
 
@@ -575,6 +570,16 @@ def change_colormap(i_ren, obj, slider):
     return
 
         
+#put the IC coefficients in the order of the streamlines (see Evaluation.fibers_to_input_order)
+def fibers_to_input_order(x_norm):
+    if perm is None:
+        return x_norm
+    x_norm = x_norm.copy()
+    for i in range(len(norm1)//nF):
+        x_norm[i*nF+perm] = x_norm[i*nF:(i+1)*nF].copy()
+    return x_norm
+
+
 #function called by the iteration's slider
 def change_iteration(i_ren, obj, slider):
     global Weight
@@ -582,8 +587,9 @@ def change_iteration(i_ren, obj, slider):
     
     if(model == "Cylinder"):
         #load the weights of the correct iteration according to the slider
-        x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list_x_file[int(slider.value)]+'.npy')
+        x = history[int(slider.value)]
         x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+        x_norm = fibers_to_input_order(x_norm)
 
         num_ADI = np.zeros( nF )
         den_ADI = np.zeros( nF )
@@ -596,8 +602,9 @@ def change_iteration(i_ren, obj, slider):
         smallWeight_safe = Weight[:num_computed_streamlines]
     else:#model==Stick
         #load the weights of the correct iteration according to the slider
-        x = np.load(args.commitOutputPath+"/Coeff_x_"+model+"ZeppelinBall/"+list_x_file[int(slider.value)]+'.npy')
+        x = history[int(slider.value)]
         x_norm = x / np.hstack( (norm1*norm_fib,norm2,norm3) )
+        x_norm = fibers_to_input_order(x_norm)
 
         Weight = x_norm[:nF]  #signal fractions
         smallWeight_safe = Weight[:num_computed_streamlines]
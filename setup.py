@@ -1,3 +1,4 @@
+import sys
 from distutils.core import setup, Extension
 from Cython.Distutils import build_ext
 from Cython.Build import cythonize
@@ -10,7 +11,7 @@ ext1 = Extension(
     sources=['commit/trk2dictionary/trk2dictionary.pyx'],
     include_dirs=[numpy.get_include()],
     extra_compile_args=['-w'],
-    extra_link_args=[],
+    extra_link_args=['-pthread'],
     language='c++',
 )
 
@@ -23,15 +24,33 @@ ext2 = Extension(
     language='c++',
 )
 
+# the group sparsity is processed in parallel with OpenMP (not available with the default compiler of macOS)
+openmp = [] if sys.platform == 'darwin' else ['-fopenmp']
 ext3 = Extension(
     name='commit.proximals',
     sources=['commit/proximals.pyx'],
     include_dirs=[numpy.get_include()],
-    extra_compile_args=['-w'],
-    extra_link_args=[],
+    extra_compile_args=['-w'] + openmp,
+    extra_link_args=openmp,
     language='c++',
 )
 
+# Cython extension with the C code performing the matrix-vector multiplications
+# with A and A' (the number of compartments and threads are set at runtime)
+ext4 = Extension(
+    name='commit.operator.operator',
+    sources=[
+        'commit/operator/operator.pyx',
+        'commit/operator/operator_pool.c',
+        'commit/operator/operator_withLUT.c',
+        'commit/operator/operator_noLUT.c',
+        'commit/operator/operator_sparse.c',
+    ],
+    include_dirs=[numpy.get_include(), 'commit/operator'],
+    extra_compile_args=['-w', '-O3', '-Ofast'],
+    extra_link_args=['-pthread'],
+)
+
 setup(
     name='commit',
     version='1.0',
@@ -40,9 +59,6 @@ setup(
     author_email='alessandro.daducci@gmail.com',
     url='https://github.com/daducci/COMMIT',
     cmdclass = {'build_ext':build_ext},
-    ext_modules = [ ext1, ext2, ext3 ],
+    ext_modules = [ ext1, ext2, ext3, ext4 ],
     packages=['commit','commit.operator'],
-    package_data={
-        'commit.operator':["*.*"], # needed by pyximport to compile at runtime
-    },
 )